@@ -0,0 +1,59 @@
+"""Base class for the in-process AWS fakes the benchmarks run against.
+
+A FakeBoto hooks botocore's before-call event (the same mechanism Stubber
+uses), so the code under test builds real boto3 clients, validates real
+parameters and walks real paginators, but no request ever leaves the process.
+Subclasses answer each call in _respond().
+"""
+
+import threading
+
+import boto3
+from botocore.awsrequest import AWSResponse
+
+
+class FakeBoto:
+    """Answers the calls of clients of service (default: every service) made through one boto3 session.
+
+    calls counts the calls answered, keyed however the subclass likes.
+    """
+    service = None
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def install(self, session=None):
+        """Answer every call made through clients created from session (default: boto3's default session) from now on."""
+        if session is None:
+            boto3.setup_default_session(aws_access_key_id="fake", aws_secret_access_key="fake")
+            session = boto3.DEFAULT_SESSION
+        suffix = "." + self.service if self.service else ""
+        events = session._session
+        events.register("before-parameter-build" + suffix, self._remember_params)
+        events.register("before-call" + suffix, self._respond)
+        return session
+
+    def api_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def _count_call(self, key):
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def _remember_params(self, params, context, **kwargs):
+        context["fake_params"] = dict(params)
+
+    def _respond(self, model, context, **kwargs):
+        """Answer the call of model (an OperationModel) whose parameters are context["fake_params"]."""
+        raise NotImplementedError
+
+    def _reply(self, parsed):
+        """Return parsed, the response as botocore would parse it, as a before-call handler's answer.
+
+        A parsed response with an "Error" is sent as a 400, which the client raises as a ClientError.
+        """
+        status = 400 if "Error" in parsed else 200
+        parsed.setdefault("ResponseMetadata", {"HTTPStatusCode": status})
+        return AWSResponse(None, status, {}, None), parsed
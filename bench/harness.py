@@ -0,0 +1,44 @@
+"""What the benchmark scripts share: running a scenario in a fresh interpreter, and checking results against a baseline.
+
+Each benchmark runs every scenario in a subprocess of itself, so peak RSS is
+per scenario, and can save its results with --json to --compare a later run
+against.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+
+def run_in_subprocess(script, flag, payload):
+    """Run `script flag JSON(payload)` in a fresh interpreter and return the JSON it prints."""
+    out = subprocess.run([sys.executable, os.path.abspath(script), flag, json.dumps(payload)],
+                         stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    return json.loads(out)
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of human-readable regressions of results against baseline.
+
+    Both map scenario names to {metric: value}; tolerance maps each metric
+    compared to how much worse than the baseline it may get, e.g. 1.25.
+    Scenarios missing from the baseline are skipped.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric, limit in tolerance.items():
+            old, new = baseline[name][metric], result[metric]
+            if old and new > old * limit:
+                regressions.append("{}: {} went from {} to {}".format(name, metric, old, new))
+    return regressions
+
+
+def exit_on_regressions(regressions):
+    """Print regressions to stderr, and exit 1 if there are any."""
+    for line in regressions:
+        print("REGRESSION: " + line, file=sys.stderr)
+    if regressions:
+        sys.exit(1)
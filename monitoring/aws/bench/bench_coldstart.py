@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""Cold versus warm start timings for the periodic instance-report Lambda.
+
+Each mode runs in a fresh subprocess, the way Lambda starts a new execution
+environment: it times the module import (the init phase), then invokes the
+real lambda_handler several times against FakeAWS, as warm starts would.
+"uncached" builds a new client for every call, as the Lambda used to, so the
+cost of client creation shows up against "cached":
+
+    ./bench_coldstart.py
+    ./bench_coldstart.py --invocations 10 --regions 4 --latency 0.02
+    ./bench_coldstart.py --json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "lambda"))
+sys.path.insert(0, os.path.join(HERE, "..", "..", "..", "bench"))
+
+from bench_lambda import DEFAULT_REGIONS, FakeContext
+import harness
+
+MODES = ["cached", "uncached"]
+
+
+def run_mode(scenario):
+    """Import the Lambda and invoke it scenario["invocations"] times in this process."""
+    start = time.monotonic()
+    import periodic_lambda_function
+    init_ms = (time.monotonic() - start) * 1000
+
+    import boto3
+    from fake_aws import FakeAWS
+
+    if scenario["mode"] == "uncached":
+        periodic_lambda_function.get_client = lambda service, region: boto3.client(service, region)
+    fake = FakeAWS(scenario["regions"], scenario["instances"], latency={"*": scenario["latency"]})
+    session = fake.install()
+    clients = []
+    session._session.register("creating-client-class", lambda **kwargs: clients.append(1))
+
+    event = {
+        "regions": scenario["regions"],
+        "recipients": ["someone@example.com"],
+        "fromemail": "return@example.com",
+        "emailregion": "us-east-1",
+    }
+    invocations = []
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            for _ in range(scenario["invocations"]):
+                del clients[:]
+                start = time.monotonic()
+                periodic_lambda_function.lambda_handler(event, FakeContext(scenario["timeout"]))
+                invocations.append({"ms": round((time.monotonic() - start) * 1000, 1), "clients": len(clients)})
+        finally:
+            sys.stdout = stdout
+
+    warm = invocations[1:] or invocations
+    return {
+        "init_ms": round(init_ms, 1),
+        "first_ms": invocations[0]["ms"],
+        "warm_ms": round(statistics.median(i["ms"] for i in warm), 1),
+        "first_clients": invocations[0]["clients"],
+        "warm_clients": max(i["clients"] for i in warm),
+        "invocations": invocations,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_coldstart.py", description="Time cold and warm invocations of the periodic Lambda against a fake AWS.")
+    parser.add_argument("--invocations", type=int, default=5, help="Invocations per mode; the first is the cold one.")
+    parser.add_argument("--instances", type=int, default=1000, help="Fleet size.")
+    parser.add_argument("--regions", type=int, default=len(DEFAULT_REGIONS), help="How many regions to spread the fleet across.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every fake API call.")
+    parser.add_argument("--timeout", type=float, default=30, help="Lambda timeout the handler sees, in seconds.")
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES, help="Modes to run.")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON, including every invocation.")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_mode(json.loads(args.run_one))))
+        return
+
+    results = {}
+    for mode in args.modes:
+        results[mode] = harness.run_in_subprocess(__file__, "--run-one", {
+            "mode": mode,
+            "invocations": args.invocations,
+            "instances": args.instances,
+            "regions": DEFAULT_REGIONS[:args.regions],
+            "latency": args.latency,
+            "timeout": args.timeout,
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print("{:<10} {:>9} {:>10} {:>9} {:>14} {:>13}".format("mode", "init_ms", "first_ms", "warm_ms", "first_clients", "warm_clients"))
+        for mode, r in results.items():
+            print("{:<10} {:>9} {:>10} {:>9} {:>14} {:>13}".format(mode, r["init_ms"], r["first_ms"], r["warm_ms"], r["first_clients"], r["warm_clients"]))
+
+
+if __name__ == "__main__":
+    main()
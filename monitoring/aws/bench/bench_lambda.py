@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+"""Offline benchmarks for the periodic instance-report Lambda.
+
+Each scenario runs the real lambda_handler in a fresh subprocess against
+FakeAWS, so peak RSS is per scenario and no AWS account is needed:
+
+    ./bench_lambda.py
+    ./bench_lambda.py --instances 10 1000 50000 --latency 0.05 --slow ap-east-1=2
+    ./bench_lambda.py --json > baseline.json
+    ./bench_lambda.py --compare baseline.json    # exits 1 on a regression
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "lambda"))
+sys.path.insert(0, os.path.join(HERE, "..", "..", "..", "bench"))
+
+import harness  # noqa: E402
+
+# The regions the report scanned before it learned to discover them
+DEFAULT_REGIONS = ["us-east-1", "us-east-2", "us-west-1", "us-west-2", "ap-east-1", "ap-south-1",
+                   "ap-northeast-2", "ap-southeast-1", "ap-southeast-2", "ap-northeast-1", "ca-central-1",
+                   "eu-central-1", "eu-west-1", "eu-west-2", "eu-west-3", "eu-north-1", "me-south-1", "sa-east-1"]
+
+# Metrics compared by --compare, and how much worse than the baseline each may get
+REGRESSION_TOLERANCE = {"seconds": 1.25, "peak_rss_mb": 1.25, "api_calls": 1.0, "report_bytes": 1.1}
+
+
+class FakeContext:
+    """Just enough of the Lambda context object for the handler's deadline logic."""
+    def __init__(self, timeout):
+        self.end = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int((self.end - time.monotonic()) * 1000)
+
+
+def run_scenario(scenario):
+    """Run one scenario in this process and return its measurements."""
+    from fake_aws import FakeAWS
+
+    fake = FakeAWS(scenario["regions"], scenario["instances"], latency=scenario["latency"], errors=scenario["errors"])
+    fake.install()
+    import periodic_lambda_function
+
+    event = {
+        "regions": scenario["regions"],
+        "recipients": ["someone@example.com"],
+        "fromemail": "return@example.com",
+        "emailregion": "us-east-1",
+    }
+    event.update(scenario["event"])
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.monotonic()
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            periodic_lambda_function.lambda_handler(event, FakeContext(scenario["timeout"]))
+        finally:
+            sys.stdout = stdout
+    seconds = time.monotonic() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return {
+        "seconds": round(seconds, 3),
+        # ru_maxrss is KiB on Linux
+        "peak_rss_mb": round(peak_rss / 1024, 1),
+        "rss_growth_mb": round((peak_rss - rss_before) / 1024, 1),
+        "api_calls": fake.api_calls(),
+        "calls": fake.calls,
+        "emails": len(fake.emails),
+        "report_bytes": sum(len(e) for e in fake.emails),
+    }
+
+
+def scenario_name(scenario):
+    return "{}i/{}r".format(scenario["instances"], len(scenario["regions"]))
+
+
+def build_scenarios(args):
+    latency = {"*": args.latency}
+    for spec in args.slow:
+        region, seconds = spec.split("=")
+        latency[region] = float(seconds)
+    errors = {region: "UnauthorizedOperation" for region in args.fail}
+    regions = DEFAULT_REGIONS[:args.regions]
+    return [{
+        "instances": n,
+        "regions": regions,
+        "latency": latency,
+        "errors": errors,
+        "timeout": args.timeout,
+        "event": json.loads(args.event),
+    } for n in args.instances]
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_lambda.py", description="Benchmark the periodic Lambda against a fake AWS.")
+    parser.add_argument("--instances", type=int, nargs="+", default=[10, 1000, 10000, 50000], help="Fleet sizes to run, one scenario each.")
+    parser.add_argument("--regions", type=int, default=len(DEFAULT_REGIONS), help="How many regions to spread each fleet across.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every fake API call.")
+    parser.add_argument("--slow", metavar="REGION=SECONDS", action="append", default=[], help="Per-call latency override for one region.")
+    parser.add_argument("--fail", metavar="REGION", action="append", default=[], help="Make every EC2 and ELB call in REGION fail.")
+    parser.add_argument("--timeout", type=float, default=30, help="Lambda timeout the handler sees, in seconds.")
+    parser.add_argument("--event", default="{}", help="JSON merged into the handler's event, e.g. '{\"concurrency\": 4}'.")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON (usable with --compare).")
+    parser.add_argument("--compare", metavar="BASELINE_JSON", help="Exit 1 if any scenario regressed against this earlier --json output.")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_scenario(json.loads(args.run_one))))
+        return
+
+    results = {}
+    for scenario in build_scenarios(args):
+        results[scenario_name(scenario)] = harness.run_in_subprocess(__file__, "--run-one", scenario)
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print("{:<16} {:>9} {:>12} {:>10} {:>7} {:>13}".format("scenario", "seconds", "peak_rss_mb", "api_calls", "emails", "report_bytes"))
+        for name, r in results.items():
+            print("{:<16} {:>9} {:>12} {:>10} {:>7} {:>13}".format(name, r["seconds"], r["peak_rss_mb"], r["api_calls"], r["emails"], r["report_bytes"]))
+
+    if args.compare:
+        with open(args.compare) as f:
+            harness.exit_on_regressions(harness.compare(results, json.load(f), REGRESSION_TOLERANCE))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+"""In-process stand-in for the EC2, ELB, SES and S3 calls made by the periodic Lambda; see fake_boto.py."""
+
+import io
+import os
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "bench"))
+
+from fake_boto import FakeBoto  # noqa: E402
+
+
+class FakeAWS(FakeBoto):
+    """A synthetic fleet of instances spread evenly across regions.
+
+    Instance i in a region is stopped when i % 10 == 0, has no Name tag when
+    i % 25 == 0, and belongs to the team-czcpt cluster when i % 7 == 0, so every
+    filter in the Lambda has something to do. Every six instances make a
+    cluster, and some clusters leave other resources behind; see _leftovers().
+
+    latency maps region (or "*") to seconds slept per call. errors maps region
+    to an error code that every EC2 and ELB call in that region fails with.
+    """
+    def __init__(self, regions, instances, latency=None, errors=None):
+        super().__init__()
+        self.regions = list(regions)
+        self.per_region = {}
+        for n, region in enumerate(self.regions):
+            self.per_region[region] = instances // len(self.regions) + (1 if n < instances % len(self.regions) else 0)
+        self.latency = latency or {}
+        self.errors = errors or {}
+        self.emails = []
+        self.objects = {}
+        self.leftovers = {}
+
+    def _respond(self, model, context, **kwargs):
+        # service_name, unlike endpoint_prefix, tells elb from elbv2
+        service = model.service_model.service_name
+        region = context["client_region"]
+        key = "{}:{}".format(service, model.name)
+        self._count_call(key)
+
+        delay = self.latency.get(region, self.latency.get("*", 0))
+        if delay:
+            time.sleep(delay)
+
+        handler = getattr(self, "_{}_{}".format(service.replace("-", "_"), model.name), None)
+        if handler is None:
+            raise NotImplementedError("FakeAWS does not implement {}".format(key))
+        if service in ("ec2", "elb", "elbv2") and region in self.errors:
+            return self._error(self.errors[region], "injected failure in {}".format(region))
+        try:
+            parsed = handler(region, context.get("fake_params", {}))
+        except KeyError as e:
+            return self._error(e.args[0], "not found")
+        return self._reply(parsed)
+
+    def _error(self, code, message):
+        return self._reply({"Error": {"Code": code, "Message": message}})
+
+    def _instance(self, region, i):
+        tags = []
+        if i % 25:
+            name = "team-czcpt-{}".format(i) if i % 7 == 0 else "ci-op-{:06d}-{}-master-{}".format(i // 6, region, i % 3)
+            tags.append({"Key": "Name", "Value": name})
+        tags.append({"Key": "kubernetes.io/cluster/ci-op-{:06d}".format(i // 6), "Value": "owned"})
+        return {
+            "InstanceId": "i-{:08x}{:09x}".format(zlib.crc32(region.encode()), i),
+            "InstanceType": "m5.xlarge",
+            "ImageId": "ami-0123456789abcdef0",
+            "LaunchTime": "2026-01-01T00:00:00Z",
+            "State": {"Code": 80 if i % 10 == 0 else 16, "Name": "stopped" if i % 10 == 0 else "running"},
+            "Tags": tags,
+        }
+
+    def _matches(self, instance, filters):
+        for f in filters:
+            if f["Name"] == "instance-state-name":
+                if instance["State"]["Name"] not in f["Values"]:
+                    return False
+            elif f["Name"] == "tag-key":
+                if not any(t["Key"] in f["Values"] for t in instance["Tags"]):
+                    return False
+            else:
+                raise NotImplementedError("FakeAWS does not implement filter {}".format(f["Name"]))
+        return True
+
+    def _ec2_DescribeInstances(self, region, params):
+        start = int(params.get("NextToken", 0))
+        page_size = params.get("MaxResults", 1000)
+        filters = params.get("Filters", [])
+        total = self.per_region.get(region, 0)
+        instances = []
+        i = start
+        # Like EC2, MaxResults bounds how many instances are examined per page,
+        # not how many survive the filters.
+        while i < total and i - start < page_size:
+            instance = self._instance(region, i)
+            if self._matches(instance, filters):
+                instances.append(instance)
+            i += 1
+        parsed = {"Reservations": [{"ReservationId": "r-{}".format(start), "Instances": instances}] if instances else []}
+        if i < total:
+            parsed["NextToken"] = str(i)
+        return parsed
+
+    def _leftovers(self, region):
+        """Return {kind: [resource]} for what the region's clusters left behind.
+
+        Cluster c has an unattached volume when c % 3 == 0, an unassociated
+        Elastic IP when c % 4 == 0, a NAT gateway and an orphaned snapshot when
+        c % 5 == 0, two network load balancers when c % 2 == 0 and a classic
+        one when c % 8 == 0. Every cluster also has a volume in use and a
+        snapshot of it, and when c % 10 == 0 an AMI and its snapshot.
+        """
+        with self.lock:
+            if region not in self.leftovers:
+                self.leftovers[region] = self._make_leftovers(region)
+            return self.leftovers[region]
+
+    def _make_leftovers(self, region):
+        clusters = (self.per_region.get(region, 0) + 5) // 6
+        crc = zlib.crc32(region.encode())
+        kinds = {"volumes": [], "addresses": [], "nat_gateways": [], "load_balancers": [],
+                 "classic_load_balancers": [], "snapshots": [], "images": []}
+        for c in range(clusters):
+            infra = "ci-op-{:06d}".format(c)
+            tags = [{"Key": "kubernetes.io/cluster/{}".format(infra), "Value": "owned"}]
+            named = lambda suffix: tags + [{"Key": "Name", "Value": "{}-{}".format(infra, suffix)}]
+            in_use = "vol-{:08x}{:09x}".format(crc, 2 * c)
+            kinds["volumes"].append({"VolumeId": in_use, "State": "in-use", "Size": 120, "Tags": named("master-0")})
+            kinds["snapshots"].append({"SnapshotId": "snap-{:08x}{:09x}".format(crc, 3 * c), "VolumeId": in_use, "Tags": tags})
+            if c % 3 == 0:
+                kinds["volumes"].append({"VolumeId": "vol-{:08x}{:09x}".format(crc, 2 * c + 1), "State": "available",
+                                         "Size": 100, "Tags": named("dynamic-pvc-{}".format(c))})
+            if c % 4 < 2:
+                address = {"AllocationId": "eipalloc-{:08x}{:09x}".format(crc, c), "PublicIp": "198.51.{}.{}".format(c // 256 % 256, c % 256),
+                           "Domain": "vpc", "Tags": named("eip-{}a".format(region))}
+                if c % 4 == 1:
+                    address["AssociationId"] = "eipassoc-{:08x}{:09x}".format(crc, c)
+                kinds["addresses"].append(address)
+            if c % 5 == 0:
+                kinds["nat_gateways"].append({"NatGatewayId": "nat-{:08x}{:09x}".format(crc, c), "State": "available",
+                                              "Tags": named("nat-{}a".format(region))})
+                kinds["snapshots"].append({"SnapshotId": "snap-{:08x}{:09x}".format(crc, 3 * c + 1), "VolumeId": "vol-ffffffff", "Tags": tags})
+            if c % 10 == 0:
+                snapshot = "snap-{:08x}{:09x}".format(crc, 3 * c + 2)
+                kinds["snapshots"].append({"SnapshotId": snapshot, "VolumeId": "vol-ffffffff", "Tags": tags})
+                kinds["images"].append({"ImageId": "ami-{:08x}{:09x}".format(crc, c),
+                                        "BlockDeviceMappings": [{"DeviceName": "/dev/xvda", "Ebs": {"SnapshotId": snapshot}}]})
+            if c % 2 == 0:
+                for scheme in ("int", "ext"):
+                    name = "{}-{}".format(infra, scheme)
+                    kinds["load_balancers"].append({
+                        "LoadBalancerArn": "arn:aws:elasticloadbalancing:{}:123456789012:loadbalancer/net/{}/{:016x}".format(region, name, c),
+                        "LoadBalancerName": name, "Type": "network", "Tags": tags})
+            if c % 8 == 0:
+                kinds["classic_load_balancers"].append({"LoadBalancerName": "a{:031x}".format(c), "Tags": tags})
+        return kinds
+
+    def _ec2_DescribeVolumes(self, region, params):
+        volumes = self._leftovers(region)["volumes"]
+        for f in params.get("Filters", []):
+            if f["Name"] != "status":
+                raise NotImplementedError("FakeAWS does not implement filter {}".format(f["Name"]))
+            volumes = [v for v in volumes if v["State"] in f["Values"]]
+        return {"Volumes": volumes}
+
+    def _ec2_DescribeAddresses(self, region, params):
+        return {"Addresses": self._leftovers(region)["addresses"]}
+
+    def _ec2_DescribeNatGateways(self, region, params):
+        gateways = self._leftovers(region)["nat_gateways"]
+        for f in params.get("Filter", []):
+            if f["Name"] != "state":
+                raise NotImplementedError("FakeAWS does not implement filter {}".format(f["Name"]))
+            gateways = [n for n in gateways if n["State"] in f["Values"]]
+        return {"NatGateways": gateways}
+
+    def _ec2_DescribeSnapshots(self, region, params):
+        return {"Snapshots": self._leftovers(region)["snapshots"]}
+
+    def _ec2_DescribeImages(self, region, params):
+        return {"Images": self._leftovers(region)["images"]}
+
+    def _elbv2_DescribeLoadBalancers(self, region, params):
+        return {"LoadBalancers": [{k: v for k, v in lb.items() if k != "Tags"} for lb in self._leftovers(region)["load_balancers"]]}
+
+    def _elbv2_DescribeTags(self, region, params):
+        arns = params["ResourceArns"]
+        if len(arns) > 20:
+            return {"Error": {"Code": "ValidationError", "Message": "at most 20 resource ARNs per call"}}
+        by_arn = {lb["LoadBalancerArn"]: lb["Tags"] for lb in self._leftovers(region)["load_balancers"]}
+        return {"TagDescriptions": [{"ResourceArn": arn, "Tags": by_arn[arn]} for arn in arns if arn in by_arn]}
+
+    def _elb_DescribeLoadBalancers(self, region, params):
+        return {"LoadBalancerDescriptions": [{"LoadBalancerName": lb["LoadBalancerName"]}
+                                             for lb in self._leftovers(region)["classic_load_balancers"]]}
+
+    def _elb_DescribeTags(self, region, params):
+        names = params["LoadBalancerNames"]
+        if len(names) > 20:
+            return {"Error": {"Code": "ValidationError", "Message": "at most 20 load balancer names per call"}}
+        by_name = {lb["LoadBalancerName"]: lb["Tags"] for lb in self._leftovers(region)["classic_load_balancers"]}
+        return {"TagDescriptions": [{"LoadBalancerName": name, "Tags": by_name[name]} for name in names if name in by_name]}
+
+    def _ec2_DescribeRegions(self, region, params):
+        return {"Regions": [{"RegionName": r, "Endpoint": "ec2.{}.amazonaws.com".format(r)} for r in self.regions]}
+
+    def _ses_SendEmail(self, region, params):
+        with self.lock:
+            self.emails.append(params["Message"]["Body"]["Text"]["Data"].encode())
+        return {"MessageId": str(len(self.emails))}
+
+    def _ses_SendRawEmail(self, region, params):
+        with self.lock:
+            self.emails.append(params["RawMessage"]["Data"])
+        return {"MessageId": str(len(self.emails))}
+
+    def _s3_GetObject(self, region, params):
+        data = self.objects.get((params["Bucket"], params["Key"]))
+        if data is None:
+            raise KeyError("NoSuchKey")
+        return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+    def _s3_PutObject(self, region, params):
+        body = params["Body"]
+        self.objects[(params["Bucket"], params["Key"])] = body if isinstance(body, bytes) else body.read()
+        return {"ETag": '"fake"'}
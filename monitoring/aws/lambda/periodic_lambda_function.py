@@ -1,82 +1,1056 @@
 #!/usr/bin/env python3
 
 import boto3
+import csv
+import fnmatch
+import functools
+import gzip
+import html
 import json
 import io
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+
+from botocore.config import Config
+
+# How many (region, collector) scans run at once, unless the event says otherwise.
+# They spend nearly all their time waiting on AWS, so this can be well above
+# the number of CPUs.
+DEFAULT_CONCURRENCY = 64
+# Seconds a single (region, collector) scan may take before it is reported as timed out
+DEFAULT_REGION_TIMEOUT = 20
+# Seconds of the Lambda's remaining time held back to build and send the report
+REPORT_RESERVE_SECONDS = 5
+# Instances requested per describe_instances page (EC2 allows 5-1000)
+DESCRIBE_PAGE_SIZE = 1000
+# The parts of each instance description the report keeps
+INSTANCE_FIELDS = ("InstanceId", "InstanceType", "LaunchTime", "Tags")
+# An instance seen in this many consecutive runs is flagged as long-running
+DEFAULT_LONG_RUNNING_RUNS = 5
+# A region that came back empty this many runs in a row is only rescanned...
+DEFAULT_SKIP_EMPTY_AFTER_RUNS = 3
+# ...once this many hours have passed since its last scan
+DEFAULT_EMPTY_RESCAN_HOURS = 24
+# Bumped whenever the snapshot layout changes; older snapshots are migrated or ignored
+SNAPSHOT_VERSION = 2
+# How long a discovered region list is trusted when "regions" is "auto"
+DEFAULT_REGION_CACHE_HOURS = 24
+# A region that fails is left alone for this long, doubling with each further
+# failure up to the maximum
+DEFAULT_REGION_BACKOFF_HOURS = 1
+MAX_REGION_BACKOFF_HOURS = 24 * 7
+
+# Which resources are reported when the event has no "rules"
+DEFAULT_RULES = {"exclude": [{"key": "Name", "prefix": "team-czcpt"}]}
+# A rule regex starting with global inline flags, such as "(?i)"
+GLOBAL_FLAGS_RE = re.compile(r"\(\?[aiLmsux]+\)")
+
+REPORT_SUBJECT = "Hive running resources report"
+# Report size limits; the event's "report" section can override any of them
+DEFAULT_REPORT_LIMITS = {
+    # Resource names listed per region and collector in the email body
+    "summary_names": 25,
+    # Cap on the email body; regions past it are only in the attachments
+    "max_body_bytes": 64 * 1024,
+    # Attachment bytes per email, before base64. SES rejects raw messages over 10MB.
+    "max_attachment_bytes": 4 * 1024 * 1024,
+    # Emails per report; rows beyond what fits are dropped
+    "max_messages": 4,
+    # Detail attachment formats, from ATTACHMENT_FORMATS
+    "attachments": ["csv", "html"],
+}
+# Attachments are kept in memory up to this size, then spilled to /tmp
+SPOOL_BYTES = 1024 * 1024
+
+# CloudWatch namespace for the metrics the handler emits
+METRICS_NAMESPACE = "HiveMonitoring/PeriodicReport"
+# Where Metrics.flush() writes EMF lines. In Lambda, stdout goes to CloudWatch
+# Logs, which extracts the metrics; replace with e.g. a list's append to capture them.
+METRICS_SINK = print
+
+# Settings for every AWS client. Each region's EC2 client is shared by that
+# region's EC2 collectors, which may all be running at once. The timeouts stop
+# one stuck connection from using up a scan's whole budget, and "standard"
+# retries back off from throttling with jitter.
+CLIENT_CONFIG = Config(
+    max_pool_connections=10,
+    connect_timeout=5,
+    read_timeout=15,
+    retries={"mode": "standard", "max_attempts": 3},
+)
+
+# Clients by (service, region), shared by the scan threads and kept across warm
+# invocations; see get_client().
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+# Resource collectors by name, in report order; see collector()
+COLLECTORS = {}
+# ARNs or names per Elastic Load Balancing describe_tags call
+ELB_TAGS_BATCH = 20
+
+# Region discovery results and failure history for "auto" mode. Survives warm
+# invocations; also persisted in the snapshot as "region_state".
+REGION_STATE = {}
 
 def lambda_handler(event, context):
 
     print(event)
-    running_instances = {}
+    handler_start = time.monotonic()
+    metrics = Metrics(sink=METRICS_SINK)
+    rules = TagRules(event.get("rules", DEFAULT_RULES))
 
-    for region in event["regions"]:
-        ec2client = boto3.client('ec2', region)
+    deadline = None
+    if hasattr(context, "get_remaining_time_in_millis"):
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000.0 - REPORT_RESERVE_SECONDS
 
-        try:
-            response = ec2client.describe_instances()
-        except Exception as e:
-            print("Error fetching instances from region " + region)
-            print(e)
-            continue
-        
-        running_instances[region] = []
+    now = time.time()
+    store = get_snapshot_store(event.get("snapshot"))
+    previous = load_snapshot(store)
+
+    region_state = None
+    if event["regions"] == "auto":
+        region_state = get_region_state(previous)
+        regions = discover_regions(
+            region_state,
+            now,
+            ttl_seconds=event.get("region_cache_hours", DEFAULT_REGION_CACHE_HOURS) * 3600,
+            api_region=event["emailregion"],
+        )
+        regions, backed_off = back_off_failed_regions(regions, region_state, now)
+    else:
+        regions, backed_off = event["regions"], {}
+
+    regions, skipped = regions_to_scan(
+        regions,
+        previous,
+        now,
+        skip_empty_after_runs=event.get("skip_empty_after_runs", DEFAULT_SKIP_EMPTY_AFTER_RUNS),
+        rescan_seconds=event.get("empty_rescan_hours", DEFAULT_EMPTY_RESCAN_HOURS) * 3600,
+    )
+    skipped.update(backed_off)
+    for region, reason in skipped.items():
+        print("Skipping region {}: {}".format(region, reason))
+
+    collectors = event.get("collectors", list(COLLECTORS))
+    unknown = set(collectors) - set(COLLECTORS)
+    if unknown:
+        raise ValueError("unknown collectors: {}".format(", ".join(sorted(unknown))))
+
+    # Every (region, collector) pair shares one pool, so the scan takes about as
+    # long as its slowest call rather than growing with the number of collectors.
+    results, scan_errors = scan_tasks(
+        [(region, name) for region in regions for name in collectors],
+        functools.partial(run_collector, rules=rules, metrics=metrics),
+        concurrency=event.get("concurrency", DEFAULT_CONCURRENCY),
+        task_timeout=event.get("region_timeout", DEFAULT_REGION_TIMEOUT),
+        deadline=deadline,
+    )
+    found = {}
+    for (region, name), rows in results.items():
+        found.setdefault(region, {})[name] = rows
+    # A region failed when none of its collectors got through
+    failed_regions = {region: reason for (region, _), reason in scan_errors.items() if region not in found}
+
+    for (region, name), reason in scan_errors.items():
+        print("Error collecting {} from region {}: {}".format(name, region, reason))
+        metrics.add("RegionErrors", 1, Region=region)
+    metrics.put("RegionsScanned", len(found))
+    metrics.put("RegionsFailed", len(failed_regions))
+    metrics.put("RegionsSkipped", len(skipped))
+    metrics.put("ScansFailed", len(scan_errors))
+
+    snapshot, changes = update_snapshot(
+        previous,
+        found,
+        now,
+        long_running_runs=event.get("long_running_runs", DEFAULT_LONG_RUNNING_RUNS),
+    )
+    if region_state is not None:
+        record_region_failures(
+            region_state,
+            found,
+            failed_regions,
+            now,
+            backoff_seconds=event.get("region_backoff_hours", DEFAULT_REGION_BACKOFF_HOURS) * 3600,
+        )
+        snapshot["region_state"] = region_state
 
-        for resp in response["Reservations"]:
-            for instance in resp["Instances"]:
-                if instance["State"]["Name"] == "running":
-                    for tag in instance["Tags"]:
-                        if tag["Key"] == "Name":
-                            if tag["Value"].startswith("team-czcpt"):
-                                break
-                            running_instances[region].append(tag["Value"])
+    with metrics.timer("ReportBuildLatency"):
+        report = render_report(
+            ((region, resources, changes.get(region, {})) for region, resources in found.items()),
+            scan_errors,
+            skipped,
+            limits=event.get("report"),
+            pointer=store.location if store is not None else None,
+        )
+    metrics.put("ReportMessages", max(1, len(report.parts)))
+    metrics.put("ReportRowsTruncated", report.truncated_rows)
 
-        running_instances[region].sort()
+    with metrics.timer("SendEmailLatency"):
+        sent = send_report(report, event["recipients"], event["fromemail"], event["emailregion"])
+    metrics.put("ReportBytes", sent, "Bytes")
 
-    instances_formatted = build_instance_email_text(running_instances)
+    if store is not None:
+        store.save(snapshot)
 
-    send_email(event["recipients"], event["fromemail"], instances_formatted, event["emailregion"])
+    metrics.put("HandlerDuration", (time.monotonic() - handler_start) * 1000, "Milliseconds")
+    metrics.flush()
 
     return {
         'statusCode': 200,
         'body': json.dumps('Lambda complete!')
     }
 
-def build_instance_email_text(instances):
+def get_client(service, region):
+    """Return the client for service in region, creating it on first use.
+
+    Building a client costs ~10ms even once its service model is loaded, so
+    reusing them saves a few hundred ms per warm invocation. Clients are
+    thread-safe once built, but building them from one session isn't, hence the lock.
+    """
+    key = (service, region)
+    client = CLIENTS.get(key)
+    if client is None:
+        with CLIENTS_LOCK:
+            client = CLIENTS.get(key)
+            if client is None:
+                client = CLIENTS[key] = boto3.client(service, region, config=CLIENT_CONFIG)
+    return client
+
+class Metrics:
+    """Collects metrics and writes them as CloudWatch Embedded Metric Format lines.
+
+    Values are grouped by their dimensions (keyword arguments, e.g. Region=...);
+    flush() writes one JSON line per group to sink. Safe to use from the scan
+    threads.
+    """
+    def __init__(self, namespace=METRICS_NAMESPACE, sink=print):
+        self.namespace = namespace
+        self.sink = sink
+        self.lock = threading.Lock()
+        # {sorted dimension items: {metric name: [unit, [values]]}}
+        self.groups = {}
+
+    def put(self, name, value, unit="Count", **dimensions):
+        """Record one sample of a metric."""
+        with self.lock:
+            group = self.groups.setdefault(tuple(sorted(dimensions.items())), {})
+            group.setdefault(name, [unit, []])[1].append(value)
+
+    def add(self, name, value, unit="Count", **dimensions):
+        """Add to a metric that is reported as a single running total."""
+        with self.lock:
+            group = self.groups.setdefault(tuple(sorted(dimensions.items())), {})
+            entry = group.setdefault(name, [unit, [0]])
+            entry[1][0] += value
+
+    @contextmanager
+    def timer(self, name, **dimensions):
+        """Record how long the with-block took, in milliseconds."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.put(name, (time.monotonic() - start) * 1000, "Milliseconds", **dimensions)
+
+    def flush(self):
+        with self.lock:
+            groups, self.groups = self.groups, {}
+        timestamp = int(time.time() * 1000)
+        for dimensions, group in groups.items():
+            line = {
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{
+                        "Namespace": self.namespace,
+                        "Dimensions": [[key for key, _ in dimensions]],
+                        "Metrics": [{"Name": name, "Unit": unit} for name, (unit, _) in group.items()],
+                    }],
+                },
+            }
+            line.update(dimensions)
+            for name, (_, values) in group.items():
+                # EMF takes either a single value or a list of up to 100 samples
+                line[name] = values[0] if len(values) == 1 else values[:100]
+            self.sink(json.dumps(line))
+
+def scan_tasks(tasks, scan, concurrency=DEFAULT_CONCURRENCY, task_timeout=DEFAULT_REGION_TIMEOUT, deadline=None):
+    """Run scan(task) for every task (e.g. a region, or a (region, collector) pair) on a bounded thread pool.
+
+    Returns (results, errors). results maps each task that finished to what
+    scan returned, in the order the tasks were given. errors maps each task
+    that raised, exceeded task_timeout, or was still outstanding at deadline
+    (a time.monotonic() value) to a short reason. A task's clock starts when a
+    worker picks it up, so queued tasks are not charged for waiting.
+    """
+    results = {}
+    errors = {}
+    started = {}
+
+    def run(task):
+        started[task] = time.monotonic()
+        return scan(task)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(tasks))))
+    pending = {executor.submit(run, task): task for task in tasks}
+    try:
+        while pending:
+            now = time.monotonic()
+            limits = [started[t] + task_timeout for t in pending.values() if t in started]
+            if deadline is not None:
+                limits.append(deadline)
+            timeout = max(0, min(limits) - now) if limits else task_timeout
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                task = pending.pop(future)
+                try:
+                    results[task] = future.result()
+                except Exception as e:
+                    errors[task] = "error: {}".format(e)
+
+            now = time.monotonic()
+            out_of_time = deadline is not None and now >= deadline
+            for future, task in list(pending.items()):
+                if task in started and now - started[task] >= task_timeout:
+                    errors[task] = "timed out after {}s".format(task_timeout)
+                elif out_of_time:
+                    errors[task] = "timed out" if task in started else "not scanned: out of time"
+                else:
+                    continue
+                # Running scans can't be interrupted; their results are just dropped.
+                future.cancel()
+                del pending[future]
+    finally:
+        executor.shutdown(wait=False)
+
+    ordered = {task: results[task] for task in tasks if task in results}
+    return ordered, {task: errors[task] for task in tasks if task in errors}
+
+def collector(name, label):
+    """Register fn(region, rules, metrics=None) as the collector for one kind of resource.
+
+    A collector returns a sorted list of (group, name, resource ID) for the
+    resources in region that rules let through; see resource_rows(). label
+    heads the collector's section of the report.
+    """
+    def register(fn):
+        COLLECTORS[name] = {"label": label, "collect": fn}
+        return fn
+    return register
+
+def run_collector(task, rules, metrics=None):
+    """Run the collector for a (region, collector name) task."""
+    region, name = task
+    start = time.monotonic()
+    rows = COLLECTORS[name]["collect"](region, rules, metrics=metrics)
+    if metrics:
+        metrics.put("ResourcesMatched", len(rows), Collector=name)
+        metrics.put("CollectorLatency", (time.monotonic() - start) * 1000, "Milliseconds", Collector=name)
+    return rows
+
+def row_key(row):
+    return (row[0] or "", row[1], row[2])
+
+def resource_rows(resources, rules):
+    """Return the sorted (group, name, ID) rows for the resources rules let through.
+
+    resources yields (ID, default name, AWS tag list) for each resource. Unlike
+    instances, these are reported without a Name tag, under the default name.
+    """
+    rows = []
+    for resource_id, default_name, tag_list in resources:
+        tags = {tag["Key"]: tag["Value"] for tag in tag_list or ()}
+        tags.setdefault("Name", default_name)
+        if rules.matches(tags):
+            rows.append((rules.group(tags), tags["Name"], resource_id))
+    rows.sort(key=row_key)
+    return rows
+
+def iter_running_instances(ec2client, page_size=DESCRIBE_PAGE_SIZE, metrics=None):
+    """Generator for the running, Name-tagged instances visible to ec2client.
+
+    Follows NextToken via the describe_instances paginator and lets EC2 do the
+    state and tag filtering. Each instance is yielded as soon as its page
+    arrives, trimmed to the fields in INSTANCE_FIELDS. With metrics, records
+    per-page latency, pages fetched and instances scanned for the region.
+    """
+    region = ec2client.meta.region_name
+    paginator = ec2client.get_paginator('describe_instances')
+    pages = paginator.paginate(
+        Filters=[
+            {'Name': 'instance-state-name', 'Values': ['running']},
+            {'Name': 'tag-key', 'Values': ['Name']},
+        ],
+        PaginationConfig={'PageSize': page_size},
+    )
+    page_start = time.monotonic()
+    for page in pages:
+        if metrics:
+            metrics.put("DescribePageLatency", (time.monotonic() - page_start) * 1000, "Milliseconds", Region=region)
+            metrics.add("PagesFetched", 1, Region=region)
+        for reservation in page.get("Reservations", []):
+            if metrics:
+                metrics.add("InstancesScanned", len(reservation.get("Instances", [])), Region=region)
+            for instance in reservation.get("Instances", []):
+                yield {field: instance[field] for field in INSTANCE_FIELDS if field in instance}
+        page_start = time.monotonic()
+
+class TagRules:
+    """Decides which resources are reported, and how they are grouped, from their tags.
+
+    config looks like:
+        {"include": [RULE, ...], "exclude": [RULE, ...], "group_by": TAG_KEY}
+    where each RULE is {"key": TAG_KEY} plus one of "prefix", "glob" or "regex"
+    (matched from the start of the tag's value), and optionally "flags", a
+    string of regex flag letters from "imsx" (e.g. "i" to ignore case) that
+    applies to that rule alone. A resource is reported when
+    it has a Name tag, matches at least one include rule (if there are any),
+    and matches no exclude rule. A rule never matches a resource without its
+    key.
+
+    All rules on the same tag key are compiled into one alternation regex, so
+    each resource costs one match per distinct key, however many rules there are.
+    A regex with capturing groups is matched on its own instead, since joining
+    it with others would clash its group names and renumber its backreferences.
+    """
+    def __init__(self, config):
+        unknown = set(config) - {"include", "exclude", "group_by"}
+        if unknown:
+            raise ValueError("unknown keys in rules: {}".format(", ".join(sorted(unknown))))
+        self.include = self._compile(config.get("include", []))
+        self.exclude = self._compile(config.get("exclude", []))
+        self.group_by = config.get("group_by")
+
+    @staticmethod
+    def _compile(rules):
+        # {tag key: [patterns to join]}, and (key, pattern) for those matched alone
+        patterns = {}
+        alone = []
+        for rule in rules:
+            if "prefix" in rule:
+                pattern = re.escape(rule["prefix"])
+            elif "glob" in rule:
+                pattern = fnmatch.translate(rule["glob"])
+            elif "regex" in rule:
+                pattern = rule["regex"]
+                # Flags like (?i) apply to the whole expression, so they can't
+                # survive being joined with other rules.
+                if GLOBAL_FLAGS_RE.match(pattern):
+                    raise ValueError('rule regex can\'t start with inline flags, use "flags" instead: {}'.format(rule))
+            else:
+                raise ValueError("rule needs one of prefix, glob or regex: {}".format(rule))
+            # Compiled alone first, so a bad rule is reported as itself
+            try:
+                groups = re.compile(pattern).groups
+            except re.error as e:
+                raise ValueError("bad regex in rule {}: {}".format(rule, e))
+            flags = rule.get("flags", "")
+            if set(flags) - set("imsx"):
+                raise ValueError('rule "flags" may only contain i, m, s and x: {}'.format(rule))
+            pattern = "(?{}:{})".format(flags, pattern)
+            if groups:
+                alone.append((rule["key"], pattern))
+            else:
+                patterns.setdefault(rule["key"], []).append(pattern)
+        compiled = []
+        for key, pattern in [(key, "|".join(alternatives)) for key, alternatives in patterns.items()] + alone:
+            try:
+                compiled.append((key, re.compile(pattern)))
+            except re.error as e:
+                raise ValueError("bad regex in rules for tag {}: {}".format(key, e))
+        return compiled
+
+    @staticmethod
+    def _any_match(compiled, tags):
+        for key, regex in compiled:
+            value = tags.get(key)
+            if value is not None and regex.match(value):
+                return True
+        return False
+
+    def matches(self, tags):
+        """Return whether an instance with these tags ({key: value}) is reported."""
+        if "Name" not in tags:
+            return False
+        if self.include and not self._any_match(self.include, tags):
+            return False
+        return not self._any_match(self.exclude, tags)
+
+    def group(self, tags):
+        """Return the instance's group label, or None when not grouping."""
+        if not self.group_by:
+            return None
+        return tags.get(self.group_by, "(no {})".format(self.group_by))
+
+@collector("instances", "Running instances")
+def get_running_instances(region, rules, metrics=None):
+    """Return a sorted list of (group, name, instance ID) for the region's reported instances.
+
+    group is None unless rules group instances by a tag.
+    """
+    start = time.monotonic()
+    ec2client = get_client('ec2', region)
+
+    instances = []
+    for instance in iter_running_instances(ec2client, metrics=metrics):
+        tags = {tag["Key"]: tag["Value"] for tag in instance.get("Tags", ())}
+        if rules.matches(tags):
+            instances.append((rules.group(tags), tags["Name"], instance["InstanceId"]))
+
+    instances.sort(key=row_key)
+    if metrics:
+        metrics.put("InstancesMatched", len(instances), Region=region)
+        metrics.put("RegionScanLatency", (time.monotonic() - start) * 1000, "Milliseconds", Region=region)
+    return instances
+
+@collector("volumes", "Unattached volumes")
+def get_unattached_volumes(region, rules, metrics=None):
+    ec2client = get_client('ec2', region)
+    pages = ec2client.get_paginator('describe_volumes').paginate(
+        Filters=[{'Name': 'status', 'Values': ['available']}],
+    )
+    return resource_rows(
+        ((v["VolumeId"], v["VolumeId"], v.get("Tags")) for page in pages for v in page["Volumes"]),
+        rules,
+    )
+
+@collector("addresses", "Unassociated Elastic IPs")
+def get_unassociated_addresses(region, rules, metrics=None):
+    ec2client = get_client('ec2', region)
+    addresses = ec2client.describe_addresses()["Addresses"]
+    return resource_rows(
+        ((a.get("AllocationId", a["PublicIp"]), a["PublicIp"], a.get("Tags"))
+         for a in addresses if "AssociationId" not in a),
+        rules,
+    )
+
+@collector("nat_gateways", "NAT gateways")
+def get_nat_gateways(region, rules, metrics=None):
+    ec2client = get_client('ec2', region)
+    # Unlike the other describe calls, this one's parameter is "Filter"
+    pages = ec2client.get_paginator('describe_nat_gateways').paginate(
+        Filter=[{'Name': 'state', 'Values': ['pending', 'available']}],
+    )
+    return resource_rows(
+        ((n["NatGatewayId"], n["NatGatewayId"], n.get("Tags")) for page in pages for n in page["NatGateways"]),
+        rules,
+    )
+
+def get_elb_tags(elbclient, keyword, ids):
+    """Return {ID: tag list} for the load balancers ids (names or ARNs, as keyword says), in batches."""
+    tags = {}
+    id_field = "ResourceArn" if keyword == "ResourceArns" else "LoadBalancerName"
+    for i in range(0, len(ids), ELB_TAGS_BATCH):
+        response = elbclient.describe_tags(**{keyword: ids[i:i + ELB_TAGS_BATCH]})
+        for description in response["TagDescriptions"]:
+            tags[description[id_field]] = description.get("Tags", [])
+    return tags
+
+@collector("load_balancers", "Load balancers")
+def get_load_balancers(region, rules, metrics=None):
+    """Application, network and gateway load balancers, identified by the tail of their ARN."""
+    elbclient = get_client('elbv2', region)
+    balancers = [lb for page in elbclient.get_paginator('describe_load_balancers').paginate()
+                 for lb in page["LoadBalancers"]]
+    tags = get_elb_tags(elbclient, "ResourceArns", [lb["LoadBalancerArn"] for lb in balancers])
+    return resource_rows(
+        ((lb["LoadBalancerArn"].split(":loadbalancer/")[-1], lb["LoadBalancerName"], tags.get(lb["LoadBalancerArn"]))
+         for lb in balancers),
+        rules,
+    )
+
+@collector("classic_load_balancers", "Classic load balancers")
+def get_classic_load_balancers(region, rules, metrics=None):
+    elbclient = get_client('elb', region)
+    balancers = [lb for page in elbclient.get_paginator('describe_load_balancers').paginate()
+                 for lb in page["LoadBalancerDescriptions"]]
+    tags = get_elb_tags(elbclient, "LoadBalancerNames", [lb["LoadBalancerName"] for lb in balancers])
+    return resource_rows(
+        ((lb["LoadBalancerName"], lb["LoadBalancerName"], tags.get(lb["LoadBalancerName"])) for lb in balancers),
+        rules,
+    )
+
+@collector("snapshots", "Orphaned snapshots")
+def get_orphaned_snapshots(region, rules, metrics=None):
+    """The account's snapshots whose volume is gone and that none of its AMIs use."""
+    ec2client = get_client('ec2', region)
+    volumes = {v["VolumeId"] for page in ec2client.get_paginator('describe_volumes').paginate()
+               for v in page["Volumes"]}
+    in_use = set()
+    for image in ec2client.describe_images(Owners=['self'])["Images"]:
+        for mapping in image.get("BlockDeviceMappings", []):
+            if "SnapshotId" in mapping.get("Ebs", {}):
+                in_use.add(mapping["Ebs"]["SnapshotId"])
+    pages = ec2client.get_paginator('describe_snapshots').paginate(OwnerIds=['self'])
+    return resource_rows(
+        ((s["SnapshotId"], s["SnapshotId"], s.get("Tags")) for page in pages for s in page["Snapshots"]
+         if s.get("VolumeId") not in volumes and s["SnapshotId"] not in in_use),
+        rules,
+    )
+
+class SnapshotStore:
+    """Where the previous run's snapshot lives. Backends implement read() and write()."""
+    def read(self):
+        """Return the stored bytes, or None if nothing has been stored yet."""
+        raise NotImplementedError
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def save(self, snapshot):
+        self.write(encode_snapshot(snapshot))
+
+class LocalSnapshotStore(SnapshotStore):
+    """Keeps the snapshot in a gzipped JSON file, e.g. for running offline."""
+    def __init__(self, path):
+        self.path = path
+        self.location = path
+
+    def read(self):
+        try:
+            with open(self.path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, data):
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+class S3SnapshotStore(SnapshotStore):
+    """Keeps the snapshot as a gzipped JSON object in S3."""
+    def __init__(self, bucket, key, region=None):
+        self.bucket = bucket
+        self.key = key
+        self.region = region
+        self.location = "s3://{}/{}".format(bucket, key)
+
+    def read(self):
+        s3client = get_client('s3', self.region)
+        try:
+            return s3client.get_object(Bucket=self.bucket, Key=self.key)["Body"].read()
+        except s3client.exceptions.NoSuchKey:
+            return None
+
+    def write(self, data):
+        s3client = get_client('s3', self.region)
+        s3client.put_object(Bucket=self.bucket, Key=self.key, Body=data, ContentType="application/gzip")
+
+def get_snapshot_store(config):
+    """Build the snapshot store described by the event's "snapshot" section, if any.
+
+    {"path": FILE} selects LocalSnapshotStore; {"bucket": B, "key": K[, "region": R]}
+    selects S3SnapshotStore.
+    """
+    if not config:
+        return None
+    if "path" in config:
+        return LocalSnapshotStore(config["path"])
+    if "bucket" in config:
+        return S3SnapshotStore(config["bucket"], config.get("key", "snapshot.json.gz"), config.get("region"))
+    raise ValueError("snapshot config needs either 'path' or 'bucket': {}".format(config))
+
+def encode_snapshot(snapshot):
+    return gzip.compress(json.dumps(snapshot, separators=(",", ":")).encode())
+
+def load_snapshot(store):
+    """Return the previous run's snapshot, or None if there isn't a usable one.
+
+    A snapshot looks like:
+        {"version": 2, "run": N, "time": EPOCH,
+         "regions": {REGION: {"scanned": EPOCH, "empty_runs": N,
+                              "resources": {COLLECTOR: {ID: [NAME, RUNS_SEEN]}}}}}
+    """
+    if store is None:
+        return None
+    try:
+        data = store.read()
+        if data is None:
+            return None
+        snapshot = json.loads(gzip.decompress(data))
+    except Exception as e:
+        print("Error loading snapshot, reporting without history: {}".format(e))
+        return None
+    if snapshot.get("version") == 1:
+        # Version 1 only tracked instances
+        for entry in snapshot["regions"].values():
+            entry["resources"] = {"instances": entry.pop("instances")}
+        snapshot["version"] = SNAPSHOT_VERSION
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        print("Ignoring snapshot with version {}".format(snapshot.get("version")))
+        return None
+    return snapshot
+
+def regions_to_scan(regions, previous, now, skip_empty_after_runs, rescan_seconds):
+    """Split regions into (to_scan, skipped), where skipped maps region to reason.
+
+    A region is skipped when it has been empty for skip_empty_after_runs runs in
+    a row and was last scanned less than rescan_seconds ago.
+    """
+    prev_regions = previous["regions"] if previous else {}
+    to_scan = []
+    skipped = {}
+    for region in regions:
+        entry = prev_regions.get(region)
+        if (entry and entry["empty_runs"] >= skip_empty_after_runs
+                and now - entry["scanned"] < rescan_seconds):
+            skipped[region] = "empty for the last {} runs".format(entry["empty_runs"])
+        else:
+            to_scan.append(region)
+    return to_scan, skipped
+
+def get_region_state(previous):
+    """Return the freshest region state: this container's, or the snapshot's.
+
+    Region state looks like:
+        {"updated": EPOCH, "regions": [REGION, ...], "expires": EPOCH,
+         "failures": {REGION: [CONSECUTIVE_FAILURES, RETRY_AFTER_EPOCH]}}
+    """
+    global REGION_STATE
+    stored = previous.get("region_state") if previous else None
+    if stored and stored.get("updated", 0) > REGION_STATE.get("updated", 0):
+        REGION_STATE = stored
+    return REGION_STATE
+
+def discover_regions(state, now, ttl_seconds, api_region):
+    """Return the enabled regions, asking EC2 only when the cached list in state has expired.
+
+    If discovery fails, a stale cached list is used rather than failing the run.
+    """
+    if state.get("regions") and now < state.get("expires", 0):
+        return state["regions"]
+
+    ec2client = get_client('ec2', api_region)
+    try:
+        # Without AllRegions, only regions enabled for the account are returned.
+        response = ec2client.describe_regions()
+    except Exception as e:
+        if not state.get("regions"):
+            raise
+        print("Error discovering regions, using the cached list: {}".format(e))
+        return state["regions"]
+
+    state["regions"] = sorted(r["RegionName"] for r in response["Regions"])
+    state["expires"] = now + ttl_seconds
+    state["updated"] = now
+    print("Discovered regions: {}".format(", ".join(state["regions"])))
+    return state["regions"]
+
+def back_off_failed_regions(regions, state, now):
+    """Split regions into (to_scan, skipped), skipping those still backing off after failures."""
+    failures = state.get("failures", {})
+    to_scan = []
+    skipped = {}
+    for region in regions:
+        if region in failures and now < failures[region][1]:
+            skipped[region] = "failed {} runs in a row, retrying after {}".format(
+                failures[region][0], time.strftime("%Y-%m-%d %H:%M UTC", time.gmtime(failures[region][1])))
+        else:
+            to_scan.append(region)
+    return to_scan, skipped
+
+def record_region_failures(state, scanned, errors, now, backoff_seconds):
+    """Update the failure history in state after a scan."""
+    failures = state.setdefault("failures", {})
+    for region in scanned:
+        failures.pop(region, None)
+    for region in errors:
+        count = failures.get(region, [0, 0])[0] + 1
+        delay = min(backoff_seconds * 2 ** (count - 1), MAX_REGION_BACKOFF_HOURS * 3600)
+        failures[region] = [count, now + delay]
+    state["updated"] = now
+
+def update_snapshot(previous, found, now, long_running_runs=DEFAULT_LONG_RUNNING_RUNS):
+    """Fold this run's resources ({region: {collector: rows}}) into the previous snapshot.
+
+    Returns (snapshot, changes). changes maps each scanned region to
+    {collector: {"new": set of IDs, "long_running": {ID: runs seen},
+    "gone": sorted names}}. Regions that weren't scanned this time (skipped or
+    failed) keep their previous entry untouched, as do collectors that failed
+    in a region that was otherwise scanned. Nothing is reported as new with no
+    previous snapshot, nor by a collector the region's entry has no history for.
+    """
+    prev_regions = previous["regions"] if previous else {}
+    regions = {region: entry for region, entry in prev_regions.items() if region not in found}
+    changes = {}
+
+    for region, resources in found.items():
+        prev_entry = prev_regions.get(region, {})
+        prev_resources = prev_entry.get("resources", {})
+        current_resources = {name: items for name, items in prev_resources.items() if name not in resources}
+        changes[region] = {}
+        for collector_name, rows in resources.items():
+            before = prev_resources.get(collector_name, {})
+            known = previous and (collector_name in prev_resources or not prev_entry)
+            current = {}
+            new = set()
+            long_running = {}
+            for _, name, resource_id in rows:
+                seen = before[resource_id][1] + 1 if resource_id in before else 1
+                current[resource_id] = [name, seen]
+                if known and resource_id not in before:
+                    new.add(resource_id)
+                if seen >= long_running_runs:
+                    long_running[resource_id] = seen
+            gone = sorted(entry[0] for resource_id, entry in before.items() if resource_id not in current)
+            current_resources[collector_name] = current
+            changes[region][collector_name] = {"new": new, "long_running": long_running, "gone": gone}
+
+        regions[region] = {
+            "scanned": now,
+            "empty_runs": 0 if any(current_resources.values()) else prev_entry.get("empty_runs", 0) + 1,
+            "resources": current_resources,
+        }
+
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "run": (previous["run"] if previous else 0) + 1,
+        "time": now,
+        "regions": regions,
+    }
+    return snapshot, changes
+
+class ReportPart:
+    """One email's worth of detail attachments, spooled to disk once they get big."""
+    def __init__(self, formats):
+        self.files = {fmt: tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) for fmt in formats}
+        self.size = 0
+        self.rows = 0
+        for fmt in formats:
+            self._write(fmt, ATTACHMENT_FORMATS[fmt]["header"])
+
+    def _write(self, fmt, text):
+        data = text.encode()
+        self.files[fmt].write(data)
+        self.size += len(data)
+
+    def row_size(self, fields):
+        return sum(len(ATTACHMENT_FORMATS[fmt]["row"](fields).encode()) for fmt in self.files)
+
+    def add_row(self, fields):
+        for fmt in self.files:
+            self._write(fmt, ATTACHMENT_FORMATS[fmt]["row"](fields))
+        self.rows += 1
+
+    def finish(self):
+        for fmt in self.files:
+            self._write(fmt, ATTACHMENT_FORMATS[fmt]["footer"])
+
+def _csv_row(fields):
     buf = io.StringIO()
+    csv.writer(buf).writerow(fields)
+    return buf.getvalue()
+
+def _html_row(fields):
+    return "<tr>{}</tr>\n".format("".join("<td>{}</td>".format(html.escape(str(f))) for f in fields))
+
+REPORT_COLUMNS = ("region", "resource", "group", "name", "id", "status")
 
-    for region in instances.keys():
-        if len(instances[region]) == 0:
+# How each detail attachment format is laid out
+ATTACHMENT_FORMATS = {
+    "csv": {
+        "mimetype": ("text", "csv"),
+        "header": _csv_row(REPORT_COLUMNS),
+        "row": _csv_row,
+        "footer": "",
+    },
+    "html": {
+        "mimetype": ("text", "html"),
+        "header": "<html><body><table border=\"1\">\n<tr>{}</tr>\n".format("".join("<th>{}</th>".format(c) for c in REPORT_COLUMNS)),
+        "row": _html_row,
+        "footer": "</table></body></html>\n",
+    },
+}
+
+class Report:
+    """The rendered report: a bounded summary body plus detail attachments split into parts.
+
+    Each part becomes one email. truncated_rows counts detail rows dropped
+    because max_messages parts were already full.
+    """
+    def __init__(self, summary, parts, truncated_rows):
+        self.summary = summary
+        self.parts = parts
+        self.truncated_rows = truncated_rows
+
+def render_report(region_results, errors=None, skipped=None, limits=None, pointer=None):
+    """Render the report from an iterable of (region, resources, changes) tuples.
+
+    resources maps collector name to the sorted (group, name, ID) rows it found
+    in the region, and changes is the region's entry from update_snapshot()
+    (may be empty). errors maps (region, collector name) to why that scan is
+    missing. Regions are consumed one at a time. The summary lists at most
+    summary_names names per region and collector and stops growing at
+    max_body_bytes. Every resource goes into the detail attachments, which
+    start a new part (email) once a part reaches max_attachment_bytes. After
+    max_messages parts, further rows are dropped, and the summary says so and
+    points at pointer, if given.
+    """
+    limits = dict(DEFAULT_REPORT_LIMITS, **(limits or {}))
+    formats = [fmt for fmt in limits["attachments"] if fmt in ATTACHMENT_FORMATS]
+    summary = io.StringIO()
+    summary_bytes = 0
+    omitted_regions = []
+    parts = [ReportPart(formats)] if formats else []
+    truncated_rows = 0
+
+    def add_summary(text):
+        nonlocal summary_bytes
+        size = len(text.encode())
+        if summary_bytes + size > limits["max_body_bytes"]:
+            return False
+        summary.write(text)
+        summary_bytes += size
+        return True
+
+    def add_row(fields):
+        nonlocal truncated_rows
+        if not parts:
+            return
+        part = parts[-1]
+        if part.rows and part.size + part.row_size(fields) > limits["max_attachment_bytes"]:
+            if len(parts) >= limits["max_messages"]:
+                truncated_rows += 1
+                return
+            part.finish()
+            part = ReportPart(formats)
+            parts.append(part)
+        part.add_row(fields)
+
+    for region, resources, region_changes in region_results:
+        lines = []
+        for collector_name, rows in resources.items():
+            change = region_changes.get(collector_name, {})
+            new = change.get("new", ())
+            long_running = change.get("long_running", {})
+            gone = change.get("gone", [])
+            if not rows and not gone:
+                continue
+
+            lines.append("{}: {}".format(COLLECTORS[collector_name]["label"], len(rows)))
+            counts = []
+            if new:
+                counts.append("{} new".format(len(new)))
+            if gone:
+                counts.append("{} gone".format(len(gone)))
+            lines[-1] += " ({})\n".format(", ".join(counts)) if counts else "\n"
+            current_group = None
+            shown = 0
+            for group, name, resource_id in rows:
+                if resource_id in new:
+                    status = "new"
+                elif resource_id in long_running:
+                    status = "running for {} runs".format(long_running[resource_id])
+                else:
+                    status = ""
+                add_row((region, collector_name, group or "", name, resource_id, status))
+
+                if shown < limits["summary_names"]:
+                    if group is not None and group != current_group:
+                        lines.append("[{}]\n".format(group))
+                        current_group = group
+                    lines.append("{} ({})\n".format(name, status) if status else "{}\n".format(name))
+                    shown += 1
+            if shown < len(rows):
+                lines.append("... and {} more, see attachment\n".format(len(rows) - shown))
+            for name in gone:
+                add_row((region, collector_name, "", name, "", "gone"))
+            if gone:
+                shown = gone[:limits["summary_names"]]
+                lines.append("Gone since last run: {}{}\n".format(", ".join(shown), ", ..." if len(gone) > len(shown) else ""))
+        if not lines:
             continue
+        lines.insert(0, "Region: {}\n".format(region))
+        lines.append("\n")
 
-        buf.write("Region: {}\n".format(region))
-        for instance in instances[region]:
-            buf.write("{}\n".format(instance))
+        if omitted_regions or not add_summary("".join(lines)):
+            omitted_regions.append(region)
 
-        buf.write("\n")
-        
-    return buf.getvalue()
+    if parts:
+        parts[-1].finish()
 
-def send_email(recipients, fromemail, email_body, region):
-    sesclient = boto3.client('ses', region)
-
-    response = sesclient.send_email(
-        Source=fromemail,
-        Destination={
-            'ToAddresses': recipients,
-        },
-        Message={
-            'Subject': {'Data': 'Hive running instance report'},
-            'Body': {'Text': {'Data': email_body}},
-        },
-    )
+    footer = io.StringIO()
+    if omitted_regions:
+        footer.write("Summary truncated; regions not shown above: {}\n\n".format(", ".join(omitted_regions)))
+    if truncated_rows:
+        footer.write("Report truncated: {} rows did not fit in {} messages.".format(truncated_rows, limits["max_messages"]))
+        if pointer:
+            footer.write(" The full list of running resources is in {}.".format(pointer))
+        footer.write("\n\n")
+    if errors:
+        footer.write("Scans missing from this report:\n")
+        for (region, collector_name), reason in errors.items():
+            footer.write("{} {}: {}\n".format(region, COLLECTORS[collector_name]["label"], reason))
+        footer.write("\n")
+    if skipped:
+        footer.write("Regions skipped this run:\n")
+        for region, reason in skipped.items():
+            footer.write("{}: {}\n".format(region, reason))
+        footer.write("\n")
+
+    return Report(summary.getvalue() + footer.getvalue(), parts, truncated_rows)
+
+def build_messages(report, recipients, fromemail, subject=REPORT_SUBJECT):
+    """Generator for the raw MIME messages (bytes) that make up the report, one per part."""
+    # Only needed once the scan is done, so they stay out of the import path
+    from email import encoders
+    from email.mime.base import MIMEBase
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    count = max(1, len(report.parts))
+    for n in range(count):
+        msg = MIMEMultipart()
+        msg["Subject"] = subject if count == 1 else "{} (part {} of {})".format(subject, n + 1, count)
+        msg["From"] = fromemail
+        msg["To"] = ", ".join(recipients)
+        if n == 0:
+            msg.attach(MIMEText(report.summary, "plain"))
+        else:
+            msg.attach(MIMEText("Detail attachments, part {} of {}. The summary is in part 1.\n".format(n + 1, count), "plain"))
+        if report.parts:
+            part = report.parts[n]
+            for fmt, f in part.files.items():
+                f.seek(0)
+                attachment = MIMEBase(*ATTACHMENT_FORMATS[fmt]["mimetype"])
+                attachment.set_payload(f.read())
+                encoders.encode_base64(attachment)
+                filename = "running-resources.{}".format(fmt) if count == 1 else "running-resources-part{}.{}".format(n + 1, fmt)
+                attachment.add_header("Content-Disposition", "attachment", filename=filename)
+                msg.attach(attachment)
+                f.close()
+        yield msg.as_bytes()
+
+def send_report(report, recipients, fromemail, region):
+    """Send the report with SES, one raw email per part. Returns the total bytes sent."""
+    sesclient = get_client('ses', region)
 
-    print("Email response: {}".format(response))
+    sent = 0
+    for data in build_messages(report, recipients, fromemail):
+        response = sesclient.send_raw_email(
+            Source=fromemail,
+            Destinations=recipients,
+            RawMessage={'Data': data},
+        )
+        sent += len(data)
+        print("Email response: {}".format(response))
+    return sent
 
 def main():
     event = {"regions": ["us-east-1", "us-east-2"],
             "recipients": ["someone@example.com"],
             "fromemail": "return@example.com",
             "emailregion": "us-east-1",
+            "snapshot": {"path": "instance-snapshot.json.gz"},
             }
     result = lambda_handler(event, "")
     print(result)
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+"""Offline benchmarks for vmcdns.py's DNS path.
+
+Each scenario runs in fresh subprocesses against FakeRoute53, so peak RSS is
+per scenario and no AWS account is needed. Zone scenarios time discovery
+(cold, cached and revalidated), availability queries and reserve/release
+round trips against a synthetic zone; race scenarios have several processes
+allocate from one segment of a shared zone at once, and thread scenarios
+several threads of one process (whose changes Route53Client coalesces):
+
+    ./bench/bench_vmcdns.py
+    ./bench/bench_vmcdns.py --records 100 100000 --latency 0.05 --rate 5
+    ./bench/bench_vmcdns.py --processes 2 8 32 --start first hash
+    ./bench/bench_vmcdns.py --threads 16 --latency 0.2 --rate 5
+    ./bench/bench_vmcdns.py --segments big-catalog.json --segment seg-0
+    ./bench/bench_vmcdns.py --json > baseline.json
+    ./bench/bench_vmcdns.py --compare baseline.json    # exits 1 on a regression
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(HERE, "..", "..", "bench"))
+
+import harness  # noqa: E402
+
+# Times each segment's available() is listed in full by the "available" phase
+AVAILABLE_REPEAT = 100
+
+# Metrics compared by --compare, and how much worse than the baseline each may get
+REGRESSION_TOLERANCE = {"seconds": 1.25, "api_calls": 1.0, "peak_rss_mb": 1.25}
+
+
+def setup(scenario, seed=True):
+    """Point vmcdns at a FakeRoute53 (and an empty cache) for scenario; return the fake."""
+    import vmcdns
+    from fake_route53 import FakeRoute53, synthetic_zone
+
+    rsets = ()
+    if seed:
+        rsets = synthetic_zone(vmcdns.VMC_BASE_DOMAIN, scenario["records"], vmcdns.SEGMENTS_BY_NAME.values(), scenario["fill"])
+    fake = FakeRoute53(vmcdns.HOSTED_ZONE_ID, rsets, latency=scenario["latency"], rate=scenario["rate"], path=scenario.get("path"))
+    fake.install()
+    # Pace the client to the fake account's limit, as it would be to Route53's
+    vmcdns.ROUTE53_RATE = scenario["rate"]
+    vmcdns.CACHE_DIR = tempfile.mkdtemp(prefix="vmcdns-bench-")
+    vmcdns.ARGS = argparse.Namespace(debug=False)
+    return fake
+
+
+def run_phase(fake, fn):
+    """Run fn, returning its time, the Route53 calls it made, what was rejected, and how the client coped."""
+    import botocore.exceptions
+    import vmcdns
+    fake.reset_counts()
+    stats = dict(vmcdns.get_route53_client().stats)
+    error = None
+    start = time.monotonic()
+    try:
+        fn()
+    except botocore.exceptions.ClientError as e:
+        error = e.response["Error"]["Code"]
+    result = {
+        "seconds": round(time.monotonic() - start, 4),
+        "api_calls": fake.api_calls(),
+        "rejected": sum(fake.rejected.values()),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    for key in ("retries", "coalesced"):
+        result[key] = vmcdns.get_route53_client().stats[key] - stats[key]
+    if error:
+        result["error"] = error
+    return result
+
+
+def run_zone_scenario(scenario):
+    """Run one zone scenario in this process and return {phase: measurements}."""
+    fake = setup(scenario)
+    import vmcdns
+    segment = vmcdns.SEGMENTS_BY_NAME[scenario["segment"]]
+
+    def available():
+        for _ in range(AVAILABLE_REPEAT):
+            for seg in vmcdns.SEGMENTS_BY_NAME.values():
+                list(seg.available())
+
+    def reserve_release():
+        for i in range(scenario["clusters"]):
+            name = f"bench-{i}"
+            ips = vmcdns.allocate_ips(segment, name, start=scenario["start"])
+            vmcdns.release_ips(ips[0], ips[1], name)
+
+    def age_cache():
+        vmcdns.ZONE_CACHE["checked"] -= vmcdns.CACHE_TTL_SECONDS
+        vmcdns.save_zone_cache(vmcdns.ZONE_CACHE)
+
+    phases = {}
+    with open(os.devnull, "w") as devnull:
+        stderr, sys.stderr = sys.stderr, devnull
+        try:
+            phases["discover_cold"] = run_phase(fake, vmcdns.discover_reserved_ips)
+            phases["discover_cached"] = run_phase(fake, vmcdns.discover_reserved_ips)
+            age_cache()
+            phases["discover_revalidate"] = run_phase(fake, vmcdns.discover_reserved_ips)
+            phases["available"] = run_phase(fake, available)
+            phases["reserve_release"] = run_phase(fake, reserve_release)
+        finally:
+            sys.stderr = stderr
+    return phases
+
+
+def run_race_worker(worker):
+    """Allocate worker["clusters"] clusters from the shared zone, starting at worker["start_at"]."""
+    fake = setup(worker, seed=False)
+    import vmcdns
+    segment = vmcdns.SEGMENTS_BY_NAME[worker["segment"]]
+    allocated, failed = {}, 0
+
+    def allocate():
+        nonlocal failed
+        vmcdns.discover_reserved_ips()
+        for i in range(worker["clusters"]):
+            name = f"race-{worker['id']}-{i}"
+            try:
+                ips = vmcdns.allocate_ips(segment, name, start=worker["start"])
+            except vmcdns.Conflict:
+                ips = None
+            if ips:
+                allocated[name] = ips
+            else:
+                failed += 1
+
+    time.sleep(max(0, worker["start_at"] - time.time()))
+    with open(os.devnull, "w") as devnull:
+        stderr, sys.stderr = sys.stderr, devnull
+        try:
+            result = run_phase(fake, allocate)
+        finally:
+            sys.stderr = stderr
+    result.update(allocated=allocated, failed=failed)
+    return result
+
+
+def run_thread_scenario(scenario):
+    """Have scenario["threads"] threads of this process each allocate scenario["clusters"] clusters at once."""
+    import threading
+    fake = setup(scenario)
+    import vmcdns
+    segment = vmcdns.SEGMENTS_BY_NAME[scenario["segment"]]
+    allocated, failed = {}, []
+
+    def allocate(n):
+        for i in range(scenario["clusters"]):
+            name = f"thread-{n}-{i}"
+            try:
+                ips = vmcdns.allocate_ips(segment, name, start=scenario["start"])
+            except vmcdns.Conflict:
+                ips = None
+            if ips:
+                allocated[name] = ips
+            else:
+                failed.append(name)
+
+    def allocate_all():
+        threads = [threading.Thread(target=allocate, args=(n,)) for n in range(scenario["threads"])]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    with open(os.devnull, "w") as devnull:
+        stderr, sys.stderr = sys.stderr, devnull
+        try:
+            vmcdns.discover_reserved_ips()
+            result = run_phase(fake, allocate_all)
+        finally:
+            sys.stderr = stderr
+    ips = [ip for pair in allocated.values() for ip in pair]
+    result.update(allocated=len(allocated), failed=len(failed), duplicates=len(ips) - len(set(ips)))
+    return {"allocate": result}
+
+
+def run_race_scenario(scenario):
+    """Seed a shared zone, race scenario["processes"] workers against it, and summarize."""
+    with tempfile.TemporaryDirectory(prefix="vmcdns-race-") as tmp:
+        scenario = dict(scenario, path=os.path.join(tmp, "zone.json"))
+        setup(scenario)
+        start_at = time.time() + 1 + 0.1 * scenario["processes"]
+        procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "--run-worker",
+                                   json.dumps(dict(scenario, id=n, start_at=start_at))],
+                                  stdout=subprocess.PIPE, universal_newlines=True)
+                 for n in range(scenario["processes"])]
+        workers = [json.loads(p.communicate()[0]) for p in procs]
+        if any(p.returncode for p in procs):
+            sys.exit("A race worker failed")
+
+    owners = {}
+    for w in workers:
+        for name, ips in w["allocated"].items():
+            for ip in ips:
+                owners.setdefault(ip, []).append(name)
+    return {"allocate": {
+        # Every worker starts together, so the slowest one is the race's wall time
+        "seconds": max(w["seconds"] for w in workers),
+        "api_calls": sum(w["api_calls"] for w in workers),
+        "rejected": sum(w["rejected"] for w in workers),
+        "retries": sum(w["retries"] for w in workers),
+        "coalesced": sum(w["coalesced"] for w in workers),
+        "peak_rss_mb": max(w["peak_rss_mb"] for w in workers),
+        "allocated": sum(len(w["allocated"]) for w in workers),
+        "failed": sum(w["failed"] for w in workers),
+        "duplicates": sum(1 for names in owners.values() if len(names) > 1),
+        "errors": sorted({w["error"] for w in workers if "error" in w}),
+    }}
+
+
+def build_scenarios(args):
+    common = {
+        "latency": args.latency,
+        "rate": args.rate,
+        "fill": args.fill,
+        "segment": args.segment,
+        "clusters": args.clusters,
+    }
+    scenarios = {}
+    for n in args.records:
+        scenarios[f"zone {n}"] = dict(common, kind="zone", records=n, start=args.start[0])
+    for p in args.processes:
+        for start in args.start:
+            scenarios[f"race {p}p/{start}"] = dict(common, kind="race", records=args.race_records, processes=p, start=start)
+    for t in args.threads:
+        scenarios[f"threads {t}t"] = dict(common, kind="threads", records=args.race_records, threads=t, start=args.start[0])
+    return scenarios
+
+
+def run_scenario(scenario):
+    if scenario["kind"] == "race":
+        return run_race_scenario(scenario)
+    flag = "--run-threads" if scenario["kind"] == "threads" else "--run-one"
+    return harness.run_in_subprocess(__file__, flag, scenario)
+
+
+def compare(results, baseline):
+    """Return a list of human-readable regressions of results, {scenario: {phase: measurements}}, against baseline.
+
+    Any address handed out twice is a regression, baseline or not.
+    """
+    def by_phase(results):
+        return {f"{name} {phase}": result for name, phases in results.items() for phase, result in phases.items()}
+
+    results = by_phase(results)
+    regressions = harness.compare(results, by_phase(baseline), REGRESSION_TOLERANCE)
+    for name, result in results.items():
+        if result.get("duplicates"):
+            regressions.append(f"{name}: {result['duplicates']} addresses were given to more than one cluster")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_vmcdns.py", description="Benchmark vmcdns.py against a fake Route53.")
+    parser.add_argument("--records", type=int, nargs="*", default=[100, 1000, 10000, 100000], help="Zone sizes (A records) to run, one zone scenario each.")
+    parser.add_argument("--processes", type=int, nargs="*", default=[1, 4, 16], help="Numbers of processes to race, one race scenario each.")
+    parser.add_argument("--threads", type=int, nargs="*", default=[8], help="Numbers of threads in one process to race, one thread scenario each.")
+    parser.add_argument("--race-records", type=int, default=1000, help="Zone size (A records) for the race and thread scenarios.")
+    parser.add_argument("--clusters", type=int, default=2, help="Clusters each zone scenario reserves and releases, and each racing process allocates.")
+    parser.add_argument("--start", nargs="+", default=["first", "hash"], choices=["first", "random", "hash"], help="allocate_ips() start strategies to race (zone scenarios use the first).")
+    parser.add_argument("--segment", default="devqe-segment-229-disconnected", help="The segment to reserve in.")
+    parser.add_argument("--segments", metavar="CATALOG", help="Segment catalog to use instead of segments.json.")
+    parser.add_argument("--fill", type=float, default=0.25, help="Fraction of each segment already reserved in the synthetic zone.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every fake Route53 call.")
+    parser.add_argument("--rate", type=float, help="Calls per second the fake zone accepts before throttling (Route53 allows 5).")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON (usable with --compare).")
+    parser.add_argument("--compare", metavar="BASELINE_JSON", help="Exit 1 if any scenario regressed against this earlier --json output.")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    parser.add_argument("--run-worker", help=argparse.SUPPRESS)
+    parser.add_argument("--run-threads", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.segments:
+        # Scenario subprocesses inherit this, and load the catalog when they import vmcdns
+        os.environ["VMCDNS_SEGMENTS"] = os.path.abspath(args.segments)
+
+    if args.run_one:
+        print(json.dumps(run_zone_scenario(json.loads(args.run_one))))
+        return
+    if args.run_worker:
+        print(json.dumps(run_race_worker(json.loads(args.run_worker))))
+        return
+    if args.run_threads:
+        print(json.dumps(run_thread_scenario(json.loads(args.run_threads))))
+        return
+
+    results = {name: run_scenario(scenario) for name, scenario in build_scenarios(args).items()}
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print(f"{'scenario':<18} {'phase':<20} {'seconds':>9} {'api_calls':>10} {'rejected':>9} {'retries':>8} {'peak_rss_mb':>12}  notes")
+        for name, phases in results.items():
+            for phase, r in phases.items():
+                notes = [f"{k}={r[k]}" for k in ("allocated", "failed", "duplicates", "coalesced", "error", "errors") if r.get(k)]
+                print(f"{name:<18} {phase:<20} {r['seconds']:>9} {r['api_calls']:>10} {r['rejected']:>9} {r['retries']:>8} {r['peak_rss_mb']:>12}  {' '.join(notes)}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            harness.exit_on_regressions(compare(results, json.load(f)))
+
+
+if __name__ == "__main__":
+    main()
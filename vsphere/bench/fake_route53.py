@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+"""In-process stand-in for the Route53 calls made by vmcdns.py; see fake_boto.py.
+
+It models the parts of Route53 vmcdns depends on: record ordering and
+pagination, all-or-nothing change batches that reject CREATEs of existing
+records, batch size limits, per-call latency and request-rate throttling.
+
+Given a path, the zone lives in that file instead of in memory, so several
+processes can share one zone (and one rate limit) to race each other.
+"""
+
+import contextlib
+import fcntl
+import ipaddress
+import itertools
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "bench"))
+
+from fake_boto import FakeBoto  # noqa: E402
+
+# Route53's limits on a single change_resource_record_sets call
+MAX_BATCH_RECORDS = 1000
+MAX_BATCH_VALUE_CHARS = 32000
+# ...and on a single list_resource_record_sets page
+MAX_LIST_ITEMS = 300
+
+
+def sort_key(name, rtype):
+    """Route53 lists records by name with its labels reversed, then by type."""
+    return (list(reversed(name.lower().rstrip(".").split("."))), rtype)
+
+
+def synthetic_zone(domain, records, segments=(), fill=0.5):
+    """Return the record sets of a zone with about `records` A records.
+
+    The lower `fill` of each Segment's allocatable range is taken by clusters
+    reserved the way vmcdns does it (api. and *.apps. records plus a claim
+    per address); the remaining A records belong to clusters outside every
+    segment, as most of the real zone's do.
+    """
+    rsets = [
+        {"Name": f"{domain}.", "Type": "NS", "TTL": 172800, "ResourceRecords": [{"Value": "ns-1.awsdns-00.com."}]},
+        {"Name": f"{domain}.", "Type": "SOA", "TTL": 900, "ResourceRecords": [{"Value": "ns-1.awsdns-00.com. hostmaster. 1 7200 900 1209600 86400"}]},
+    ]
+
+    def add_cluster(name, api, ingress, claims):
+        rsets.append({"Name": f"api.{name}.{domain}.", "Type": "A", "TTL": 60, "ResourceRecords": [{"Value": api}]})
+        rsets.append({"Name": f"\\052.apps.{name}.{domain}.", "Type": "A", "TTL": 60, "ResourceRecords": [{"Value": ingress}]})
+        for ip in claims:
+            rsets.append({"Name": f"_vmcdns-ip-{ip.replace('.', '-')}.{domain}.", "Type": "TXT", "TTL": 60,
+                          "ResourceRecords": [{"Value": f'"{name}"'}]})
+
+    count = 0
+    for s, segment in enumerate(segments):
+        used = int(segment.size * fill) // 2 * 2
+        ips = itertools.islice(iter(segment), min(used, records - count))
+        for n, (api, ingress) in enumerate(zip(ips, ips)):
+            add_cluster(f"seg{s}-cluster-{2 * n}", api, ingress, [api, ingress])
+            count += 2
+    outside = int(ipaddress.ip_address("10.0.0.0"))
+    while count < records:
+        add_cluster(f"ci-op-{count:06d}", str(ipaddress.ip_address(outside + count)),
+                    str(ipaddress.ip_address(outside + count + 1)), [])
+        count += 2
+    return rsets
+
+
+class FakeRoute53(FakeBoto):
+    """One hosted zone, answered from memory (or from the file at path).
+
+    latency is seconds slept per call. rate is how many calls per second the
+    zone accepts before answering Throttling, like Route53's per-account limit.
+    botocore doesn't retry errors raised from before-call, so callers see a
+    throttle as a ClientError, as they would once botocore's own retries ran out.
+    """
+    service = "route53"
+
+    def __init__(self, zone_id, rsets=(), latency=0, rate=None, path=None):
+        super().__init__()
+        self.zone_id = zone_id
+        self.latency = latency
+        self.rate = rate
+        self.path = path
+        self.rejected = {}
+        self.records = {}
+        self.recent = []
+        for rset in rsets:
+            self.records[(rset["Name"], rset["Type"])] = rset
+        self.sorted_keys = None
+        if path is not None and self.records:
+            # Seed the shared zone, replacing whatever was there
+            with open(path, "w") as f:
+                json.dump({"records": list(self.records.values()), "recent": []}, f)
+
+    def reset_counts(self):
+        with self.lock:
+            self.calls, self.rejected = {}, {}
+
+    @contextlib.contextmanager
+    def _shared(self):
+        """Load the zone from self.path under a file lock, and save it back afterwards."""
+        with open(self.path + ".lock", "w") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            with open(self.path) as f:
+                state = json.load(f)
+            self.records = {(r["Name"], r["Type"]): r for r in state["records"]}
+            self.recent = state["recent"]
+            self.sorted_keys = None
+            yield
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump({"records": list(self.records.values()), "recent": self.recent}, f)
+            os.replace(tmp, self.path)
+
+    def _respond(self, model, context, **kwargs):
+        self._count_call(model.name)
+        if self.latency:
+            time.sleep(self.latency)
+
+        handler = getattr(self, f"_{model.name}", None)
+        if handler is None:
+            raise NotImplementedError(f"FakeRoute53 does not implement {model.name}")
+        with self.lock:
+            if self.path is None:
+                parsed = self._answer(handler, context.get("fake_params", {}))
+            else:
+                with self._shared():
+                    parsed = self._answer(handler, context.get("fake_params", {}))
+        if "Error" in parsed:
+            with self.lock:
+                code = parsed["Error"]["Code"]
+                self.rejected[code] = self.rejected.get(code, 0) + 1
+        return self._reply(parsed)
+
+    def _answer(self, handler, params):
+        if self.rate is not None:
+            # Like a token bucket, a throttled call doesn't use up any of the rate
+            now = time.time()
+            self.recent = [t for t in self.recent if now - t < 1]
+            if len(self.recent) >= self.rate:
+                return self._error("Throttling", "Rate exceeded")
+            self.recent.append(now)
+        if params.get("Id", params.get("HostedZoneId")).split("/")[-1] != self.zone_id:
+            return self._error("NoSuchHostedZone", f"No hosted zone found with ID: {params.get('Id')}")
+        return handler(params)
+
+    def _error(self, code, message):
+        return {"Error": {"Code": code, "Message": message, "Type": "Sender"}}
+
+    def _GetHostedZone(self, params):
+        return {"HostedZone": {
+            "Id": f"/hostedzone/{self.zone_id}",
+            "Name": "fake.",
+            "CallerReference": "fake",
+            "ResourceRecordSetCount": len(self.records),
+        }}
+
+    def _ListResourceRecordSets(self, params):
+        if self.sorted_keys is None:
+            self.sorted_keys = sorted(self.records, key=lambda k: sort_key(*k))
+        max_items = min(int(params.get("MaxItems", MAX_LIST_ITEMS)), MAX_LIST_ITEMS)
+        start = 0
+        if "StartRecordName" in params:
+            start = self._position(sort_key(params["StartRecordName"], params.get("StartRecordType", "")))
+        page = self.sorted_keys[start:start + max_items]
+        parsed = {
+            "ResourceRecordSets": [self.records[key] for key in page],
+            "IsTruncated": start + max_items < len(self.sorted_keys),
+            "MaxItems": str(max_items),
+        }
+        if parsed["IsTruncated"]:
+            parsed["NextRecordName"], parsed["NextRecordType"] = self.sorted_keys[start + max_items]
+        return parsed
+
+    def _position(self, key):
+        """Where key (a sort_key()) is, or would go, in sorted_keys."""
+        lo, hi = 0, len(self.sorted_keys)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if sort_key(*self.sorted_keys[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _ChangeResourceRecordSets(self, params):
+        changes = params["ChangeBatch"]["Changes"]
+        values = [rec["Value"] for c in changes for rec in c["ResourceRecordSet"].get("ResourceRecords", [])]
+        if len(values) > MAX_BATCH_RECORDS:
+            return self._error("InvalidChangeBatch", f"Number of records limit of {MAX_BATCH_RECORDS} exceeded.")
+        if sum(len(v) for v in values) > MAX_BATCH_VALUE_CHARS:
+            return self._error("InvalidChangeBatch", f"Number of characters limit of {MAX_BATCH_VALUE_CHARS} exceeded.")
+
+        # Validate the whole batch against the zone first: it's all or nothing.
+        records = dict(self.records)
+        problems = []
+        for change in changes:
+            rset = dict(change["ResourceRecordSet"])
+            rset["Name"] = rset["Name"].replace("*", "\\052")
+            key = (rset["Name"], rset["Type"])
+            what = f"resource record set [name='{rset['Name']}', type='{rset['Type']}']"
+            if change["Action"] == "CREATE":
+                if key in records:
+                    problems.append(f"Tried to create {what} but it already exists")
+                else:
+                    records[key] = rset
+            elif change["Action"] == "DELETE":
+                if key not in records:
+                    problems.append(f"Tried to delete {what} but it was not found")
+                elif records[key].get("ResourceRecords") != rset.get("ResourceRecords") or records[key].get("TTL") != rset.get("TTL"):
+                    problems.append(f"Tried to delete {what} but the values provided do not match the current values")
+                else:
+                    del records[key]
+            else:
+                records[key] = rset
+        if problems:
+            return self._error("InvalidChangeBatch", f"[{', '.join(problems)}]")
+
+        if self.sorted_keys is not None:
+            # Keep the listing order up to date rather than sort the whole zone again
+            for key in self.records.keys() - records.keys():
+                del self.sorted_keys[self._position(sort_key(*key))]
+            for key in records.keys() - self.records.keys():
+                self.sorted_keys.insert(self._position(sort_key(*key)), key)
+        self.records = records
+        return {"ChangeInfo": {"Id": f"/change/C{len(changes)}", "Status": "INSYNC", "SubmittedAt": time.time()}}
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""Track how long vmcdns.py and new_hub.py take to start.
+
+Runs each command under `python -X importtime` in a fresh interpreter and
+reports its wall-clock time, the time spent importing, and the slowest
+imports. Fails if a command imports a module that should load only on
+demand (AWS SDK, etc.), or goes over --budget-ms:
+
+    ./bench/importtime.py
+    ./bench/importtime.py --top 15
+    ./bench/importtime.py --budget-ms 80
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+VSPHERE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Name: arguments to python. Each of these should start without touching AWS.
+COMMANDS = {
+    "import vmcdns": ["-c", "import vmcdns"],
+    "vmcdns.py --help": ["vmcdns.py", "--help"],
+    "new_hub.py --help": ["new_hub.py", "--help"],
+}
+
+# Modules only commands that talk to AWS should import
+LAZY_MODULES = ["boto3", "botocore", "netaddr"]
+
+
+def parse_importtime(stderr):
+    """Return [(module, self_us, cumulative_us)] from -X importtime output."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        imports.append((module.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def measure(args):
+    """Run python with args once; return (wall ms, [(module, self_us, cumulative_us)])."""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime"] + args, cwd=VSPHERE_DIR,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+    if result.returncode != 0:
+        sys.exit(f"{' '.join(args)} failed:\n{result.stderr}")
+    return wall_ms, parse_importtime(result.stderr)
+
+
+def bench(args, repeat):
+    """Measure args repeat times (after a warm-up run) and keep the fastest run."""
+    measure(args)
+    best = min((measure(args) for _ in range(repeat)), key=lambda run: run[0])
+    wall_ms, imports = best
+    return {
+        "wall_ms": round(wall_ms, 1),
+        "import_ms": round(sum(self_us for _, self_us, _ in imports) / 1000, 1),
+        "modules": len(imports),
+        "lazy_loaded": sorted({m.split(".")[0] for m, _, _ in imports} & set(LAZY_MODULES)),
+        "slowest": [(m, round(cumulative_us / 1000, 1)) for m, _, cumulative_us in sorted(imports, key=lambda i: -i[2])],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="importtime.py", description="Measure the startup time of the vsphere scripts.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per command; the fastest is reported.")
+    parser.add_argument("--top", type=int, default=5, help="How many of the slowest imports to list per command.")
+    parser.add_argument("--budget-ms", type=float, help="Fail if any command spends longer than this importing.")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON.")
+    args = parser.parse_args()
+
+    results = {name: bench(cmd, args.repeat) for name, cmd in COMMANDS.items()}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'command':<20} {'wall_ms':>8} {'import_ms':>10} {'modules':>8}")
+        for name, r in results.items():
+            print(f"{name:<20} {r['wall_ms']:>8} {r['import_ms']:>10} {r['modules']:>8}")
+            for module, ms in r["slowest"][:args.top]:
+                print(f"    {ms:>8} ms  {module}")
+
+    failed = False
+    for name, r in results.items():
+        if r["lazy_loaded"]:
+            print(f"FAIL: {name} imported {', '.join(r['lazy_loaded'])} at startup", file=sys.stderr)
+            failed = True
+        if args.budget_ms is not None and r["import_ms"] > args.budget_ms:
+            print(f"FAIL: {name} spent {r['import_ms']} ms importing (budget {args.budget_ms} ms)", file=sys.stderr)
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
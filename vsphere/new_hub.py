@@ -1,19 +1,104 @@
 #!/usr/bin/env python
 
 import argparse
+import concurrent.futures
+import contextlib
+import json
 import os
 import re
 import subprocess
 import sys
+import threading
+import time
 
 import vmcdns
-from netaddr import *
 
 
 def debug(*a, **k):
     if ARGS.debug:
         print("DEBUG: ", *a, file=sys.stderr, **k)
 
+# Name of the JSON timeline create-cluster writes to the assets directory
+TIMELINE_FILE = "new_hub-timeline.json"
+
+# Lines of `openshift-install create cluster --log-level=info` output that
+# start each sub-phase of the install. Each runs until the next one starts.
+INSTALL_SUBPHASES = [
+    ("infrastructure", re.compile(r"Creating infrastructure resources")),
+    ("wait-api", re.compile(r"Waiting up to \S+ .*for the Kubernetes API")),
+    ("bootstrap", re.compile(r"API v\S+ up")),
+    ("destroy-bootstrap", re.compile(r"Destroying the bootstrap resources")),
+    ("cluster-init", re.compile(r"Waiting up to \S+ .*for the cluster at \S+ to initialize")),
+    ("finish", re.compile(r"Install complete!")),
+]
+
+# create-clusters runs several installs at once: whole lines of their output
+# are written under OUTPUT_LOCK so they don't interleave, and `make deploy`s
+# take turns under DEPLOY_LOCK because they share the hive checkout.
+OUTPUT_LOCK = threading.Lock()
+DEPLOY_LOCK = threading.Lock()
+
+# With --dry-run, addresses already picked for another cluster: reserve_vips() won't use them.
+PICKED = set()
+
+
+class Timeline:
+    """Wall-clock time spent in each phase of a run, saved as JSON to path after every phase.
+
+    Phases may have sub-phases, named "phase/sub-phase"; see subphase().
+    """
+    def __init__(self, path, **info):
+        self.path = path
+        self.info = info
+        self.started = time.time()
+        self.start = time.monotonic()
+        self.status = "running"
+        self.phases = []
+        self.current_sub = None
+
+    def now(self):
+        return round(time.monotonic() - self.start, 3)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        entry = {"name": name, "start": self.now(), "seconds": None}
+        self.phases.append(entry)
+        try:
+            yield
+        finally:
+            self.end_subphase()
+            entry["seconds"] = round(self.now() - entry["start"], 3)
+            self.save()
+
+    def subphase(self, parent, name):
+        """End the current sub-phase, if any, and start parent/name."""
+        self.end_subphase()
+        self.current_sub = {"name": "{}/{}".format(parent, name), "start": self.now(), "seconds": None}
+        self.phases.append(self.current_sub)
+
+    def end_subphase(self):
+        if self.current_sub is not None:
+            self.current_sub["seconds"] = round(self.now() - self.current_sub["start"], 3)
+            self.current_sub = None
+
+    def save(self):
+        timeline = dict(self.info, started=time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.started)),
+                        status=self.status, total_seconds=self.now(), phases=self.phases)
+        with open(self.path, "w") as f:
+            json.dump(timeline, f, indent=2)
+
+    def summary(self):
+        """Return the phases as a table, with each one's share of the total."""
+        total = self.now() or 1
+        lines = ["{:<32} {:>10} {:>6}".format("phase", "seconds", "%")]
+        for entry in self.phases:
+            seconds = entry["seconds"] if entry["seconds"] is not None else self.now() - entry["start"]
+            name = "  " + entry["name"].split("/", 1)[1] if "/" in entry["name"] else entry["name"]
+            lines.append("{:<32} {:>10.1f} {:>6.1f}".format(name, seconds, 100 * seconds / total))
+        lines.append("{:<32} {:>10.1f}".format("total", self.now()))
+        return "\n".join(lines)
+
+
 def is_valid_ssh_file(filename):
     with open(filename, "r") as f:
         if "PRIVATE" in f.read():
@@ -21,6 +106,22 @@ def is_valid_ssh_file(filename):
             sys.exit(-1)
     return filename
 
+def add_create_args(parser, dir_help):
+    """Add the arguments create-cluster and create-clusters share to parser."""
+    parser.add_argument("--dir", metavar="DIR", default=os.getcwd(), help=dir_help)
+    parser.add_argument("--install-hive", dest="install_hive", action="store_true", help="Install Hive on the cluster. NOTE: Can only be run from hive directory." + 
+                            "NOTE: Make sure $IMG points to the hive image you want to install.")
+    parser.add_argument("--pull-secret", required=True, metavar="PULL_SECRET_FILE", help="The pull secret file to use for the cluster.")
+    parser.add_argument("--ssh-key", required=True, type=is_valid_ssh_file, metavar="SSH_KEY_FILE", help="The ssh key file to use for the cluster. You may download and use the team key from the hive-team repo at https://github.com/openshift-hive/hive-team/tree/master/repo-creds ")
+
+    network_kwargs = dict(choices=list(vmcdns.SEGMENTS_BY_NAME.keys()), help="The network segment to query.")
+    mutexgrp = parser.add_mutually_exclusive_group()
+    mutexgrp.add_argument("--network", **network_kwargs)
+    mutexgrp.add_argument("--disconnected", action="store_true", help="Use a disconnected segment (a public segment will be used by default).")
+    parser.add_argument("--start", choices=["first", "random", "hash"], default="hash", help="Where in the segment to start looking for VIPs: the bottom, a random spot, or a spot derived from the cluster name (the default). The last two make collisions between concurrent creates less likely.")
+    parser.add_argument("--sweep", action="store_true", help="Ping the VIPs picked before reserving them, and pass over any that answer (in use, but missing from DNS).")
+    parser.add_argument("--timings", action="store_true", help="Print how long each phase took when done. The timeline is always saved to {} in DIR.".format(TIMELINE_FILE))
+
 def build_parser():
     parser = argparse.ArgumentParser(
     prog="new_hub.py",
@@ -29,6 +130,8 @@ def build_parser():
     )
     parser.add_argument("--debug", action="store_true", help="Print debug output.")
     parser.add_argument("--dry-run", dest="dry_run", action="store_true", help="Don't actually do anything.")
+    parser.add_argument("--refresh", action="store_true", help="Ignore the local cache of the DNS hosted zone and rescan it.")
+    parser.add_argument("--no-server", dest="no_server", action="store_true", help="Don't use a running 'vmcdns.py serve', even if there is one.")
 
     subparsers = parser.add_subparsers(dest="subcommand")
 
@@ -38,17 +141,16 @@ def build_parser():
     # TODO: check that api_vip and ingress_vip are valid IPs
     create.add_argument("--api-vip", metavar="API_VIP", dest="api_vip", help="The optional IP address for api. NOTE: Script does not check whether this IP is already reserved in DNS")
     create.add_argument("--ingress-vip", metavar="INGRESS_VIP", dest="ingress_vip", help="The optional IP address for *.apps. NOTE: Script does not check whether this IP is already reserved in DNS")
-    create.add_argument("--dir", metavar="DIR", default=os.getcwd(), help="The directory to save the install-config.yaml file to. Defaults to current working directory.")
-    create.add_argument("--install-hive", dest="install_hive", action="store_true", help="Install Hive on the cluster. NOTE: Can only be run from hive directory." + 
-                            "NOTE: Make sure $IMG points to the hive image you want to install.")
-    create.add_argument("--pull-secret", required=True, metavar="PULL_SECRET_FILE", help="The pull secret file to use for the cluster.")
-    create.add_argument("--ssh-key", required=True, type=is_valid_ssh_file, metavar="SSH_KEY_FILE", help="The ssh key file to use for the cluster. You may download and use the team key from the hive-team repo at https://github.com/openshift-hive/hive-team/tree/master/repo-creds ")
+    add_create_args(create, dir_help="The directory to save the install-config.yaml file to. Defaults to current working directory.")
+
+    # create-clusters subcommand
+    create_many = subparsers.add_parser("create-clusters", help="Create several clusters in parallel. NOTE: GOVC_USERNAME and GOVC_PASSWORD env variables must be set.")
+    create_many.add_argument("cluster_names", nargs="*", metavar="CLUSTER_NAME", help="The names of the clusters to create.")
+    create_many.add_argument("--count", type=int, help="Create this many clusters named PREFIX-1 to PREFIX-COUNT instead of naming them.")
+    create_many.add_argument("--prefix", help="Name prefix for --count.")
+    create_many.add_argument("--parallel", type=int, default=4, help="How many clusters to install at once (default 4).")
+    add_create_args(create_many, dir_help="The directory to create each cluster's assets directory (DIR/CLUSTER_NAME) in. Defaults to current working directory.")
 
-    network_kwargs = dict(choices=list(vmcdns.SEGMENTS_BY_NAME.keys()), help="The network segment to query.")
-    mutexgrp = create.add_mutually_exclusive_group()
-    mutexgrp.add_argument("--network", **network_kwargs)
-    mutexgrp.add_argument("--disconnected", action="store_true", help="Use a disconnected segment (a public segment will be used by default).")
-   
     # destroy-cluster subcommand
     destroy = subparsers.add_parser("cleanup-cluster", help="Destroy and existing cluster and release its IPs.")
     destroy.add_argument("cluster_name", type=str, metavar="CLUSTER_NAME", help="The name of the cluster to destroy.")
@@ -65,7 +167,7 @@ def check_args():
         print("Subcommand required", file=sys.stderr)
         PARSER.print_help()
         sys.exit(-1)
-    if ARGS.subcommand == "create-cluster":
+    if ARGS.subcommand in ("create-cluster", "create-clusters"):
         debug("Creating cluster {}".format("and installing hive" if ARGS.install_hive else ""))
 
         CREDS.username = os.environ.get("GOVC_USERNAME")
@@ -85,12 +187,23 @@ def check_args():
                 print("IMG not set", file=sys.stderr)
                 sys.exit(-1)
 
+    if ARGS.subcommand == "create-cluster":
         if (ARGS.network or ARGS.disconnected) and (ARGS.api_vip or ARGS.ingress_vip):
             print("Cannot specify both --network/--disconnected and --api-vip/--ingress-vip", file=sys.stderr)
             sys.exit(-1)
         if not (ARGS.api_vip and ARGS.ingress_vip) and (ARGS.api_vip or ARGS.ingress_vip):
             print("Must specify both --api-vip and --ingress-vip", file=sys.stderr)
             sys.exit(-1)
+    if ARGS.subcommand == "create-clusters":
+        if bool(ARGS.cluster_names) == bool(ARGS.count):
+            print("Specify either CLUSTER_NAMEs or --count", file=sys.stderr)
+            sys.exit(-1)
+        if ARGS.count and not ARGS.prefix:
+            print("--count requires --prefix", file=sys.stderr)
+            sys.exit(-1)
+        if len(set(ARGS.cluster_names)) != len(ARGS.cluster_names):
+            print("Cluster names must be unique", file=sys.stderr)
+            sys.exit(-1)
     return ARGS
 
 def ping_ip(ip):
@@ -114,16 +227,16 @@ def check_vips(api_vip, ingress_vip):
     debug("Pinging ingress_vip: {}".format(ingress_vip))
     debug("ingress_vip {} is available".format(ping_ip(ingress_vip)))
 
-    # FIXME: this is a hack to get the segment name, don't do this
-    segname = None
-    pattern = r'^(\d+\.\d+\.\d+)\.'
-    match = re.search(pattern, api_vip)
-    for _, segment in vmcdns.SEGMENTS_BY_NAME.items():
-        if match.group(0) in str(segment.network):
-            return [api_vip, ingress_vip], segname
-    else:
-        print("Error: could not find segment name for api_vip {}".format(api_vip), file=sys.stderr)
+    segments = []
+    for vip in (api_vip, ingress_vip):
+        try:
+            segments.append(vmcdns.segment_for(vmcdns.ip_int(vip)))
+        except ValueError:
+            segments.append(None)
+    if segments[0] is None or segments[1] is not segments[0]:
+        print("Error: api_vip {} and ingress_vip {} must both be in one known segment".format(api_vip, ingress_vip), file=sys.stderr)
         sys.exit(-1)
+    return [api_vip, ingress_vip], segments[0].name
 
 def get_networks():
     if ARGS.network:
@@ -133,20 +246,59 @@ def get_networks():
     else:
         return [segname for segname in vmcdns.SEGMENTS_BY_NAME.keys() if "-disconnected" not in segname]
     
-def save_install_config(ips, segname, cluster_name, creds):
+def reserve_vips(cluster_name, networks):
+    """Reserve two VIPs for cluster_name in the first of networks that has them (with --dry-run, just pick them).
+
+    Returns (VIPs, segment name), or (None, None) if no network has two
+    available IPs. Raises vmcdns.Conflict if the cluster's records already exist.
+    With --sweep, VIPs that answer a ping are passed over; raises vmcdns.PingError
+    if ping itself fails.
+    """
+    avail, name = vmcdns.find_ips(cluster_name, networks, start=ARGS.start, avoid=PICKED, dry_run=ARGS.dry_run, sweep=ARGS.sweep, server=SERVER)
+    if avail and ARGS.dry_run:
+        PICKED.update(avail)
+    debug("{} IPs: {}".format("Picked" if ARGS.dry_run else "Reserved", avail))
+    return avail, name
+
+def save_install_config(ips, segname, cluster_name, creds, dir=None):
     install_config = vmcdns.get_install_config(ips, segname, cluster_name, creds)
     # TODO check that this is a valid directory
     filename = "install-config.yaml"
-    if ARGS.dir:
-        filename = os.path.join(ARGS.dir, "install-config.yaml")
+    dir = dir or ARGS.dir
+    if dir:
+        filename = os.path.join(dir, "install-config.yaml")
     with open(filename, "w") as f:
         f.write(install_config)
 
-def create_cluster(dir):
-    try:
-        subprocess.run(["openshift-install", "create", "cluster", "--dir", dir, "--log-level=info"], check=True)
-    except subprocess.CalledProcessError as e:
-        print("ERROR: {}".format(e), file=sys.stderr)
+def stream(cmd, prefix="", env=None, on_line=None):
+    """Run cmd, copying its output to stderr with each line prefixed; return its exit status."""
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1, env=env)
+    for line in proc.stdout:
+        with OUTPUT_LOCK:
+            sys.stderr.write(prefix + line)
+        if on_line:
+            on_line(line)
+    return proc.wait()
+
+def run_install(dir, timeline, prefix=""):
+    """Run `openshift-install create cluster` in dir, timing its sub-phases in timeline; return its exit status."""
+    def on_line(line):
+        for name, pattern in INSTALL_SUBPHASES:
+            if pattern.search(line):
+                timeline.subphase("install", name)
+                break
+
+    timeline.subphase("install", "assets")
+    return stream(install_command(dir), prefix, on_line=on_line)
+
+def install_command(dir):
+    return ["openshift-install", "create", "cluster", "--dir", dir, "--log-level=info"]
+
+def create_cluster(dir, timeline):
+    """Run openshift-install, passing its output through and timing its sub-phases in timeline."""
+    returncode = run_install(dir, timeline)
+    if returncode != 0:
+        print("ERROR: {}".format(subprocess.CalledProcessError(returncode, install_command(dir))), file=sys.stderr)
         print("Run the cleanup-cluster subcommand to clean up the cluster", file=sys.stderr)
         sys.exit(-1)
 
@@ -164,43 +316,177 @@ def install_hive(dir):
         print("ERROR: {}".format(e), file=sys.stderr)
         sys.exit(-1)
 
+def provision(cluster):
+    """Install (and deploy hive to) one cluster of create-clusters, recording any failure in cluster["error"]."""
+    prefix = "[{}] ".format(cluster["name"])
+    timeline = cluster["timeline"]
+    try:
+        with timeline.phase("install"):
+            returncode = run_install(cluster["dir"], timeline, prefix)
+        if returncode != 0:
+            cluster["error"] = "openshift-install exited with status {}".format(returncode)
+            return
+        if ARGS.install_hive:
+            env = dict(os.environ, KUBECONFIG=os.path.join(cluster["dir"], "auth", "kubeconfig"))
+            with DEPLOY_LOCK, timeline.phase("install-hive"):
+                returncode = stream(["make", "deploy"], prefix, env=env)
+            if returncode != 0:
+                cluster["error"] = "make deploy exited with status {}".format(returncode)
+    except Exception as e:
+        cluster["error"] = str(e)
+    finally:
+        timeline.status = "failed" if cluster["error"] else "succeeded"
+        timeline.save()
+        cluster["seconds"] = timeline.now()
+
+def create_clusters(names, timeline, clusters):
+    """Reserve VIPs for and render the assets of every named cluster, then provision ARGS.parallel of them at a time.
+
+    Appends a dict per cluster to clusters, with its name, dir, vips and error
+    (None if it succeeded). A failure for one cluster is recorded in its error;
+    if anything else fails, clusters still has those reserved so far.
+    """
+    if not SERVER:
+        with timeline.phase("discover"):
+            vmcdns.discover_reserved_ips(refresh=ARGS.refresh)
+    networks = get_networks()
+
+    with timeline.phase("reserve"):
+        for name in names:
+            cluster = dict(name=name, dir=os.path.join(ARGS.dir, name), vips=None, error=None)
+            try:
+                cluster["vips"], cluster["segment"] = reserve_vips(name, networks)
+                if not cluster["vips"]:
+                    cluster["error"] = "could not find any networks with two available IPs"
+            except vmcdns.PingError as e:
+                cluster["error"] = "can't ping: {}".format(e)
+            except Exception as e:
+                cluster["error"] = str(e)
+            clusters.append(cluster)
+
+    ready = [cluster for cluster in clusters if not cluster["error"]]
+    with timeline.phase("render-config"):
+        for cluster in ready:
+            try:
+                os.makedirs(cluster["dir"], exist_ok=True)
+                save_install_config(cluster["vips"], cluster["segment"], cluster["name"], CREDS, cluster["dir"])
+                cluster["timeline"] = Timeline(os.path.join(cluster["dir"], TIMELINE_FILE), cluster_name=cluster["name"], hive_image=os.environ.get("IMG"))
+            except Exception as e:
+                cluster["error"] = str(e)
+
+    ready = [cluster for cluster in ready if not cluster["error"]]
+    if not ARGS.dry_run:
+        with timeline.phase("install"):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=ARGS.parallel) as pool:
+                list(pool.map(provision, ready))
+
+def print_summary(clusters):
+    print("\n{:<24} {:<10} {:<16} {:<16} {}".format("cluster", "status", "api_vip", "ingress_vip", "minutes"), file=sys.stderr)
+    for cluster in clusters:
+        vips = cluster["vips"] or ["-", "-"]
+        minutes = "{:.1f}".format(cluster["seconds"] / 60) if "seconds" in cluster else "-"
+        status = "failed" if cluster["error"] else ("dry-run" if ARGS.dry_run else "succeeded")
+        print("{:<24} {:<10} {:<16} {:<16} {}".format(cluster["name"], status, vips[0], vips[1], minutes), file=sys.stderr)
+    failed = [cluster for cluster in clusters if cluster["error"]]
+    for cluster in failed:
+        print("ERROR: {}: {}".format(cluster["name"], cluster["error"]), file=sys.stderr)
+    cleanups = [cluster for cluster in failed if cluster["vips"] and not ARGS.dry_run]
+    if cleanups:
+        print("\nTo clean up the failed clusters and release their IPs:", file=sys.stderr)
+        for cluster in cleanups:
+            print("  {} cleanup-cluster {} --dir {} --api-vip {} --ingress-vip {}".format(
+                sys.argv[0], cluster["name"], cluster["dir"], cluster["vips"][0], cluster["vips"][1]), file=sys.stderr)
+
 if __name__ == "__main__":
     PARSER = build_parser()
     ARGS = PARSER.parse_args()
     vmcdns.ARGS = type('', (), dict(debug=ARGS.debug))
     CREDS = vmcdns.Creds()
     check_args()
+    # A running `vmcdns.py serve` already has the zone in memory, so use it if there is one.
+    SERVER = False
+    if ARGS.subcommand and not (ARGS.no_server or ARGS.refresh):
+        SERVER = vmcdns.server_request("GET", "/status", timeout=5) is not None
+        if SERVER:
+            debug("Using the vmcdns server at {}".format(vmcdns.SERVER_ADDRESS))
 
     if ARGS.subcommand == "create-cluster":
-        avail = []
-        if ARGS.api_vip and ARGS.ingress_vip:
-           avail, segname = check_vips(ARGS.api_vip, ARGS.ingress_vip)
-        else:
-            vmcdns.discover_reserved_ips()
-            networks = get_networks()
-            for name in networks:
-                avail = list(vmcdns.SEGMENTS_BY_NAME[name].available())
-                if len(avail) < 2:
-                    debug("Skipping segment %s: it doesn't have two available IPs")
-                    continue
-                segname = name
-                if not ARGS.dry_run:
-                    debug("Reserving IPs: {}".format(avail[:2]))
-                    vmcdns.reserve_ips(avail[:2], ARGS.cluster_name)
-        save_install_config(avail[:2], segname, ARGS.cluster_name, CREDS)
+        timeline = Timeline(os.path.join(ARGS.dir, TIMELINE_FILE), cluster_name=ARGS.cluster_name, hive_image=os.environ.get("IMG"))
+        try:
+            avail = []
+            if ARGS.api_vip and ARGS.ingress_vip:
+                with timeline.phase("check-vips"):
+                    avail, segname = check_vips(ARGS.api_vip, ARGS.ingress_vip)
+            else:
+                if not SERVER:
+                    with timeline.phase("discover"):
+                        vmcdns.discover_reserved_ips(refresh=ARGS.refresh)
+                networks = get_networks()
+                with timeline.phase("reserve"):
+                    try:
+                        avail, segname = reserve_vips(ARGS.cluster_name, networks)
+                    except vmcdns.Conflict as e:
+                        print("ERROR: {}".format(e), file=sys.stderr)
+                        sys.exit(-1)
+                    except vmcdns.PingError as e:
+                        print("ERROR: can't ping: {}".format(e), file=sys.stderr)
+                        sys.exit(-1)
+                if not avail:
+                    print("Error: could not find any networks with two available IPs", file=sys.stderr)
+                    sys.exit(-1)
+            with timeline.phase("render-config"):
+                save_install_config(avail[:2], segname, ARGS.cluster_name, CREDS)
+            if ARGS.dry_run:
+                print("\nThis is a dry-run. Your IPs are not reserved!", file=sys.stderr)
+                timeline.status = "dry-run"
+            else:
+                print("\nYour IP addresses have been reserved in the AWS hosted zone!", file=sys.stderr)
+                with timeline.phase("install"):
+                    create_cluster(ARGS.dir, timeline)
+                if ARGS.install_hive:
+                    os.environ['KUBECONFIG'] = os.path.join(ARGS.dir, "auth", "kubeconfig")
+                    with timeline.phase("install-hive"):
+                        install_hive(ARGS.dir)
+                timeline.status = "succeeded"
+        finally:
+            if timeline.status == "running":
+                timeline.status = "failed"
+            timeline.save()
+            if ARGS.timings:
+                print("\n" + timeline.summary(), file=sys.stderr)
+            debug("Timeline saved to {}".format(timeline.path))
+        sys.exit(0)
+    if ARGS.subcommand == "create-clusters":
+        names = ARGS.cluster_names or ["{}-{}".format(ARGS.prefix, i) for i in range(1, ARGS.count + 1)]
+        timeline = Timeline(os.path.join(ARGS.dir, TIMELINE_FILE), cluster_names=names, hive_image=os.environ.get("IMG"))
+        clusters = []
+        finished = False
+        try:
+            create_clusters(names, timeline, clusters)
+            finished = True
+        finally:
+            if not finished:
+                # Whatever stopped the run, say which clusters it left unfinished (and how to release their IPs)
+                for cluster in clusters:
+                    if not cluster["error"] and "seconds" not in cluster:
+                        cluster["error"] = "not finished: create-clusters stopped early"
+            failed = not finished or not clusters or any(cluster["error"] for cluster in clusters)
+            timeline.status = "failed" if failed else ("dry-run" if ARGS.dry_run else "succeeded")
+            timeline.save()
+            if clusters:
+                print_summary(clusters)
+            if ARGS.timings:
+                print("\n" + timeline.summary(), file=sys.stderr)
         if ARGS.dry_run:
             print("\nThis is a dry-run. Your IPs are not reserved!", file=sys.stderr)
-        else:
-            print("\nYour IP addresses have been reserved in the AWS hosted zone!", file=sys.stderr)
-            create_cluster(ARGS.dir)
-            if ARGS.install_hive:
-                os.environ['KUBECONFIG'] = os.path.join(ARGS.dir, "auth", "kubeconfig")
-                install_hive(ARGS.dir)
-        sys.exit(0)
+        sys.exit(-1 if timeline.status == "failed" else 0)
     if ARGS.subcommand == "cleanup-cluster":
         debug("Destroying cluster {}".format(ARGS.cluster_name))
         destroy_cluster(ARGS.dir)
         debug("Releasing IPs {}".format([ARGS.api_vip, ARGS.ingress_vip]))
-        vmcdns.release_ips(ARGS.api_vip, ARGS.ingress_vip, ARGS.cluster_name)
+        if SERVER:
+            vmcdns.server_request("POST", "/release", dict(api_vip=ARGS.api_vip, ingress_vip=ARGS.ingress_vip, cluster_name=ARGS.cluster_name))
+        else:
+            vmcdns.release_ips(ARGS.api_vip, ARGS.ingress_vip, ARGS.cluster_name)
         debug("Cleanup completed successfully")
         sys.exit(0)
\ No newline at end of file
@@ -0,0 +1,83 @@
+"""What the vmcdns.py tests share: vmcdns on the path, and a fake hosted zone that each test gets afresh.
+
+vmcdns keeps its state in module globals (RESERVED, the segment indexes, the
+zone cache and its directory, the Route53 client), so VmcdnsTestCase puts
+back every one a test may touch, and FakeZoneTestCase adds a FakeRoute53 zone
+and a throwaway cache directory, removed afterwards.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "bench"))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import boto3  # noqa: E402
+import vmcdns  # noqa: E402
+from fake_route53 import FakeRoute53, synthetic_zone  # noqa: E402
+
+# Module globals a test may replace, restored after each test
+GLOBALS = ["ARGS", "CACHE_DIR", "R53CLIENT", "ROUTE53_RATE", "ROUTE53_BACKOFF_SECONDS", "SERVER_ADDRESS", "ZONE_CACHE",
+           "ZONE_JOURNAL_MAX_BYTES"]
+# ...and containers it may change in place
+CONTAINERS = ["RESERVED", "RECORDED"]
+
+
+class VmcdnsTestCase(unittest.TestCase):
+    """Restores vmcdns's globals, RESERVED and every segment's indexes after each test."""
+
+    def setUp(self):
+        missing = object()
+        saved = {name: getattr(vmcdns, name, missing) for name in GLOBALS}
+        contents = {name: getattr(vmcdns, name).copy() for name in CONTAINERS if hasattr(vmcdns, name)}
+        segments = {segment: (dict(segment.reserved), list(segment.reserved_sorted), set(segment.live), set(segment.held))
+                    for segment in vmcdns.SEGMENTS_BY_NAME.values()}
+        session = boto3.DEFAULT_SESSION
+
+        def restore():
+            for name, value in saved.items():
+                if value is missing:
+                    if hasattr(vmcdns, name):
+                        delattr(vmcdns, name)
+                else:
+                    setattr(vmcdns, name, value)
+            for name, copy in contents.items():
+                container = getattr(vmcdns, name)
+                container.clear()
+                container.update(copy) if isinstance(container, dict) else container.extend(copy)
+            for segment, (reserved, reserved_sorted, live, held) in segments.items():
+                segment.reserved, segment.reserved_sorted, segment.live, segment.held = reserved, reserved_sorted, live, held
+            boto3.DEFAULT_SESSION = session
+
+        self.addCleanup(restore)
+        vmcdns.ARGS = argparse.Namespace(debug=False)
+
+
+class FakeZoneTestCase(VmcdnsTestCase):
+    """Runs each test against a fresh FakeRoute53 zone, indexed with discover_reserved_ips().
+
+    records and fill are synthetic_zone()'s: about how many A records the zone
+    holds, and how much of each segment they take.
+    """
+    records = 0
+    fill = 0
+
+    def setUp(self):
+        super().setUp()
+        rsets = synthetic_zone(vmcdns.VMC_BASE_DOMAIN, self.records, vmcdns.SEGMENTS_BY_NAME.values(), self.fill)
+        self.fake = FakeRoute53(vmcdns.HOSTED_ZONE_ID, rsets)
+        self.fake.install()
+        vmcdns.CACHE_DIR = tempfile.mkdtemp(prefix="vmcdns-test-")
+        self.addCleanup(shutil.rmtree, vmcdns.CACHE_DIR, ignore_errors=True)
+        vmcdns.R53CLIENT = None
+        vmcdns.ROUTE53_RATE = None
+        vmcdns.ZONE_CACHE = None
+        vmcdns.RESERVED.clear()
+        for segment in vmcdns.SEGMENTS_BY_NAME.values():
+            segment.reserved, segment.reserved_sorted, segment.live, segment.held = {}, [], set(), set()
+        vmcdns.discover_reserved_ips(refresh=True)
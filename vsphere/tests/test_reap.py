@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+"""Behaviour tests for vmcdns.py reap, which deletes DNS records, against FakeRoute53.
+
+    python3 -m unittest discover -s tests
+"""
+
+import contextlib
+import io
+import unittest
+
+from fixtures import FakeZoneTestCase, vmcdns
+
+
+class ReapTest(FakeZoneTestCase):
+    records = 20
+    fill = 0.5
+
+    def setUp(self):
+        super().setUp()
+        segment = list(vmcdns.SEGMENTS_BY_NAME.values())[0]
+        self.stale = vmcdns.select_stale(vmcdns.cluster_records([segment]), match=r"^seg0-")
+
+    def cluster_names(self):
+        return {name for name, _ in self.fake.records if ".seg0-cluster-" in name or name.startswith("_vmcdns-")}
+
+    def reap(self):
+        stderr = io.StringIO()
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(stderr):
+            calls, failed = vmcdns.reap(self.stale)
+        return calls, failed, stderr.getvalue()
+
+    def test_reaps_in_one_batch(self):
+        self.assertEqual(len(self.stale), 10)
+        calls, failed, _ = self.reap()
+        self.assertEqual((calls, failed), (1, []))
+        self.assertEqual(self.cluster_names(), set())
+
+    def test_changed_cluster_does_not_sink_the_batch(self):
+        # Someone releases seg0-cluster-0 after the scan
+        for key in [key for key in self.fake.records if f".seg0-cluster-0.{vmcdns.VMC_BASE_DOMAIN}." in key[0]
+                    or self.fake.records[key]["ResourceRecords"][0]["Value"] == '"seg0-cluster-0"']:
+            del self.fake.records[key]
+        self.fake.sorted_keys = None
+
+        calls, failed, stderr = self.reap()
+        self.assertEqual(failed, ["seg0-cluster-0"])
+        self.assertIn("Could not reap seg0-cluster-0", stderr)
+        # The rejected batch, then each of its 10 clusters on its own
+        self.assertEqual(calls, 11)
+        self.assertEqual(self.cluster_names(), set())
+
+    def test_other_errors_propagate(self):
+        from botocore.exceptions import ClientError
+        self.fake._ChangeResourceRecordSets = lambda params: self.fake._error("NoSuchHostedZone", "No hosted zone found")
+        with self.assertRaises(ClientError), contextlib.redirect_stdout(io.StringIO()):
+            vmcdns.reap(self.stale)
+
+
+if __name__ == "__main__":
+    unittest.main()
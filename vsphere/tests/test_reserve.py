@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""Behaviour tests for vmcdns.py reserve_ips and release_ips against FakeRoute53.
+
+    python3 -m unittest discover -s tests
+"""
+
+import contextlib
+import io
+import unittest
+
+from fixtures import FakeZoneTestCase, vmcdns
+
+
+class ReserveTest(FakeZoneTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ips = list(vmcdns.SEGMENTS_BY_NAME.values())[0].available()
+        self.quiet = contextlib.redirect_stderr(io.StringIO())
+        self.quiet.__enter__()
+        self.addCleanup(self.quiet.__exit__, None, None, None)
+
+    def claim(self, ip):
+        rset = self.fake.records.get((vmcdns.claim_name(ip), "TXT"))
+        return rset and rset["ResourceRecords"][0]["Value"]
+
+    def test_lost_race(self):
+        ips = [next(self.ips), next(self.ips)]
+        vmcdns.reserve_ips(ips, "first")
+        with self.assertRaises(vmcdns.Conflict) as cm:
+            vmcdns.reserve_ips([ips[1], next(self.ips)], "second")
+        self.assertEqual((cm.exception.ips, cm.exception.cluster_exists), ([ips[1]], False))
+
+    def test_retry_of_applied_batch_succeeds(self):
+        from botocore.exceptions import ReadTimeoutError
+        apply = self.fake._ChangeResourceRecordSets
+
+        def apply_then_time_out(params):
+            # Route53 applies the batch, but the reply never arrives; the client retries
+            self.fake._ChangeResourceRecordSets = apply
+            apply(params)
+            raise ReadTimeoutError(endpoint_url="https://route53.amazonaws.com")
+
+        self.fake._ChangeResourceRecordSets = apply_then_time_out
+        ips = [next(self.ips), next(self.ips)]
+        vmcdns.reserve_ips(ips, "mine")
+        self.assertEqual((self.claim(ips[0]), self.claim(ips[1])), ('"mine"', '"mine"'))
+        # ...and reserve_ips() recorded them, as for any reservation
+        self.assertEqual(vmcdns.RESERVED.get(ips[0]), f"api.mine.{vmcdns.VMC_BASE_DOMAIN}.")
+
+    def test_existing_cluster_is_a_conflict(self):
+        vmcdns.reserve_ips([next(self.ips), next(self.ips)], "mine")
+        with self.assertRaises(vmcdns.Conflict) as cm:
+            vmcdns.reserve_ips([next(self.ips), next(self.ips)], "mine")
+        self.assertTrue(cm.exception.cluster_exists)
+
+    def test_other_rejections_are_not_conflicts(self):
+        from botocore.exceptions import ClientError
+        self.fake._ChangeResourceRecordSets = lambda params: self.fake._error(
+            "InvalidChangeBatch", "Number of records limit of 1000 exceeded.")
+        with self.assertRaises(ClientError):
+            vmcdns.reserve_ips([next(self.ips), next(self.ips)], "first")
+
+    def test_release_leaves_others_claims(self):
+        ips = [next(self.ips), next(self.ips)]
+        vmcdns.reserve_ips(ips, "first")
+        # Someone else's claim on one of the addresses, with no records of ours behind it
+        self.fake.records[(vmcdns.claim_name(ips[1]), "TXT")]["ResourceRecords"] = [{"Value": '"second"'}]
+        vmcdns.release_ips(ips[0], ips[1], "first")
+        self.assertEqual((self.claim(ips[0]), self.claim(ips[1])), (None, '"second"'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+"""Tests for which errors vmcdns.py's Route53Client retries.
+
+    python3 -m unittest discover -s tests
+"""
+
+import types
+import unittest
+
+from botocore.exceptions import ClientError, EndpointConnectionError, ReadTimeoutError
+from fixtures import VmcdnsTestCase, vmcdns
+
+
+def client_error(code, status):
+    return ClientError({"Error": {"Code": code, "Message": code}, "ResponseMetadata": {"HTTPStatusCode": status}},
+                       "GetHostedZone")
+
+
+class FailingClient:
+    """Raises each of errors in turn from get_hosted_zone, then answers."""
+    meta = types.SimpleNamespace(method_to_api_mapping={"get_hosted_zone": "GetHostedZone"})
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def get_hosted_zone(self, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"HostedZone": {}}
+
+
+class RetryTest(VmcdnsTestCase):
+    def setUp(self):
+        super().setUp()
+        vmcdns.ROUTE53_BACKOFF_SECONDS = 0.001
+
+    def call(self, *errors):
+        stub = FailingClient(*errors)
+        client = vmcdns.Route53Client(stub, rate=None)
+        client.get_hosted_zone(Id="Z")
+        return stub.calls, client.stats
+
+    def test_throttles_are_retried(self):
+        calls, stats = self.call(client_error("Throttling", 400))
+        self.assertEqual((calls, stats["throttles"], stats["retries"]), (2, 1, 1))
+
+    def test_server_and_connection_errors_are_retried(self):
+        calls, stats = self.call(
+            client_error("ServiceUnavailable", 503),
+            client_error("InternalError", 500),
+            client_error("SomethingNew", 502),
+            EndpointConnectionError(endpoint_url="https://route53.amazonaws.com"),
+            ReadTimeoutError(endpoint_url="https://route53.amazonaws.com"),
+        )
+        self.assertEqual((calls, stats["throttles"], stats["retries"]), (6, 0, 5))
+
+    def test_client_errors_are_not_retried(self):
+        with self.assertRaises(ClientError):
+            self.call(client_error("InvalidChangeBatch", 400))
+
+
+if __name__ == "__main__":
+    unittest.main()
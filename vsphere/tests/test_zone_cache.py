@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""Tests for how vmcdns.py keeps its zone cache on disk and in the server's index.
+
+    python3 -m unittest discover -s tests
+"""
+
+import contextlib
+import io
+import threading
+import unittest
+
+from fixtures import FakeZoneTestCase, vmcdns
+
+
+class ZoneCacheTest(FakeZoneTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ips = list(vmcdns.SEGMENTS_BY_NAME.values())[0].available()
+        self.quiet = contextlib.redirect_stderr(io.StringIO())
+        self.quiet.__enter__()
+        self.addCleanup(self.quiet.__exit__, None, None, None)
+
+    def test_refresh_keeps_reservation_made_while_reading(self):
+        ips = [next(self.ips), next(self.ips)]
+        current_zone = vmcdns.current_zone
+
+        def stale_zone(refresh=False):
+            # The copy is read, then a request reserves before the index is rebuilt
+            cache = vmcdns.load_zone_cache()
+            vmcdns.reserve_ips(ips, "mine")
+            return cache
+
+        vmcdns.current_zone = stale_zone
+        self.addCleanup(setattr, vmcdns, "current_zone", current_zone)
+        vmcdns.refresh_index()
+        api = f"api.mine.{vmcdns.VMC_BASE_DOMAIN}."
+        self.assertEqual(vmcdns.RESERVED.get(ips[0]), api)
+        self.assertIn(api, vmcdns.load_zone_cache()["records"])
+
+    def test_changes_go_to_the_journal(self):
+        ips = [next(self.ips), next(self.ips)]
+        with open(vmcdns.zone_cache_path()) as f:
+            saved = f.read()
+        vmcdns.reserve_ips(ips, "mine")
+        with open(vmcdns.zone_cache_path()) as f:
+            self.assertEqual(f.read(), saved)
+        api = f"api.mine.{vmcdns.VMC_BASE_DOMAIN}."
+        cache = vmcdns.load_zone_cache()
+        self.assertIn(api, cache["records"])
+        self.assertEqual(cache["records"], vmcdns.ZONE_CACHE["records"])
+        vmcdns.release_ips(*ips, "mine")
+        self.assertNotIn(api, vmcdns.load_zone_cache()["records"])
+        self.assertEqual(vmcdns.load_zone_cache()["record_count"], len(self.fake.records))
+
+    def test_full_journal_is_folded_into_the_cache(self):
+        vmcdns.ZONE_JOURNAL_MAX_BYTES = 1
+        vmcdns.reserve_ips([next(self.ips), next(self.ips)], "mine")
+        self.assertFalse(vmcdns.os.path.exists(vmcdns.zone_journal_path()))
+        with open(vmcdns.zone_cache_path()) as f:
+            self.assertIn(f"api.mine.{vmcdns.VMC_BASE_DOMAIN}.", f.read())
+
+    def test_concurrent_saves(self):
+        cache = vmcdns.load_zone_cache()
+        errors = []
+
+        def save():
+            try:
+                for _ in range(20):
+                    vmcdns.save_zone_cache(cache)
+            except OSError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=save) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(vmcdns.load_zone_cache(), cache)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,71 +1,357 @@
 #!/usr/bin/env python
 
-import argparse
-import boto3
-import botocore
-from netaddr import *
+import bisect
+import ipaddress
+import itertools
+import os
+import re
 import sys
 import json
+import threading
+import time
+import zlib
+
+# boto3, botocore, argparse, asyncio and random are imported where they're
+# first needed: boto3 alone takes hundreds of milliseconds to import, which
+# --help, install-config rendering and importers like new_hub.py shouldn't pay
+# for. bench/importtime.py keeps an eye on this.
+
+
+# IPv6 addresses are stored as integers above all IPv4 ones, so both families
+# share one integer space (and one sorted index) without colliding.
+IPV6_OFFSET = 1 << 32
+
+
+def ip_int(ip):
+    """Return the IP address (string) ip as an integer; raise ValueError if it isn't one."""
+    addr = ipaddress.ip_address(ip)
+    return int(addr) + IPV6_OFFSET if addr.version == 6 else int(addr)
+
+
+def ip_str(ip):
+    """Return the integer IP as an address string."""
+    if ip >= IPV6_OFFSET:
+        return str(ipaddress.IPv6Address(ip - IPV6_OFFSET))
+    return str(ipaddress.IPv4Address(ip))
+
+
+def merge_ranges(ranges):
+    """Return the inclusive integer (lo, hi) ranges sorted, with overlapping and adjacent ones joined."""
+    merged = []
+    for lo, hi in sorted(ranges):
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(hi, merged[-1][1]))
+        else:
+            merged.append((lo, hi))
+    return merged
+
+
+def subtract_ranges(ranges, holes):
+    """Return the merged integer ranges covering ranges but none of holes."""
+    holes = merge_ranges(holes)
+    result = []
+    for lo, hi in merge_ranges(ranges):
+        for hole_lo, hole_hi in holes[max(bisect.bisect_left(holes, (lo,)) - 1, 0):]:
+            if hole_lo > hi:
+                break
+            if hole_hi < lo:
+                continue
+            if hole_lo > lo:
+                result.append((lo, hole_lo - 1))
+            lo = hole_hi + 1
+        if lo <= hi:
+            result.append((lo, hi))
+    return result
+
+
+# The biggest network (a /16) a Segment allocates from whole when it isn't given
+# ranges. Bigger ones, such as an IPv6 /64, must say which part to use.
+MAX_DEFAULT_RANGE_SIZE = 2 ** 16
 
 
 class Segment:
-    def __init__(self, cidr, dhcpstart) -> None:
-        self.network = IPNetwork(cidr)
-        self.dhcpstart = IPAddress(dhcpstart)
+    """A network segment called name, with addresses allocated from the CIDR cidr.
+
+    ranges and exclude are lists of "FIRST-LAST" ranges, CIDRs or single
+    addresses within the network: addresses are allocated from ranges
+    (default: all but the network's first three and last addresses, for a
+    network of up to MAX_DEFAULT_RANGE_SIZE addresses), less exclude. Everything is kept as integer ranges, so a big network costs
+    no more than a small one until its addresses are actually walked.
+    """
 
-    def available(self):
-        """Generator for IP address strings for available (unreserved) addresses in this segment."""
-        for ip in self:
-            if ip not in RESERVED:
-                yield ip
+    def __init__(self, name, cidr, ranges=None, exclude=()) -> None:
+        self.name = name
+        self.network = ipaddress.ip_network(cidr)
+        # The whole network, as an inclusive integer range
+        self.network_range = (ip_int(self.network.network_address), ip_int(self.network.broadcast_address))
+        if ranges is None:
+            if self.network.num_addresses > MAX_DEFAULT_RANGE_SIZE:
+                raise ValueError(f"{cidr} is too big to allocate from whole; give its \"ranges\"")
+            ranges = [(self.network_range[0] + 3, self.network_range[1] - 1)]
+        else:
+            ranges = [self.parse_range(spec) for spec in ranges]
+        # Allocatable ranges, as sorted, disjoint, inclusive integer ranges
+        self.ranges = subtract_ranges(ranges, [self.parse_range(spec) for spec in exclude])
+        if not self.ranges:
+            raise ValueError(f"{cidr} has no allocatable addresses")
+        self.starts = [lo for lo, hi in self.ranges]
+        # How many allocatable addresses precede each range, for start_for()
+        self.offsets = list(itertools.accumulate([0] + [hi - lo + 1 for lo, hi in self.ranges]))
+        self.size = self.offsets.pop()
+        # Reserved IPs in this segment's network: {int IP: DNS name}, plus the
+        # same IPs kept sorted so ranges can be walked without scanning.
+        self.reserved = dict()
+        self.reserved_sorted = []
+        # Integer IPs found answering pings despite having no DNS record; see sweep().
+        self.live = set()
+        # Integer IPs picked by allocations whose reservation is still in flight
+        self.held = set()
+
+    def parse_range(self, spec):
+        """Return the "FIRST-LAST" range, CIDR or address spec as an inclusive integer range in this network."""
+        if "/" in spec:
+            net = ipaddress.ip_network(spec)
+            lo, hi = ip_int(net.network_address), ip_int(net.broadcast_address)
+        else:
+            first, _, last = spec.partition("-")
+            lo = ip_int(first.strip())
+            hi = ip_int(last.strip()) if last else lo
+        if not self.network_range[0] <= lo <= hi <= self.network_range[1]:
+            raise ValueError(f"{spec} is not a range within {self.network}")
+        return lo, hi
+
+    def __contains__(self, ip):
+        """Whether the integer IP is in this segment's network."""
+        return self.network_range[0] <= ip <= self.network_range[1]
+
+    def reserve(self, ip, name):
+        """Record the integer IP as reserved by DNS name."""
+        if ip not in self.reserved:
+            bisect.insort(self.reserved_sorted, ip)
+        self.reserved[ip] = name
+
+    def unreserve(self, ip):
+        """Forget the reservation of the integer IP, if any."""
+        if self.reserved.pop(ip, None) is not None:
+            del self.reserved_sorted[bisect.bisect_left(self.reserved_sorted, ip)]
+
+    def available(self, start=None, skip=()):
+        """Generator for IP address strings for available (unreserved) addresses in this segment.
+
+        Steps over the sorted reservations instead of looking up every address,
+        so taking N results costs O(N + reservations skipped). Addresses a sweep
+        found in use, those held by an allocation in flight and the integer IPs
+        in skip are skipped too. With start (an integer IP), begins at the first
+        allocatable address from there and wraps around to cover the rest.
+        """
+        i = 0
+        if start is not None:
+            i = bisect.bisect_right(self.starts, start) - 1
+            if i < 0 or start > self.ranges[i][1]:
+                i, start = (i + 1) % len(self.ranges), None
+        lo, hi = self.ranges[i]
+        if start is None or start == lo:
+            ranges = self.ranges[i:] + self.ranges[:i]
+        else:
+            ranges = [(start, hi)] + self.ranges[i + 1:] + self.ranges[:i] + [(lo, start - 1)]
+        for lo, hi in ranges:
+            i = bisect.bisect_left(self.reserved_sorted, lo)
+            ip = lo
+            while ip <= hi:
+                if i < len(self.reserved_sorted) and self.reserved_sorted[i] == ip:
+                    i += 1
+                elif ip not in self.live and ip not in self.held and ip not in skip:
+                    yield ip_str(ip)
+                ip += 1
+
+    def start_for(self, strategy, cluster_name):
+        """Return the integer IP an allocation should start searching from.
+
+        "first" packs allocations at the bottom of the range; "random" spreads
+        concurrent callers out; "hash" gives each cluster name a stable spot.
+        Spreading out makes it less likely that racing callers want the same
+        addresses, so fewer of them need to retry.
+        """
+        if strategy == "random":
+            import random
+            return self.address_at(random.randrange(self.size))
+        if strategy == "hash":
+            return self.address_at(zlib.crc32(cluster_name.encode()) % self.size)
+        return self.ranges[0][0]
+
+    def free(self):
+        """Return about how many addresses are left to allocate: those not reserved, found live or held."""
+        reserved = sum(bisect.bisect_right(self.reserved_sorted, hi) - bisect.bisect_left(self.reserved_sorted, lo)
+                       for lo, hi in self.ranges)
+        return max(self.size - reserved - len(self.live) - len(self.held), 0)
+
+    def address_at(self, offset):
+        """Return the integer IP of the allocatable address offset places from the first one."""
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        return self.ranges[i][0] + offset - self.offsets[i]
 
     def reserved_str(self):
-        """Generator for 'IP\tDNSNAME' strings for reserved addresses in this segment."""
-        for ip in self:
-            if ip in RESERVED:
-                yield f"{ip}\t{RESERVED[ip]}"
+        """Generator for 'IP\tDNSNAME' strings for reserved addresses in this segment's allocatable ranges."""
+        for lo, hi in self.ranges:
+            start = bisect.bisect_left(self.reserved_sorted, lo)
+            end = bisect.bisect_right(self.reserved_sorted, hi)
+            for ip in self.reserved_sorted[start:end]:
+                yield f"{ip_str(ip)}\t{self.reserved[ip]}"
 
     def __iter__(self):
-        for ip in iter_iprange(self.network.first+3, self.dhcpstart-1):
-            yield str(ip)
+        for lo, hi in self.ranges:
+            for ip in range(lo, hi + 1):
+                yield ip_str(ip)
 
     def __str__(self) -> str:
         return "\n".join(str(ip) for ip in self)
 
 
-# Source: https://docs.google.com/document/d/1cnzKMT-8TGcq5ox_AajGpT-VRwMuYTKIZI-fPNrR8Xg/edit#heading=h.pt8d46lus3jk
-SEGMENTS_BY_NAME = {
-    # "devqe-segment-221": Segment("192.168.221.0/24", "192.168.221.128"),
-    "devqe-segment-222": Segment("192.168.222.0/24", "192.168.222.50"),
-    # 223-228 are used by prow CI, and subject to automatic pruning
-    # "devqe-segment-223": Segment("192.168.223.0/24", "192.168.223.50"),
-    # "devqe-segment-224": Segment("192.168.224.0/24", "192.168.224.50"),
-    # "devqe-segment-225": Segment("192.168.225.0/24", "192.168.225.50"),
-    # "devqe-segment-226": Segment("192.168.226.0/24", "192.168.226.50"),
-    # "devqe-segment-227": Segment("192.168.227.0/24", "192.168.227.50"),
-    # "devqe-segment-228": Segment("192.168.228.0/24", "192.168.228.50"),
-    "devqe-segment-229-disconnected": Segment("192.168.229.0/24", "192.168.229.128"),
-    # 230-234 are used by prow CI, and subject to automatic pruning
-    # "devqe-segment-230-disconnected": Segment("192.168.230.0/24", "192.168.230.128"),
-    # "devqe-segment-231-disconnected": Segment("192.168.231.0/24", "192.168.231.128"),
-    # "devqe-segment-232-disconnected": Segment("192.168.232.0/24", "192.168.232.128"),
-    # "devqe-segment-233-disconnected": Segment("192.168.233.0/24", "192.168.233.128"),
-    # "devqe-segment-234-disconnected": Segment("192.168.234.0/24", "192.168.234.128"),
-}
+# The segment catalog: see segments.json, whose "source" says where it comes from.
+SEGMENTS_FILE = os.environ.get("VMCDNS_SEGMENTS") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "segments.json")
+SEGMENT_KEYS = {"cidr", "ranges", "exclude", "enabled", "note"}
+
+
+def load_segments(path=SEGMENTS_FILE):
+    """Return {name: Segment} for the enabled segments in the catalog file at path, in file order.
+
+    Raises ValueError, naming the segment, if the catalog has a mistake.
+    """
+    with open(path) as f:
+        catalog = json.load(f)
+    segments = dict()
+    for name, spec in catalog["segments"].items():
+        try:
+            unknown = set(spec) - SEGMENT_KEYS
+            if unknown:
+                raise ValueError(f"unknown keys {', '.join(sorted(unknown))}")
+            if "cidr" not in spec:
+                raise ValueError("no cidr")
+            if spec.get("enabled", True):
+                segments[name] = Segment(name, spec["cidr"], spec.get("ranges"), spec.get("exclude", ()))
+        except ValueError as e:
+            raise ValueError(f"{path}: segment {name}: {e}") from None
+    return segments
+
+
+def use_segments(segments):
+    """Make {name: Segment} segments the known segments, and index them by network for segment_for().
+
+    Raises ValueError if two of the segments' networks overlap.
+    """
+    global SEGMENTS_BY_NAME, SEGMENT_INDEX
+    ordered = sorted(segments.values(), key=lambda segment: segment.network_range)
+    for a, b in zip(ordered, ordered[1:]):
+        if b.network_range[0] <= a.network_range[1]:
+            raise ValueError(f"Segments {a.name} ({a.network}) and {b.name} ({b.network}) overlap.")
+    SEGMENTS_BY_NAME = segments
+    # The segments sorted by network, and where each network starts, for bisecting
+    SEGMENT_INDEX = ([segment.network_range[0] for segment in ordered], ordered)
+
+
+use_segments(load_segments())
 
 
 HOSTED_ZONE_ID = 'Z0355267XBPSF2ILEW5O'
 VMC_BASE_DOMAIN = "vmc.devcluster.openshift.com"
 
-# IPs that already have records associated with them
+# IPs that already have records associated with them, as {IP string: DNS name}.
+# Those inside a known segment are also indexed on the Segment itself.
 RESERVED = dict()
 
-# Singleton AWS Route53 client
+# Singleton Route53Client, see get_route53_client()
 R53CLIENT = None
 
+# Route53 accepts five requests per second per account, shared by every job
+# using it. Each process paces itself to ROUTE53_RATE requests per second (None
+# for no pacing), halves its rate whenever it's throttled anyway, down to
+# ROUTE53_MIN_RATE, and wins back a tenth of ROUTE53_RATE with each success.
+ROUTE53_RATE = 5
+ROUTE53_MIN_RATE = 0.2
+# Seconds a throttled call keeps being retried before it fails, and the base
+# and cap of the jittered exponential backoff between attempts
+ROUTE53_RETRY_SECONDS = 300
+ROUTE53_BACKOFF_SECONDS = 0.25
+ROUTE53_MAX_BACKOFF_SECONDS = 20
+# Route53 error codes worth retrying after a pause
+ROUTE53_RETRY_CODES = {"Throttling", "ThrottlingException", "PriorRequestNotComplete", "RequestLimitExceeded"}
+# ...and those (with any other 5xx response, or a connection or read error) that
+# are retried too, but don't mean we're going too fast. botocore's own retries
+# are off, so these are the ones it would have retried.
+ROUTE53_TRANSIENT_CODES = {"ServiceUnavailable", "InternalError", "InternalFailure", "RequestTimeout"}
+
+# On-disk copy of the hosted zone's A and AAAA records, so repeated runs needn't
+# page through the whole zone. See discover_reserved_ips().
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "vmcdns")
+CACHE_VERSION = 4
+# Within this many seconds of the last check the cache is trusted outright...
+CACHE_TTL_SECONDS = 300
+# ...after that it is trusted if the zone's record count hasn't changed, until
+# it is this old, when it is always rebuilt. The count misses UPSERTs and a
+# delete balanced by a create, so the cache can be stale for this long; see
+# current_zone().
+CACHE_MAX_AGE_SECONDS = 3600
+# Records per list_resource_record_sets page (Route53 allows up to 300)
+LIST_PAGE_SIZE = "300"
+
+# The zone cache in use by this process, once discover_reserved_ips() has run
+ZONE_CACHE = None
+# Once record_changes() has appended this much to the zone cache's journal,
+# the journal is folded into the cache
+ZONE_JOURNAL_MAX_BYTES = 2 ** 20
+# Changes record_changes() has applied since the server's last refresh_index()
+RECORDED = []
+
+# The fewest times allocate_ips() moves on to fresh candidates after losing a
+# race; a segment with more free pairs than this gets one attempt per free pair
+ALLOCATE_ATTEMPTS = 10
+
+# Route53's limits on a single change_resource_record_sets call
+MAX_BATCH_RECORDS = 1000
+MAX_BATCH_VALUE_CHARS = 32000
+
+# Seconds to wait for each ping reply during a sweep
+SWEEP_TIMEOUT = 1
+# Available addresses a sweep pings, counting from the bottom of the segment;
+# pinging every address of a /16 (or an IPv6 range) isn't practical
+SWEEP_WINDOW = 256
+# Available addresses `vmcdns.py available` lists unless given --count
+AVAILABLE_COUNT = 256
+# Pings in flight at once during a sweep
+SWEEP_CONCURRENCY = 64
+# ping's exit status when it got no reply; any other but 0 is an error, such as
+# lacking permission to send
+PING_NO_REPLY = 2 if sys.platform == "darwin" else 1
+
+# Where `vmcdns.py serve` listens, and where clients look for it: a UNIX
+# socket path, or an http://127.0.0.1:PORT URL.
+SERVER_ADDRESS = os.environ.get("VMCDNS_SERVER") or os.path.join(CACHE_DIR, "serve.sock")
+# Seconds between the server's checks for changes to the zone
+SERVE_REFRESH_SECONDS = 60
+# Guards RESERVED, the segment indexes and the zone cache against the server's
+# concurrent requests. It isn't held during Route53 calls, so changes from
+# concurrent requests can share a batch; see Route53Client.
+SERVE_LOCK = threading.RLock()
+
+
+class PingError(Exception):
+    """Raised when ping fails for a reason other than getting no reply."""
+
+
+class Conflict(Exception):
+    """Raised when Route53 refuses to CREATE records because some already exist.
+
+    ips holds the addresses someone else claimed first; cluster_exists is set
+    when the cluster's own records were the ones in the way.
+    """
+    def __init__(self, message, ips=(), cluster_exists=False):
+        super().__init__(message)
+        self.ips = list(ips)
+        self.cluster_exists = cluster_exists
+
 
 def change_json(action, route, base_name, ip):
-    if action not in ("UPSERT", "DELETE"):
+    if action not in ("CREATE", "UPSERT", "DELETE"):
         raise ValueError(f"BUG: change_json got invalid action '{action}'.")
     if route == "API":
         prefix = "api"
@@ -77,7 +363,7 @@ def change_json(action, route, base_name, ip):
         "Action": action,
         "ResourceRecordSet": {
             "Name": f"{prefix}.{base_name}.{VMC_BASE_DOMAIN}.",
-            "Type": "A",
+            "Type": "AAAA" if ":" in ip else "A",
             "TTL": 60,
             "ResourceRecords": [{
                 "Value": ip
@@ -86,6 +372,54 @@ def change_json(action, route, base_name, ip):
     }
 
 
+# Each reserved address also gets a TXT "claim" record named after it. Route53
+# CREATE fails if a name already exists, and a change batch is all or nothing,
+# so creating the claims alongside the cluster's records guarantees no address
+# is ever handed to two clusters, without any lock.
+CLAIM_PREFIX = "_vmcdns-ip-"
+CLAIM_RE = re.compile("^" + re.escape(CLAIM_PREFIX) + r"(?P<ip>[0-9a-f-]+)\." + re.escape(VMC_BASE_DOMAIN) + r"\.$")
+
+
+def claim_name(ip):
+    # An IPv6 address is spelled out in full, as eight dash-separated groups
+    if ":" in ip:
+        ip = ipaddress.ip_address(ip).exploded.replace(":", "-")
+    return f"{CLAIM_PREFIX}{ip.replace('.', '-')}.{VMC_BASE_DOMAIN}."
+
+
+def claim_ip(name):
+    """Return the IP address string claimed by the record called name, or None if it's not a claim."""
+    match = CLAIM_RE.match(name)
+    if not match:
+        return None
+    groups = match.group("ip").split("-")
+    if len(groups) == 8:
+        return str(ipaddress.ip_address(":".join(groups)))
+    return ".".join(groups)
+
+
+def claim_json(action, ip, cluster_name):
+    return {
+        "Action": action,
+        "ResourceRecordSet": {
+            "Name": claim_name(ip),
+            "Type": "TXT",
+            "TTL": 60,
+            "ResourceRecords": [{
+                "Value": f'"{cluster_name}"'
+            }],
+        },
+    }
+
+
+def record_ips(name, rset):
+    """Return the IP address strings reserved by a cached record."""
+    if rset.get("Type", "A") in ("A", "AAAA"):
+        return rset["Values"]
+    ip = claim_ip(name)
+    return [ip] if ip else []
+
+
 def debug(*a, **k):
     try:
         if ARGS.debug:
@@ -96,39 +430,687 @@ def debug(*a, **k):
         else:
             raise
 
-def discover_reserved_ips():
+def check_access(e):
+    """Exit with a helpful message if the ClientError e is an AccessDenied."""
+    if e.response['Error']['Code'] == "AccessDenied":
+        print("Access denied! Do you need to set $AWS_PROFILE and/or $AWS_ACCESS_KEY_ID/$AWS_SECRET_ACCESS_KEY?", file=sys.stderr)
+        sys.exit(1)
+
+
+def discover_reserved_ips(refresh=False, offline=False):
+    """Populate RESERVED (and the segment indexes) from the hosted zone's A and AAAA records.
+
+    See current_zone() for how the zone is read, and what refresh and offline do.
+    """
+    global ZONE_CACHE
+    ZONE_CACHE = current_zone(refresh, offline)
+    index_zone(ZONE_CACHE)
+
+
+def current_zone(refresh=False, offline=False):
+    """Return the zone cache, rescanning the zone first if the cache is out of date.
+
+    The zone is read from the on-disk cache when possible. A cache checked within
+    CACHE_TTL_SECONDS is used as is. Past that, one cheap get_hosted_zone call
+    compares the zone's record count with the cache's, and only a mismatch (or
+    a cache older than CACHE_MAX_AGE_SECONDS) triggers a full rescan. refresh
+    forces the rescan; offline uses the cache without talking to AWS at all.
+
+    The record count doesn't change when a record is UPSERTed, or when one is
+    deleted and another created, so such changes can go unseen until the cache
+    ages out. That's harmless when allocating, since the CREATE claims catch
+    any address someone else took, but anything that deletes records based on
+    the cache must pass refresh.
+    """
+    cache = load_zone_cache()
+    now = time.time()
+    if offline:
+        if cache is None:
+            print(f"No cached copy of hosted zone {HOSTED_ZONE_ID}; run once without --offline.", file=sys.stderr)
+            sys.exit(1)
+        debug("Using cached zone from %s (offline)" % time.ctime(cache["fetched"]))
+    elif refresh or cache is None or now - cache["fetched"] >= CACHE_MAX_AGE_SECONDS:
+        cache = scan_zone()
+    elif now - cache["checked"] >= CACHE_TTL_SECONDS:
+        if zone_record_count() != cache["record_count"]:
+            debug("Hosted zone has changed since it was cached")
+            cache = scan_zone()
+        else:
+            debug("Hosted zone unchanged since %s" % time.ctime(cache["fetched"]))
+            cache["checked"] = now
+            save_zone_cache(cache)
+    else:
+        debug("Using cached zone from %s" % time.ctime(cache["fetched"]))
+    return cache
+
+
+def index_zone(cache):
+    """Add the reservations recorded in the zone cache to RESERVED and the segment indexes."""
+    for name, rset in cache["records"].items():
+        for val in record_ips(name, rset):
+            add_reservation(val, name)
+            debug("Reserved: %s" % val)
+
+
+def clear_reservations():
+    """Forget every reservation in RESERVED and the segment indexes."""
+    RESERVED.clear()
+    for segment in SEGMENTS_BY_NAME.values():
+        segment.reserved.clear()
+        segment.reserved_sorted.clear()
+
+
+def zone_record_count():
+    r53client = get_route53_client()
+    from botocore.exceptions import ClientError
+    try:
+        res = r53client.get_hosted_zone(Id=HOSTED_ZONE_ID)
+    except ClientError as e:
+        check_access(e)
+        raise
+    return res["HostedZone"]["ResourceRecordSetCount"]
+
+
+def scan_zone():
+    """Read every A and claim record in the hosted zone, save them to the cache, and return the cache."""
     debug("Querying Hosted Zone %s" % HOSTED_ZONE_ID)
     r53client = get_route53_client()
+    from botocore.exceptions import ClientError
+    # Taken first, so a change made during the scan shows up as a mismatch next time.
+    record_count = zone_record_count()
+    # Route53 doesn't say when a record was created, so remember when we first saw it.
+    previous = load_zone_cache()
+    first_seen = {name: rset["FirstSeen"] for name, rset in previous["records"].items()} if previous else {}
+    now = time.time()
+    records = dict()
     kw = {}
     while True:
         try:
-            res = r53client.list_resource_record_sets(HostedZoneId=HOSTED_ZONE_ID, MaxItems="10", **kw)
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "AccessDenied":
-                print("Access denied! Do you need to set $AWS_PROFILE and/or $AWS_ACCESS_KEY_ID/$AWS_SECRET_ACCESS_KEY?", file=sys.stderr)
-                sys.exit(1)
+            res = r53client.list_resource_record_sets(HostedZoneId=HOSTED_ZONE_ID, MaxItems=LIST_PAGE_SIZE, **kw)
+        except ClientError as e:
+            check_access(e)
             raise
         for rset in res.get('ResourceRecordSets'):
-            if rset.get('Type') != "A": continue
+            if rset.get('Type') not in ("A", "AAAA") and not (rset.get('Type') == "TXT" and claim_ip(rset["Name"])): continue
             recs = rset.get('ResourceRecords')
             if not recs: continue
-            for rec in recs:
-                val = rec.get("Value")
-                if val:
-                    RESERVED[val] = rset["Name"]
-                    debug("Reserved: %s" % val)
+            values = [rec["Value"] for rec in recs if rec.get("Value")]
+            if values:
+                records[rset["Name"]] = {"Type": rset["Type"], "TTL": rset.get("TTL"), "Values": values, "FirstSeen": first_seen.get(rset["Name"], now)}
         if not res['IsTruncated']:
             break
         kw['StartRecordName'] = res['NextRecordName']
         kw['StartRecordType'] = res['NextRecordType']
 
+    now = time.time()
+    cache = {
+        "version": CACHE_VERSION,
+        "zone": HOSTED_ZONE_ID,
+        "fetched": now,
+        "checked": now,
+        "record_count": record_count,
+        "records": records,
+    }
+    save_zone_cache(cache)
+    return cache
+
+
+def zone_cache_path():
+    return os.path.join(CACHE_DIR, f"{HOSTED_ZONE_ID}.json")
+
+
+def zone_journal_path():
+    return os.path.join(CACHE_DIR, f"{HOSTED_ZONE_ID}.journal")
+
+
+def load_zone_cache():
+    """Return the cached zone, with the changes in its journal applied, or None if there's no usable cache."""
+    try:
+        with open(zone_cache_path()) as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        debug("Ignoring unreadable zone cache: %s" % e)
+        return None
+    if cache.get("version") != CACHE_VERSION or cache.get("zone") != HOSTED_ZONE_ID:
+        return None
+    try:
+        with open(zone_journal_path()) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Another process may be part way through appending it
+                    debug("Ignoring unreadable zone journal entry")
+                    continue
+                apply_changes(cache, entry["changes"], entry["time"])
+    except FileNotFoundError:
+        pass
+    return cache
+
+
+def save_zone_cache(cache):
+    """Write cache to disk, replacing the old copy (and its journal) in one step.
+
+    Every writer, in any process or thread, gets its own temporary file.
+    """
+    import tempfile
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, prefix=f"{HOSTED_ZONE_ID}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp, zone_cache_path())
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    try:
+        os.unlink(zone_journal_path())
+    except FileNotFoundError:
+        pass
+
+
+def journal_changes(changes, now=None):
+    """Append changes, made at now, to the zone cache's journal, which load_zone_cache() applies to the cache.
+
+    One short line per batch, where saving the cache means writing out the whole
+    zone. Once the journal passes ZONE_JOURNAL_MAX_BYTES it's folded into the cache.
+    A line lost to another process saving the cache at the same moment leaves the
+    cache's record count off, so the next freshness check rescans the zone.
+    """
+    if not os.path.exists(zone_cache_path()):
+        return
+    line = json.dumps({"time": now or time.time(), "changes": changes}) + "\n"
+    # One write to an O_APPEND file, so lines from concurrent writers don't interleave
+    fd = os.open(zone_journal_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+        size = os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+    if size > ZONE_JOURNAL_MAX_BYTES:
+        cache = load_zone_cache()
+        if cache is not None:
+            save_zone_cache(cache)
+
+
+def record_changes(changes):
+    """Apply our own successful change_json()/claim_json() changes to RESERVED and the zone cache.
+
+    Keeps both current without a rescan: the in-memory cache directly, the one
+    on disk through its journal. The cache's record count is adjusted too, so
+    the next freshness check doesn't mistake our changes for someone else's.
+    """
+    now = time.time()
+    with SERVE_LOCK:
+        _record_changes(changes, now)
+    journal_changes(changes, now)
+
+
+def _record_changes(changes, now):
+    for change in changes:
+        name, record = change_record(change)
+        for val in record_ips(name, record):
+            if change["Action"] == "DELETE":
+                remove_reservation(val)
+            else:
+                add_reservation(val, name)
+    RECORDED.extend(changes)
+    if ZONE_CACHE is not None:
+        apply_changes(ZONE_CACHE, changes, now)
+
+
+def change_record(change):
+    """Return (name, record) for a change's record set, as they're kept in the zone cache."""
+    rset = change["ResourceRecordSet"]
+    # Route53 lists '*' as its octal escape
+    name = rset["Name"].replace("*", "\\052")
+    return name, {"Type": rset["Type"], "TTL": rset["TTL"], "Values": [rec["Value"] for rec in rset["ResourceRecords"]]}
+
+
+def apply_changes(cache, changes, now=None):
+    """Apply changes, made at now, to the zone cache (but not RESERVED). Applying them twice changes nothing more."""
+    for change in changes:
+        name, record = change_record(change)
+        if change["Action"] == "DELETE":
+            if cache["records"].pop(name, None) is not None:
+                cache["record_count"] -= 1
+        else:
+            first_seen = now or time.time()
+            if name in cache["records"]:
+                first_seen = cache["records"][name]["FirstSeen"]
+            else:
+                cache["record_count"] += 1
+            record["FirstSeen"] = first_seen
+            cache["records"][name] = record
+
+
+def add_reservation(ip, name):
+    """Record that the IP address string ip has a DNS record called name.
+
+    A cluster's own record names the address in preference to its claim record.
+    """
+    if ip in RESERVED and claim_ip(name):
+        return
+    RESERVED[ip] = name
+    try:
+        ipint = ip_int(ip)
+    except ValueError:
+        return
+    segment = segment_for(ipint)
+    if segment is not None:
+        segment.reserve(ipint, name)
+
+
+def remove_reservation(ip):
+    """Forget that the IP address string ip has a DNS record."""
+    RESERVED.pop(ip, None)
+    try:
+        ipint = ip_int(ip)
+    except ValueError:
+        return
+    segment = segment_for(ipint)
+    if segment is not None:
+        segment.unreserve(ipint)
+
+
+def segment_for(ip):
+    """Return the Segment whose network contains the integer IP, or None."""
+    starts, segments = SEGMENT_INDEX
+    i = bisect.bisect_right(starts, ip) - 1
+    if i >= 0 and ip in segments[i]:
+        return segments[i]
+    return None
+
+
+async def ping(ip, timeout, semaphore):
+    """Return whether ip answers a single ping within timeout seconds; raise PingError if ping can't tell."""
+    import asyncio
+    if sys.platform == "darwin":
+        # BSD ping takes its reply timeout in milliseconds
+        wait = ["-W", str(int(timeout * 1000))]
+    else:
+        wait = ["-W", str(max(1, round(timeout)))]
+    async with semaphore:
+        proc = await asyncio.create_subprocess_exec(
+            "ping", "-c", "1", *wait, ip,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(), timeout + 1)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return False
+    if proc.returncode not in (0, PING_NO_REPLY):
+        raise PingError(f"ping {ip} exited with status {proc.returncode}: {stderr.decode().strip()}")
+    return proc.returncode == 0
+
+
+def sweep(segment, timeout=SWEEP_TIMEOUT, concurrency=SWEEP_CONCURRENCY, window=SWEEP_WINDOW):
+    """Ping the first window available addresses in segment at once; return the set of those that answered.
+
+    Such addresses are in use (e.g. by a leftover VM) even though DNS doesn't
+    say so. They are remembered on the segment, so available() skips them from
+    now on. A window takes about one timeout when concurrency covers it.
+    """
+    candidates = list(itertools.islice(segment.available(), window))
+    debug(f"Sweeping {len(candidates)} addresses in {segment.network}")
+    live = ping_all(candidates, timeout, concurrency)
+    segment.live.update(ip_int(ip) for ip in live)
+    return live
+
+
+def ping_all(ips, timeout=SWEEP_TIMEOUT, concurrency=SWEEP_CONCURRENCY):
+    """Ping all the IP address strings at once; return the set of those that answered.
+
+    Raises PingError if any ping fails for a reason other than getting no reply.
+    """
+    import asyncio
+    ips = list(ips)
+
+    async def probe_all():
+        semaphore = asyncio.Semaphore(concurrency)
+        # Every ping is let finish, so none is left running when one fails
+        return await asyncio.gather(*(ping(ip, timeout, semaphore) for ip in ips), return_exceptions=True)
+
+    answered = asyncio.run(probe_all())
+    for result in answered:
+        if isinstance(result, FileNotFoundError):
+            raise PingError("'ping' was not found in $PATH.")
+        if isinstance(result, Exception):
+            raise result
+    return {ip for ip, up in zip(ips, answered) if up}
+
+
+# Records created for a cluster by reserve_ips(): api.NAME and *.apps.NAME
+CLUSTER_RECORD_RE = re.compile(r"^(?:api|\\052\.apps)\.(?P<cluster>[^.]+)\." + re.escape(VMC_BASE_DOMAIN) + r"\.$")
+
+
+def cluster_records(segments):
+    """Group the cached cluster and claim records whose addresses all lie in segments.
+
+    Returns {cluster name: {record name: record}}, where records are as stored
+    in the zone cache. Must be called after discover_reserved_ips().
+    """
+    segments = set(segments)
+    clusters = dict()
+    for name, rset in ZONE_CACHE["records"].items():
+        match = CLUSTER_RECORD_RE.match(name)
+        if match:
+            cluster = match.group("cluster")
+        elif claim_ip(name):
+            cluster = rset["Values"][0].strip('"')
+        else:
+            continue
+        try:
+            ips = [ip_int(val) for val in record_ips(name, rset)]
+        except ValueError:
+            continue
+        if all(segment_for(ip) in segments for ip in ips):
+            clusters.setdefault(cluster, dict())[name] = rset
+    return clusters
+
+
+def select_stale(clusters, older_than=None, match=None, dead=False):
+    """Return the subset of cluster_records() output that meets every given criterion.
+
+    older_than: seconds since the cluster's newest record was first seen.
+    match: regex searched for in the cluster name.
+    dead: none of the cluster's addresses answer a ping.
+    """
+    now = time.time()
+    stale = dict()
+    for cluster, records in clusters.items():
+        if older_than is not None and now - max(r["FirstSeen"] for r in records.values()) < older_than:
+            continue
+        if match is not None and not re.search(match, cluster):
+            continue
+        stale[cluster] = records
+    if dead and stale:
+        live = ping_all(val for records in stale.values() for name, r in records.items() for val in record_ips(name, r))
+        stale = {cluster: records for cluster, records in stale.items()
+                 if not any(val in live for name, r in records.items() for val in record_ips(name, r))}
+    return stale
+
+
+def delete_changes(records):
+    """The DELETE changes for one cluster's records (a cluster_records() value)."""
+    return [{
+        "Action": "DELETE",
+        "ResourceRecordSet": {
+            "Name": name,
+            "Type": rset.get("Type", "A"),
+            "TTL": rset["TTL"],
+            "ResourceRecords": [{"Value": val} for val in rset["Values"]],
+        },
+    } for name, rset in sorted(records.items())]
+
+
+def delete_batches(clusters):
+    """Generator for lists of cluster names whose DELETE changes fit in one batch, packed into as few batches as Route53 allows.
+
+    A cluster's records always share a batch, so each cluster goes away atomically.
+    """
+    batch, nrecords, nchars = [], 0, 0
+    for cluster in sorted(clusters):
+        records = sum(len(rset["Values"]) for rset in clusters[cluster].values())
+        chars = sum(len(val) for rset in clusters[cluster].values() for val in rset["Values"])
+        if batch and (nrecords + records > MAX_BATCH_RECORDS or nchars + chars > MAX_BATCH_VALUE_CHARS):
+            yield batch
+            batch, nrecords, nchars = [], 0, 0
+        batch.append(cluster)
+        nrecords += records
+        nchars += chars
+    if batch:
+        yield batch
+
+
+def reap(clusters, dry_run=False):
+    """Delete every record of the given clusters (cluster_records() output), printing a diff.
+
+    If Route53 rejects a batch (one of its clusters' records changed since the
+    scan), that batch's clusters are retried one at a time, so the others still go.
+    Returns the number of change_resource_record_sets calls made and the
+    sorted names of the clusters that couldn't be reaped.
+    """
+    from botocore.exceptions import ClientError
+    for cluster in sorted(clusters):
+        for name, rset in sorted(clusters[cluster].items()):
+            for val in record_ips(name, rset):
+                print(f"- {val}\t{name}")
+    if dry_run:
+        return 0, []
+    calls = 0
+    failed = []
+    r53client = get_route53_client()
+
+    def rejected(names):
+        """Delete names' records in one batch; return Route53's message if it rejects the batch."""
+        changes = [change for cluster in names for change in delete_changes(clusters[cluster])]
+        try:
+            r53client.change_resource_record_sets(
+                HostedZoneId=HOSTED_ZONE_ID,
+                ChangeBatch={
+                "Comment": f"Reap {len(changes)} stale DNS records in domain '{VMC_BASE_DOMAIN}'.",
+                "Changes": changes,
+            })
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "InvalidChangeBatch":
+                raise
+            return e.response["Error"]["Message"]
+        record_changes(changes)
+        return None
+
+    for names in delete_batches(clusters):
+        calls += 1
+        error = rejected(names)
+        if error and len(names) > 1:
+            debug(f"Batch of {len(names)} clusters rejected, reaping them one at a time")
+            for cluster in names:
+                calls += 1
+                error = rejected([cluster])
+                if error:
+                    print(f"Could not reap {cluster}: {error}", file=sys.stderr)
+                    failed.append(cluster)
+        elif error:
+            print(f"Could not reap {names[0]}: {error}", file=sys.stderr)
+            failed.extend(names)
+    return calls, sorted(failed)
+
+
+class Route53Client:
+    """A boto3 Route53 client that paces itself, backs off when throttled, and coalesces changes.
+
+    Every call goes through _call(): calls are spaced to the current rate,
+    shared by all threads, and one failing with a ROUTE53_RETRY_CODES or
+    ROUTE53_TRANSIENT_CODES error, any other 5xx, or a connection or read error
+    is retried after an exponential backoff with full jitter, for up to
+    ROUTE53_RETRY_SECONDS. The rate halves on each throttle and climbs back
+    towards ROUTE53_RATE as calls succeed, so processes sharing the account's
+    limit settle around their share of it instead of failing.
+
+    change_resource_record_sets() calls made from several threads at once are
+    coalesced: while one batch is in flight the others queue up, and then go
+    out together as a single ChangeBatch, within Route53's limits. If Route53
+    rejects a coalesced batch, each request is resent on its own, so one
+    request's conflict never sinks another's.
+
+    stats counts calls, throttles, retries, requests that gave up, and change
+    requests that shared a batch. Other client attributes pass straight through.
+    """
+    def __init__(self, client, rate=ROUTE53_RATE):
+        self.client = client
+        self.max_rate = rate
+        self.rate = rate
+        self.next_slot = 0
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.queue = []
+        self.stats = {"calls": 0, "throttles": 0, "retries": 0, "failures": 0, "coalesced": 0}
+
+    def __getattr__(self, name):
+        if name == "client":
+            raise AttributeError(name)
+        attr = getattr(self.client, name)
+        if name not in self.client.meta.method_to_api_mapping:
+            return attr
+        return lambda **kwargs: self._call(name, **kwargs)
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+    def _wait_turn(self):
+        """Sleep until this thread's slot under the current rate."""
+        with self.lock:
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + 1 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def _call(self, operation, **kwargs):
+        from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+        give_up = time.monotonic() + ROUTE53_RETRY_SECONDS
+        for attempt in itertools.count():
+            self._wait_turn()
+            self._count("calls")
+            try:
+                response = getattr(self.client, operation)(**kwargs)
+            except (ClientError, ConnectionError, HTTPClientError) as e:
+                if isinstance(e, ClientError):
+                    reason = e.response["Error"]["Code"]
+                    status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+                    if reason in ROUTE53_RETRY_CODES:
+                        self._count("throttles")
+                        with self.lock:
+                            if self.rate is not None:
+                                self.rate = max(ROUTE53_MIN_RATE, self.rate / 2)
+                    elif reason not in ROUTE53_TRANSIENT_CODES and status < 500:
+                        raise
+                else:
+                    reason = type(e).__name__
+                import random
+                delay = random.uniform(0, min(ROUTE53_MAX_BACKOFF_SECONDS, ROUTE53_BACKOFF_SECONDS * 2 ** attempt))
+                if time.monotonic() + delay > give_up:
+                    self._count("failures")
+                    raise
+                debug(f"Route53 {operation}: {reason}, retrying in {delay:.2f}s")
+                self._count("retries")
+                time.sleep(delay)
+                continue
+            with self.lock:
+                if self.rate is not None:
+                    self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+            return response
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        request = {"zone": HostedZoneId, "batch": ChangeBatch, "done": False}
+        with self.lock:
+            self.queue.append(request)
+        # Whoever gets the send lock sends everything queued so far, including
+        # requests whose threads are still waiting for the lock.
+        with self.send_lock:
+            if not request["done"]:
+                with self.lock:
+                    requests, self.queue = self.queue, []
+                self._send_changes(requests)
+        if "error" in request:
+            raise request["error"]
+        return request["response"]
+
+    def _send_changes(self, requests):
+        batches = []
+        for request in requests:
+            for batch in batches:
+                if batch_fits(batch, request):
+                    batch.append(request)
+                    break
+            else:
+                batches.append([request])
+        for batch in batches:
+            try:
+                if len(batch) == 1:
+                    self._send_alone(batch[0])
+                else:
+                    self._send_together(batch)
+            finally:
+                for request in batch:
+                    request["done"] = True
+
+    def _send_alone(self, request):
+        try:
+            request["response"] = self._call("change_resource_record_sets", HostedZoneId=request["zone"], ChangeBatch=request["batch"])
+        except Exception as e:
+            request["error"] = e
+
+    def _send_together(self, batch):
+        from botocore.exceptions import ClientError
+        comments = "; ".join(request["batch"].get("Comment", "") for request in batch)
+        try:
+            response = self._call("change_resource_record_sets", HostedZoneId=batch[0]["zone"], ChangeBatch={
+                # Route53 allows 256 characters of comment
+                "Comment": f"{len(batch)} coalesced changes: {comments}"[:256],
+                "Changes": [change for request in batch for change in request["batch"]["Changes"]],
+            })
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "InvalidChangeBatch":
+                for request in batch:
+                    request["error"] = e
+                return
+            debug(f"Coalesced batch of {len(batch)} rejected, sending them one at a time")
+            for request in batch:
+                self._send_alone(request)
+            return
+        except Exception as e:
+            for request in batch:
+                request["error"] = e
+            return
+        self._count("coalesced", len(batch))
+        for request in batch:
+            request["response"] = response
+
+
+def batch_fits(batch, request):
+    """Whether request's changes can join the queued requests in batch in one ChangeBatch.
+
+    Route53 limits a batch's records and characters, and rejects one that
+    changes the same record twice.
+    """
+    if batch[0]["zone"] != request["zone"]:
+        return False
+    changes = [change for r in batch + [request] for change in r["batch"]["Changes"]]
+    values = [rec["Value"] for c in changes for rec in c["ResourceRecordSet"].get("ResourceRecords", [])]
+    keys = {(c["ResourceRecordSet"]["Name"], c["ResourceRecordSet"]["Type"]) for c in changes}
+    return (len(values) <= MAX_BATCH_RECORDS and sum(len(v) for v in values) <= MAX_BATCH_VALUE_CHARS
+            and len(keys) == len(changes))
+
 
 def get_route53_client():
     global R53CLIENT
     if R53CLIENT is None:
-        R53CLIENT = boto3.client("route53")
+        import boto3
+        from botocore.config import Config
+        # Route53Client does the retrying, so it can pace and count it
+        R53CLIENT = Route53Client(boto3.client("route53", config=Config(retries={"total_max_attempts": 1})), rate=ROUTE53_RATE)
     return R53CLIENT
 
+
+def print_route53_stats():
+    """Say how much throttling this process ran into, if any (or always, with --debug)."""
+    if R53CLIENT is None:
+        return
+    stats = R53CLIENT.stats
+    line = (f"Route53: {stats['calls']} calls, {stats['throttles']} throttled, {stats['retries']} retried, "
+            f"{stats['failures']} gave up, {stats['coalesced']} changes coalesced")
+    if stats["throttles"]:
+        print(line, file=sys.stderr)
+    else:
+        debug(line)
+
 class Creds:
     def __init__(self):
         self.username = "YOUR_USERNAME_HERE"
@@ -175,87 +1157,523 @@ sshKey: |
 def print_install_config(vips, segname, cluster_name=None, creds=Creds()):
     print(get_install_config(vips, segname, cluster_name, creds))
 
+def existing_claims(ips, cluster_name):
+    """Return DELETE changes for whichever of the ips have a claim record in the zone held by cluster_name.
+
+    Asks Route53 directly rather than trusting the cache, since a DELETE of a
+    record that isn't there would sink the whole batch. Claims held by another
+    cluster are left alone.
+    """
+    r53client = get_route53_client()
+    changes = []
+    for ip in ips:
+        res = r53client.list_resource_record_sets(
+            HostedZoneId=HOSTED_ZONE_ID, StartRecordName=claim_name(ip), StartRecordType="TXT", MaxItems="1")
+        for rset in res["ResourceRecordSets"]:
+            if (rset["Name"] == claim_name(ip) and rset["Type"] == "TXT"
+                    and [rec["Value"] for rec in rset["ResourceRecords"]] == [f'"{cluster_name}"']):
+                changes.append({"Action": "DELETE", "ResourceRecordSet": rset})
+    return changes
+
+
+def changes_applied(changes):
+    """Whether every record set CREATEd by changes is in the zone already, with the same values.
+
+    Asks Route53 directly, like existing_claims().
+    """
+    r53client = get_route53_client()
+    for change in changes:
+        want = change["ResourceRecordSet"]
+        res = r53client.list_resource_record_sets(
+            HostedZoneId=HOSTED_ZONE_ID, StartRecordName=want["Name"], StartRecordType=want["Type"], MaxItems="1")
+        found = [rset for rset in res["ResourceRecordSets"]
+                 if rset["Name"].replace("\\052", "*") == want["Name"] and rset["Type"] == want["Type"]]
+        if not found or sorted(rec["Value"] for rec in found[0]["ResourceRecords"]) != sorted(rec["Value"] for rec in want["ResourceRecords"]):
+            return False
+    return True
+
+
 def release_ips(api_vip, ingress_vip, cluster_name):
     print(f"Releasing IPs for API ({api_vip}) and ingress ({ingress_vip})...", file=sys.stderr)
     r53client = get_route53_client()
+    changes = [
+        change_json("DELETE", "API", cluster_name, api_vip),
+        change_json("DELETE", "INGRESS", cluster_name, ingress_vip),
+    ] + existing_claims([api_vip, ingress_vip], cluster_name)
     r53client.change_resource_record_sets(
         HostedZoneId=HOSTED_ZONE_ID,
         ChangeBatch={
         "Comment": f"DELETE DNS records for cluster '{cluster_name}' in domain '{VMC_BASE_DOMAIN}'.",
-        "Changes": [
-            change_json("DELETE", "API", cluster_name, api_vip),
-            change_json("DELETE", "INGRESS", cluster_name, ingress_vip),
-        ],
+        "Changes": changes,
     })
+    record_changes(changes)
 
 
 def reserve_ips(two_ips, cluster_name):
+    """Reserve two_ips (API, ingress) for cluster_name, or raise Conflict if any of them is taken.
+
+    Creates the cluster's records and a claim record per address in one batch,
+    so either all of them are created or none are. If Route53 says they all
+    exist already, holding these IPs, an earlier attempt at this very batch
+    (e.g. one that timed out and was retried) went through, which is success.
+    """
     print(f"Reserving IPs for API ({two_ips[0]}) and ingress ({two_ips[1]})...", file=sys.stderr)
     r53client = get_route53_client()
-    r53client.change_resource_record_sets(
-        HostedZoneId=HOSTED_ZONE_ID,
-        ChangeBatch={
-        "Comment": f"UPSERT DNS records for cluster '{cluster_name}' in domain '{VMC_BASE_DOMAIN}'.",
-        "Changes": [
-            change_json("UPSERT", "API", cluster_name, two_ips[0]),
-            change_json("UPSERT", "INGRESS", cluster_name, two_ips[1]),
-        ],
-    })
+    from botocore.exceptions import ClientError
+    changes = [
+        change_json("CREATE", "API", cluster_name, two_ips[0]),
+        change_json("CREATE", "INGRESS", cluster_name, two_ips[1]),
+        claim_json("CREATE", two_ips[0], cluster_name),
+        claim_json("CREATE", two_ips[1], cluster_name),
+    ]
+    try:
+        r53client.change_resource_record_sets(
+            HostedZoneId=HOSTED_ZONE_ID,
+            ChangeBatch={
+            "Comment": f"CREATE DNS records for cluster '{cluster_name}' in domain '{VMC_BASE_DOMAIN}'.",
+            "Changes": changes,
+        })
+    except ClientError as e:
+        if e.response['Error']['Code'] != "InvalidChangeBatch":
+            raise
+        # e.g. "[Tried to create resource record set [name='...', type='TXT'] but it already exists]";
+        # anything else is a problem with the batch itself, not a lost race
+        names = re.findall(r"name='([^']+)', type='[^']+'\] but it already exists", e.response['Error']['Message'])
+        if not names:
+            raise
+        # Only our own cluster records being in the way (not just claims, as in a
+        # lost race) can mean this is a retry of a batch that went through
+        named = {name.replace("\\052", "*") for name in names}
+        ours = {change["ResourceRecordSet"]["Name"] for change in changes}
+        if named <= ours and not all(claim_ip(name) for name in named) and changes_applied(changes):
+            # A retry of our own batch, which went through before the first attempt timed out
+            debug(f"Records for cluster '{cluster_name}' were already created by an earlier attempt")
+            record_changes(changes)
+            return
+        ips = [claim_ip(name) for name in names if claim_ip(name)]
+        if len(ips) < len(names):
+            raise Conflict(f"Records for cluster '{cluster_name}' already exist: {e.response['Error']['Message']}", ips, cluster_exists=True)
+        raise Conflict(f"Already claimed: {', '.join(ips)}", ips)
+    record_changes(changes)
 
 
-PARSER = argparse.ArgumentParser(
-    prog="vmcdns.py",
-    description="Query IPs in the AWS Route53 hosted zone for the DEVQE VMC. "+
-        "NOTE: Make sure $AWS_PROFILE points to your creds for that account.",
-)
-PARSER.add_argument("--debug", action="store_true", help="Print debug output.")
+def allocate_ips(segment, cluster_name, start="hash", attempts=None, avoid=(), sweep=False):
+    """Pick and reserve two available IPs in segment for cluster_name; return them, or None if the segment is full.
 
-subparsers = PARSER.add_subparsers(dest="subcommand")
+    Safe to run from many places at once: when another caller claims one of our
+    candidates first, those addresses are marked taken and the search jumps to
+    a random spot, away from the callers crowding the one it lost at (who are
+    likely to have taken the adjacent addresses too). attempts defaults to
+    one per free pair of addresses, and at least ALLOCATE_ATTEMPTS, so a
+    segment with room rarely runs out. Threads of one process don't pick the
+    same candidates, since they're held until their reservation goes through.
+    start chooses where in
+    the segment the search begins (see Segment.start_for()), and the integer
+    IPs in avoid are never picked. With sweep, the candidates are pinged
+    before being reserved, and any that answer are skipped; see pick_unused().
+    Raises Conflict if the cluster's records already exist or attempts run out.
+    """
+    if attempts is None:
+        with SERVE_LOCK:
+            attempts = max(ALLOCATE_ATTEMPTS, segment.free() // 2)
+    begin = segment.start_for(start, cluster_name)
+    for attempt in range(attempts):
+        with SERVE_LOCK:
+            candidates = list(itertools.islice(segment.available(begin, skip=avoid), 2))
+            if len(candidates) < 2:
+                return None
+            held = {ip_int(ip) for ip in candidates}
+            segment.held |= held
+        try:
+            if sweep and pick_unused(segment, candidates) != candidates:
+                continue
+            reserve_ips(candidates, cluster_name)
+            return candidates
+        except Conflict as e:
+            if e.cluster_exists:
+                raise
+            debug(f"Lost the race for {', '.join(e.ips)}; trying again elsewhere")
+            with SERVE_LOCK:
+                for ip in e.ips:
+                    add_reservation(ip, claim_name(ip))
+            begin = segment.start_for("random", cluster_name)
+        finally:
+            with SERVE_LOCK:
+                segment.held -= held
+    raise Conflict(f"Could not reserve IPs for '{cluster_name}' after {attempts} attempts")
 
-network_arg = "--network"
-network_kwargs = dict(choices=list(SEGMENTS_BY_NAME.keys()), help="The network segment to query.")
 
-parser_available = subparsers.add_parser("available", help="List (N) available IP addresses in a network segment.")
-parser_available.add_argument(network_arg, **network_kwargs, required=True)
-parser_available.add_argument("--count", metavar="N", type=int, help="Limit the output to N results.")
+def pick_unused(segment, candidates):
+    """Ping the IP address strings candidates, all in segment; return those that didn't answer.
 
-parser_reserved = subparsers.add_parser("reserved", help="List reserved IP addresses (in a network segment).")
-parser_reserved.add_argument(network_arg, **network_kwargs)
+    One that answers is in use (e.g. by a leftover VM) even though DNS doesn't
+    say so. It's remembered on the segment, so available() skips it from now on.
+    Only the addresses actually being considered are pinged, which takes about
+    one SWEEP_TIMEOUT however big the segment is.
+    """
+    live = ping_all(candidates)
+    if live:
+        print(f"WARNING: these addresses in {segment.name} answer pings but have no DNS record: {', '.join(sorted(live))}", file=sys.stderr)
+        with SERVE_LOCK:
+            segment.live.update(ip_int(ip) for ip in live)
+    return [ip for ip in candidates if ip not in live]
 
-parser_installconfig = subparsers.add_parser("install-config", help="Generate networky chunks of install-config.yaml, and optionally reserve IPs.")
-mutexgrp = parser_installconfig.add_mutually_exclusive_group()
-mutexgrp.add_argument(network_arg, **network_kwargs)
-mutexgrp.add_argument("--disconnected", action="store_true", help="Use a disconnected segment (a public segment will be used by default).")
-parser_installconfig.add_argument("--reserve", metavar="CLUSTER_NAME", help=f"Automatically reserve the discovered IPs for the named cluster in base domain {VMC_BASE_DOMAIN}.")
 
-parser_release = subparsers.add_parser("release", help="Release IP addresses.")
-parser_release.add_argument("--api-vip", required=True, help="The IP address for api.")
-parser_release.add_argument("--ingress-vip", required=True, help="The IP address for *.apps.")
-parser_release.add_argument("--cluster-name", required=True, help=f"Base name of the cluster currently owning the IPs (in domain '{VMC_BASE_DOMAIN}').")
+def refresh_index(refresh=False):
+    """Bring the server's index up to date with the zone, rebuilding it only if the zone has changed.
 
-if __name__ == "__main__":
-    ARGS = PARSER.parse_args()
+    Unlike discover_reserved_ips(), drops reservations that have gone away, as a
+    long-running server must. Returns whether the index was rebuilt.
+    """
+    global ZONE_CACHE
+    with SERVE_LOCK:
+        seen = len(RECORDED)
+    cache = current_zone(refresh)
+    with SERVE_LOCK:
+        # The copy was read without the lock, so it may predate changes requests
+        # recorded meanwhile; put them back rather than lose them from the index
+        missed = RECORDED[seen:]
+        del RECORDED[:]
+        if missed:
+            debug(f"Reapplying {len(missed)} changes made while the zone was read")
+            apply_changes(cache, missed)
+        rebuilt = ZONE_CACHE is None or cache["records"] != ZONE_CACHE["records"]
+        if rebuilt:
+            clear_reservations()
+            index_zone(cache)
+        ZONE_CACHE = cache
+    if missed:
+        # A rescan's save may have dropped them from the journal too
+        journal_changes(missed)
+    return rebuilt
+
+
+def refresh_forever(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            if refresh_index():
+                debug("Rebuilt index from zone fetched at %s" % time.ctime(ZONE_CACHE["fetched"]))
+        except Exception as e:
+            print(f"WARNING: couldn't refresh the zone: {e}", file=sys.stderr)
+
+
+def handle_request(method, path, query, body):
+    """Answer one request to the server; return (HTTP status, JSON-able reply).
+
+    GET  /status                          zone freshness and Route53Client.stats
+    GET  /available?network=N&count=C     like `vmcdns.py available`; C defaults to AVAILABLE_COUNT
+    GET  /reserved[?network=N]            like `vmcdns.py reserved`, as {segment: [[IP, name], ...]}
+    POST /reserve {cluster_name, networks, start, avoid, dry_run, sweep}
+         reserves two IPs in the first of networks that has them, never
+         picking those in avoid; dry_run only picks them, and sweep pings
+         them first. 409 on a Conflict, 503 on a PingError.
+    POST /release {api_vip, ingress_vip, cluster_name}
+    """
+    if method == "GET" and path == "/status":
+        return 200, {"fetched": ZONE_CACHE["fetched"], "checked": ZONE_CACHE["checked"], "reserved": len(RESERVED),
+                     "route53": get_route53_client().stats}
+    if method == "GET" and path == "/available":
+        segment = SEGMENTS_BY_NAME.get(query.get("network"))
+        if segment is None:
+            return 400, {"error": f"unknown network {query.get('network')!r}"}
+        with SERVE_LOCK:
+            return 200, {"ips": list(itertools.islice(segment.available(), int(query.get("count", AVAILABLE_COUNT))))}
+    if method == "GET" and path == "/reserved":
+        names = [query["network"]] if "network" in query else list(SEGMENTS_BY_NAME)
+        with SERVE_LOCK:
+            return 200, {name: [line.split("\t") for line in SEGMENTS_BY_NAME[name].reserved_str()] for name in names}
+    if method == "POST" and path == "/reserve":
+        try:
+            ips, network = reserve_in_networks(body["cluster_name"], body["networks"], body.get("start", "hash"),
+                                               body.get("avoid", ()), body.get("dry_run", False), body.get("sweep", False))
+        except Conflict as e:
+            return 409, {"error": str(e), "ips": e.ips, "cluster_exists": e.cluster_exists}
+        except PingError as e:
+            return 503, {"error": str(e), "ping_error": True}
+        return 200, {"ips": ips, "network": network}
+    if method == "POST" and path == "/release":
+        release_ips(body["api_vip"], body["ingress_vip"], body["cluster_name"])
+        return 200, {}
+    return 404, {"error": f"no such request: {method} {path}"}
+
+
+def reserve_in_networks(cluster_name, networks, start="hash", avoid=(), dry_run=False, sweep=False):
+    """Reserve two IPs for cluster_name in the first of networks that has them; return (IPs, network) or (None, None).
+
+    Addresses in avoid (e.g. already picked by the caller) are skipped for
+    this allocation only. With dry_run, the IPs are only picked. With sweep,
+    candidates that answer a ping are passed over.
+    """
+    avoid = {ip_int(ip) for ip in avoid}
+    for name in networks:
+        segment = SEGMENTS_BY_NAME[name]
+        if dry_run:
+            begin = segment.start_for(start, cluster_name)
+            for attempt in range(ALLOCATE_ATTEMPTS):
+                with SERVE_LOCK:
+                    ips = list(itertools.islice(segment.available(begin, skip=avoid), 2))
+                if len(ips) < 2 or not sweep or pick_unused(segment, ips) == ips:
+                    break
+            else:
+                ips = None
+        else:
+            ips = allocate_ips(segment, cluster_name, start=start, avoid=avoid, sweep=sweep)
+        if ips and len(ips) == 2:
+            return ips, name
+    return None, None
+
+
+def is_loopback(host):
+    """Whether host (a name or IP address) is this machine's loopback interface."""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def serve(address=SERVER_ADDRESS, interval=SERVE_REFRESH_SECONDS, refresh=False):
+    """Answer handle_request()s over HTTP on address (a UNIX socket path or http://127.0.0.1:PORT) until killed.
+
+    The zone is indexed once up front and checked for changes every interval
+    seconds in the background, so requests are answered from memory, and the
+    one Route53 client (with its connection pool) is reused across requests.
+    Requests aren't authenticated, so only this machine may connect: an HTTP
+    address must be a loopback one, and the socket is readable only by us.
+    """
+    import http.server
+    import signal
+    import socketserver
+    import urllib.parse
+
+    if address.startswith("http://") and not is_loopback(urllib.parse.urlsplit(address).hostname):
+        print(f"Refusing to serve on {urllib.parse.urlsplit(address).hostname}: anyone who can reach it could reserve "
+              "and release IPs. Use a loopback address such as 127.0.0.1.", file=sys.stderr)
+        sys.exit(-1)
+    refresh_index(refresh)
+    # Exit through the finally below, which removes the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    threading.Thread(target=refresh_forever, args=(interval,), daemon=True).start()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def handle_one(self, method):
+            url = urllib.parse.urlsplit(self.path)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            body = None
+            if method == "POST":
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "{}")
+            try:
+                status, reply = handle_request(method, url.path, query, body)
+            except Exception as e:
+                status, reply = 500, {"error": f"{type(e).__name__}: {e}"}
+            data = json.dumps(reply).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self.handle_one("GET")
+
+        def do_POST(self):
+            self.handle_one("POST")
+
+        def log_message(self, format, *args):
+            debug("serve: " + format % args)
+
+    if address.startswith("http://"):
+        url = urllib.parse.urlsplit(address)
+        server = http.server.ThreadingHTTPServer((url.hostname, url.port), Handler)
+    else:
+        if server_request("GET", "/status") is not None:
+            print(f"A server is already listening on {address}.", file=sys.stderr)
+            sys.exit(1)
+        if os.path.exists(address):
+            os.unlink(address)
+        os.makedirs(os.path.dirname(address), exist_ok=True)
+
+        class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        # Only we may connect: the socket is created 0600, rather than chmod'ed after
+        umask = os.umask(0o177)
+        try:
+            server = UnixServer(address, Handler)
+        finally:
+            os.umask(umask)
+    print(f"Serving {len(RESERVED)} reservations on {address}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if not address.startswith("http://"):
+            os.unlink(address)
+
+
+def server_request(method, path, body=None, timeout=60):
+    """Send a request to the `vmcdns.py serve` at SERVER_ADDRESS; return its reply, or None if none is running.
+
+    Raises Conflict for a 409, PingError when the server couldn't ping, and
+    RuntimeError for any other error reply.
+    """
+    if not SERVER_ADDRESS.startswith("http://") and not os.path.exists(SERVER_ADDRESS):
+        return None
+    import http.client
+    import socket
+    import urllib.parse
+
+    class UnixHTTPConnection(http.client.HTTPConnection):
+        def connect(self):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(SERVER_ADDRESS)
+
+    if SERVER_ADDRESS.startswith("http://"):
+        conn = http.client.HTTPConnection(urllib.parse.urlsplit(SERVER_ADDRESS).netloc, timeout=timeout)
+    else:
+        conn = UnixHTTPConnection("localhost", timeout=timeout)
+    try:
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+        res = conn.getresponse()
+        reply = json.loads(res.read())
+    except OSError:
+        # Nothing listening (e.g. a socket left behind by a server that died)
+        return None
+    finally:
+        conn.close()
+    if res.status == 409:
+        raise Conflict(reply["error"], reply["ips"], reply["cluster_exists"])
+    if reply.get("ping_error"):
+        raise PingError(reply["error"])
+    if res.status != 200:
+        raise RuntimeError(f"vmcdns server: {reply['error']}")
+    return reply
+
+
+def available_ips(network, count=AVAILABLE_COUNT, server=False):
+    """Return the first count available IP address strings in the named segment, asking the running server if server."""
+    if server:
+        return server_request("GET", f"/available?network={network}&count={count}")["ips"]
+    return list(itertools.islice(SEGMENTS_BY_NAME[network].available(), count))
+
+
+def find_ips(cluster_name, networks, start="hash", avoid=(), dry_run=False, sweep=False, server=False):
+    """reserve_in_networks(), done by the running server if server."""
+    if server:
+        reply = server_request("POST", "/reserve", dict(cluster_name=cluster_name, networks=networks, start=start,
+                                                         avoid=sorted(avoid), dry_run=dry_run, sweep=sweep))
+        return reply["ips"], reply["network"]
+    return reserve_in_networks(cluster_name, networks, start, avoid, dry_run, sweep)
+
+
+def build_parser():
+    """Return the command line parser. Built on demand, so importing this module stays cheap."""
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="vmcdns.py",
+        description="Query IPs in the AWS Route53 hosted zone for the DEVQE VMC. "+
+            "NOTE: Make sure $AWS_PROFILE points to your creds for that account.",
+    )
+    parser.add_argument("--debug", action="store_true", help="Print debug output.")
+    cachegrp = parser.add_mutually_exclusive_group()
+    cachegrp.add_argument("--refresh", action="store_true", help="Ignore the local cache of the hosted zone and rescan it.")
+    cachegrp.add_argument("--offline", action="store_true", help="Use the local cache of the hosted zone without contacting AWS, however old it is.")
+    parser.add_argument("--no-server", dest="no_server", action="store_true", help="Don't use a running 'vmcdns.py serve', even if there is one.")
+    parser.add_argument("--server", metavar="ADDRESS", help=f"Where 'vmcdns.py serve' listens: a UNIX socket path or http://127.0.0.1:PORT (default $VMCDNS_SERVER or {SERVER_ADDRESS}).")
+
+    subparsers = parser.add_subparsers(dest="subcommand")
+
+    network_arg = "--network"
+    network_kwargs = dict(choices=list(SEGMENTS_BY_NAME.keys()), help="The network segment to query.")
+
+    parser_available = subparsers.add_parser("available", help="List (N) available IP addresses in a network segment.")
+    parser_available.add_argument(network_arg, **network_kwargs, required=True)
+    parser_available.add_argument("--count", metavar="N", type=int, default=AVAILABLE_COUNT, help=f"List the first N available addresses (default {AVAILABLE_COUNT}).")
+    parser_available.add_argument("--sweep", action="store_true", help="Ping those addresses and leave out the ones that answer.")
+
+    parser_reserved = subparsers.add_parser("reserved", help="List reserved IP addresses (in a network segment).")
+    parser_reserved.add_argument(network_arg, **network_kwargs)
+
+    parser_installconfig = subparsers.add_parser("install-config", help="Generate networky chunks of install-config.yaml, and optionally reserve IPs.")
+    mutexgrp = parser_installconfig.add_mutually_exclusive_group()
+    mutexgrp.add_argument(network_arg, **network_kwargs)
+    mutexgrp.add_argument("--disconnected", action="store_true", help="Use a disconnected segment (a public segment will be used by default).")
+    parser_installconfig.add_argument("--reserve", metavar="CLUSTER_NAME", help=f"Automatically reserve the discovered IPs for the named cluster in base domain {VMC_BASE_DOMAIN}.")
+    parser_installconfig.add_argument("--sweep", action="store_true", help="Ping the IPs picked and pass over any that answer.")
+    parser_installconfig.add_argument("--start", choices=["first", "random", "hash"], default="hash", help="Where in the segment to start looking for IPs to reserve: the bottom, a random spot, or a spot derived from the cluster name (the default). The last two make collisions between concurrent reservations less likely.")
+
+    parser_sweep = subparsers.add_parser("sweep", help="List addresses among the first available ones in a network segment that answer pings but have no DNS record.")
+    parser_sweep.add_argument(network_arg, **network_kwargs, required=True)
+    parser_sweep.add_argument("--timeout", type=float, default=SWEEP_TIMEOUT, help=f"Seconds to wait for each reply (default {SWEEP_TIMEOUT}).")
+    parser_sweep.add_argument("--concurrency", type=int, default=SWEEP_CONCURRENCY, help=f"Pings in flight at once (default {SWEEP_CONCURRENCY}).")
+    parser_sweep.add_argument("--window", metavar="N", type=int, default=SWEEP_WINDOW, help=f"Ping the first N available addresses (default {SWEEP_WINDOW}).")
+
+    parser_reap = subparsers.add_parser("reap", help="Release the IP addresses of stale clusters in bulk.")
+    parser_reap.add_argument(network_arg, **dict(network_kwargs, help="Only reap clusters in this network segment (default: all known segments)."))
+    parser_reap.add_argument("--older-than", metavar="DAYS", type=float, help="Select clusters whose records were first seen more than DAYS ago. NOTE: Route53 doesn't record creation times, so this counts from when vmcdns.py first saw the records.")
+    parser_reap.add_argument("--match", metavar="REGEX", help="Select clusters whose name matches REGEX.")
+    parser_reap.add_argument("--dead", action="store_true", help="Select clusters none of whose IP addresses answer a ping.")
+    parser_reap.add_argument("--dry-run", dest="dry_run", action="store_true", help="Show what would be deleted without deleting it.")
+
+    parser_serve = subparsers.add_parser("serve", help="Keep the zone indexed in memory and answer the other subcommands' requests from it, until killed. The other subcommands (and new_hub.py) use the server automatically when it's running.")
+    parser_serve.add_argument("--interval", type=float, default=SERVE_REFRESH_SECONDS, help=f"Seconds between checks for changes to the zone (default {SERVE_REFRESH_SECONDS}).")
+
+    parser_release = subparsers.add_parser("release", help="Release IP addresses.")
+    parser_release.add_argument("--api-vip", required=True, help="The IP address for api.")
+    parser_release.add_argument("--ingress-vip", required=True, help="The IP address for *.apps.")
+    parser_release.add_argument("--cluster-name", required=True, help=f"Base name of the cluster currently owning the IPs (in domain '{VMC_BASE_DOMAIN}').")
+    return parser
+
+
+def main():
+    global ARGS, SERVER_ADDRESS
+    ARGS = build_parser().parse_args()
     if not ARGS.subcommand:
         print("Subcommand required. Use --help for usage.", file=sys.stderr)
         sys.exit(-1)
+    if ARGS.server:
+        SERVER_ADDRESS = ARGS.server
 
-    if ARGS.subcommand != "release":
-        discover_reserved_ips()
+    if ARGS.subcommand == "serve":
+        serve(SERVER_ADDRESS, interval=ARGS.interval, refresh=ARGS.refresh)
+        return
+
+    # A running server already has the zone in memory, so let it answer if it can.
+    server = False
+    if ARGS.subcommand in ("available", "reserved", "install-config", "release") and not (ARGS.no_server or ARGS.refresh or ARGS.offline):
+        server = server_request("GET", "/status", timeout=5) is not None
+        if server:
+            debug(f"Using the server at {SERVER_ADDRESS}")
+    if ARGS.subcommand == "reap" and ARGS.offline and not ARGS.dry_run:
+        print("reap deletes records, so it needs a fresh copy of the zone: drop --offline, or add --dry-run.", file=sys.stderr)
+        sys.exit(-1)
+    if not server and ARGS.subcommand != "release":
+        # reap deletes what the zone says, so it never trusts the cache; see current_zone()
+        discover_reserved_ips(refresh=ARGS.refresh or (ARGS.subcommand == "reap" and not ARGS.offline), offline=ARGS.offline)
 
     if ARGS.subcommand == "available":
-        iteravail = SEGMENTS_BY_NAME[ARGS.network].available()
-        if ARGS.count:
-            # TODO: make use of the generator rather than constructing the whole list
-            print("\n".join(list(iteravail)[:ARGS.count]))
-        else:
-            print("\n".join(iteravail))
+        iteravail = available_ips(ARGS.network, ARGS.count, server)
+        if ARGS.sweep:
+            live = ping_all(iteravail)
+            iteravail = [ip for ip in iteravail if ip not in live]
+        print("\n".join(iteravail))
     elif ARGS.subcommand == "reserved":
+        if server:
+            reserved = server_request("GET", f"/reserved?network={ARGS.network}" if ARGS.network else "/reserved")
+        else:
+            reserved = {name: [line.split("\t") for line in segment.reserved_str()] for name, segment in SEGMENTS_BY_NAME.items()}
         if ARGS.network:
-            print("\n".join(SEGMENTS_BY_NAME[ARGS.network].reserved_str()))
+            print("\n".join("\t".join(entry) for entry in reserved[ARGS.network]))
         else:
-            for name, segment in SEGMENTS_BY_NAME.items():
+            for name in SEGMENTS_BY_NAME:
                 print("\n%s:" % name)
-                print("\n".join(segment.reserved_str()))
+                print("\n".join("\t".join(entry) for entry in reserved[name]))
     elif ARGS.subcommand == "install-config":
         if ARGS.network:
             networks = [ARGS.network]
@@ -263,20 +1681,54 @@ if __name__ == "__main__":
             networks = [segname for segname in SEGMENTS_BY_NAME.keys() if "-disconnected" in segname]
         else:
             networks = [segname for segname in SEGMENTS_BY_NAME.keys() if "-disconnected" not in segname]
-        for segname in networks:
-            avail = list(SEGMENTS_BY_NAME[segname].available())
-            if len(avail) < 2:
-                debug("Skipping segment %s: it doesn't have two available IPs")
-                continue
+        try:
+            avail, segname = find_ips(ARGS.reserve or "", networks, start=ARGS.start, dry_run=not ARGS.reserve, sweep=ARGS.sweep, server=server)
+        except Conflict as e:
+            print(f"ERROR: {e}", file=sys.stderr)
+            sys.exit(1)
+        if not avail:
+            print("Could not find any networks with two available IPs!", file=sys.stderr)
+        else:
             if ARGS.reserve:
-                reserve_ips(avail[:2], ARGS.reserve)
                 print(f"Need to reserve {avail[:2]} for {ARGS.reserve}")
             print_install_config(avail[:2], segname, ARGS.reserve if ARGS.reserve else None)
             if ARGS.reserve:
                 print("\nYour IP addresses have been reserved in the AWS hosted zone!", file=sys.stderr)
             else:
                 print("\nYour IPs are not reserved! You may wish to run this command again with '--reserve your-cluster-name'", file=sys.stderr)
-            sys.exit(0)
-        print("Could not find any networks with two available IPs!", file=sys.stderr)
+    elif ARGS.subcommand == "sweep":
+        live = sweep(SEGMENTS_BY_NAME[ARGS.network], timeout=ARGS.timeout, concurrency=ARGS.concurrency, window=ARGS.window)
+        print("\n".join(sorted(live, key=lambda ip: ip_int(ip))))
+    elif ARGS.subcommand == "reap":
+        if ARGS.older_than is None and ARGS.match is None and not ARGS.dead:
+            print("Refusing to reap every cluster: give at least one of --older-than, --match, --dead.", file=sys.stderr)
+            sys.exit(-1)
+        segments = [SEGMENTS_BY_NAME[ARGS.network]] if ARGS.network else list(SEGMENTS_BY_NAME.values())
+        stale = select_stale(
+            cluster_records(segments),
+            older_than=ARGS.older_than * 86400 if ARGS.older_than is not None else None,
+            match=ARGS.match,
+            dead=ARGS.dead,
+        )
+        calls, failed = reap(stale, dry_run=ARGS.dry_run)
+        if ARGS.dry_run:
+            print(f"\nDry run: would release the IPs of {len(stale)} clusters.", file=sys.stderr)
+        else:
+            print(f"\nReleased the IPs of {len(stale) - len(failed)} clusters in {calls} requests.", file=sys.stderr)
+        if failed:
+            print(f"Could not reap {len(failed)} clusters whose records changed since the scan: {', '.join(failed)}", file=sys.stderr)
+            sys.exit(1)
     elif ARGS.subcommand == "release":
-        release_ips()
+        if server:
+            server_request("POST", "/release", dict(api_vip=ARGS.api_vip, ingress_vip=ARGS.ingress_vip, cluster_name=ARGS.cluster_name))
+        else:
+            release_ips(ARGS.api_vip, ARGS.ingress_vip, ARGS.cluster_name)
+    print_route53_stats()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except PingError as e:
+        print(f"Can't ping: {e}", file=sys.stderr)
+        sys.exit(1)